@@ -0,0 +1,206 @@
+"""Load test dell'endpoint /api/predict.
+
+Esempi:
+    python -m benchmarks.load_test --base-url http://localhost:7071 --requests 500 --concurrency 16
+    python -m benchmarks.load_test --synthetic 5000 --mode batch --batch-size 50 --rate 20
+    python -m benchmarks.load_test --output run.json --baseline baseline.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+
+from predict_client import records_from_frame
+
+
+DEFAULT_DATASET = "DIA_testset_RDKit_descriptors.csv"
+
+
+def load_records(dataset, synthetic=0, seed=42):
+    df = pd.read_csv(dataset)
+    if synthetic:
+        # Dataset sintetico: righe ricampionate con un rumore dell'1% sui
+        # descrittori continui, così le richieste non sono tutte identiche
+        rng = np.random.default_rng(seed)
+        df = df.sample(synthetic, replace=True, random_state=seed).reset_index(drop=True)
+        floats = df.select_dtypes(include="float").columns
+        df[floats] = df[floats] * (1 + rng.normal(0, 0.01, size=(len(df), len(floats))))
+    return records_from_frame(df)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return float(np.percentile(values, q))
+
+
+def summarize(samples, elapsed):
+    latencies = [s["latency_ms"] for s in samples if s["ok"]]
+    status = {}
+    for s in samples:
+        status[str(s["status"])] = status.get(str(s["status"]), 0) + 1
+    errors = sum(1 for s in samples if not s["ok"])
+    rows = sum(s["rows"] for s in samples if s["ok"])
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+        "rows_per_s": rows / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.fmean(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "status": status,
+    }
+
+
+class LoadTest:
+    def __init__(self, base_url, records, mode="single", batch_size=50, timeout=60):
+        self.url = base_url.rstrip("/") + ("/api/predict/batch" if mode == "batch" else "/api/predict")
+        self.records = records
+        self.mode = mode
+        self.batch_size = batch_size
+        self.timeout = timeout
+        # Una sessione keep-alive per thread (requests.Session non è thread-safe)
+        self._local = threading.local()
+
+    def _session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def payload(self, i):
+        if self.mode == "batch":
+            start = (i * self.batch_size) % len(self.records)
+            chunk = self.records[start:start + self.batch_size]
+            return chunk, len(chunk)
+        return self.records[i % len(self.records)], 1
+
+    def send(self, i, scheduled=None):
+        body, rows = self.payload(i)
+        started = time.perf_counter()
+        try:
+            response = self._session().post(self.url, json=body, timeout=self.timeout)
+            status = response.status_code
+            ok = status == 200
+        except requests.RequestException as e:
+            status = type(e).__name__
+            ok = False
+        finished = time.perf_counter()
+        return {
+            "latency_ms": (finished - started) * 1000,
+            # Ritardo rispetto all'istante pianificato (solo con --rate)
+            "queue_ms": (started - scheduled) * 1000 if scheduled is not None else 0.0,
+            "status": status,
+            "ok": ok,
+            "rows": rows,
+        }
+
+    def run(self, n_requests, concurrency, rate=None):
+        # Con `rate` le richieste partono a intervalli fissi (carico aperto),
+        # altrimenti ogni worker invia la successiva appena riceve la risposta.
+        start = time.perf_counter()
+
+        def job(i):
+            scheduled = None
+            if rate:
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            return self.send(i, scheduled)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(job, range(n_requests)))
+        return samples, time.perf_counter() - start
+
+
+def compare(current, baseline, tolerance):
+    # Regressione se p95 peggiora o il throughput cala oltre la tolleranza
+    regressions = []
+    cur, base = current["warm"], baseline["warm"]
+    if base["latency_ms"]["p95"] and cur["latency_ms"]["p95"] and \
+            cur["latency_ms"]["p95"] > base["latency_ms"]["p95"] * (1 + tolerance):
+        regressions.append(f"p95 {cur['latency_ms']['p95']:.1f} ms > {base['latency_ms']['p95']:.1f} ms")
+    if base["throughput_rps"] and cur["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {cur['throughput_rps']:.1f} < {base['throughput_rps']:.1f} req/s")
+    if cur["error_rate"] > base["error_rate"] + tolerance / 10:
+        regressions.append(f"error rate {cur['error_rate']:.2%} > {base['error_rate']:.2%}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test dell'API di predizione")
+    parser.add_argument("--base-url", default="http://localhost:7071",
+                        help="host delle Function (es. quello di 'func start' o l'App Service)")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET)
+    parser.add_argument("--synthetic", type=int, default=0, help="numero di righe sintetiche da generare")
+    parser.add_argument("--mode", choices=["single", "batch"], default="single")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=None, help="richieste al secondo (carico aperto)")
+    parser.add_argument("--cold-requests", type=int, default=1,
+                        help="richieste iniziali inviate da sole e contate come cold start")
+    parser.add_argument("--output", help="file JSON con i risultati")
+    parser.add_argument("--baseline", help="JSON di un run precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    records = load_records(args.dataset, args.synthetic)
+    test = LoadTest(args.base_url, records, args.mode, args.batch_size)
+    print(f"Target: {test.url} | {len(records)} record | {args.requests} richieste, "
+          f"concorrenza {args.concurrency}" + (f", {args.rate} req/s" if args.rate else ""))
+
+    # Cold start: le prime richieste vengono inviate in sequenza, prima del
+    # carico, così includono l'eventuale avvio dell'host e il caricamento del modello
+    cold_started = time.perf_counter()
+    cold = [test.send(i) for i in range(args.cold_requests)]
+    cold_elapsed = time.perf_counter() - cold_started
+
+    warm, warm_elapsed = test.run(args.requests, args.concurrency, args.rate)
+
+    result = {
+        "config": vars(args) | {"url": test.url, "records": len(records)},
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cold": summarize(cold, cold_elapsed),
+        "warm": summarize(warm, warm_elapsed),
+        "queue_ms_p95": percentile([s["queue_ms"] for s in warm], 95),
+    }
+
+    for phase in ("cold", "warm"):
+        s = result[phase]
+        lat = s["latency_ms"]
+        fmt = lambda v: f"{v:.1f}" if v is not None else "-"
+        print(f"[{phase}] {s['requests']} req, {s['throughput_rps']:.1f} req/s, {s['rows_per_s']:.1f} righe/s, "
+              f"p50 {fmt(lat['p50'])} ms, p95 {fmt(lat['p95'])} ms, p99 {fmt(lat['p99'])} ms, "
+              f"errori {s['error_rate']:.2%} {s['status']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Risultati salvati in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONE rispetto al baseline: " + "; ".join(regressions))
+            return 1
+        print("Nessuna regressione rispetto al baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
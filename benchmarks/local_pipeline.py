@@ -0,0 +1,142 @@
+"""Esecuzione locale dell'intera pipeline, in-process e senza Azure.
+
+Carica il CSV di training nel backend di storage scelto (memoria o cartella
+locale, vedi storage.py) e chiama direttamente le funzioni di
+function_app.py: upload -> data_preprocessing -> train_model (e training
+pianificato) -> predict e predict/batch sul CSV di test. Stampa la durata di ogni stadio; con
+--profile salva il profilo cProfile dell'intero run.
+
+Esempi:
+    python -m benchmarks.local_pipeline
+    python -m benchmarks.local_pipeline --backend local --root .storage
+    python -m benchmarks.local_pipeline --profile pipeline.prof --predict-rows 500
+    TRAINING_CANDIDATES=random_forest python -m benchmarks.local_pipeline
+"""
+import argparse
+import cProfile
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+import storage
+
+
+DEFAULT_TRAIN = os.path.join("dashboard", "DIA_trainingset_RDKit_descriptors.csv")
+DEFAULT_TEST = "DIA_testset_RDKit_descriptors.csv"
+
+
+def user_function(function):
+    # Le funzioni decorate da FunctionApp sono FunctionBuilder: recuperiamo
+    # la funzione Python originale per chiamarla direttamente
+    return function.build().get_user_function() if hasattr(function, "build") else function
+
+
+def trigger_client(container, name):
+    # Come il binding BlobClient dei trigger: solo il riferimento al blob
+    return storage.get_blob_client(container, name)
+
+
+def run(args):
+    import azure.functions as func
+    import function_app
+    import scheduler
+    from predict_client import records_from_frame
+    from preprocessing import processed_filename
+
+    timings = {}
+
+    def stage(name, fn, *fn_args):
+        started = time.perf_counter()
+        result = fn(*fn_args)
+        timings[name] = time.perf_counter() - started
+        print(f"{name}: {timings[name]:.3f}s")
+        return result
+
+    input_name = os.path.basename(args.train)
+    with open(args.train, "rb") as f:
+        raw = f.read()
+    stage("upload", storage.write_blob, storage.get_blob_client("input-data", input_name), raw)
+
+    stage("preprocess", user_function(function_app.data_preprocessing), trigger_client("input-data", input_name))
+
+    processed_name = processed_filename(input_name)
+
+    def train():
+        user_function(function_app.train_model)(trigger_client("processed-data", processed_name))
+        # Con lo scheduler attivo train_model mette solo il file in coda:
+        # il training parte subito invece di aspettare il timer
+        if scheduler.TRAINING_SCHEDULER:
+            scheduler.run_pending(function_app.train_processed, force=True)
+
+    stage("train", train)
+
+    test = pd.read_csv(args.test)
+    records = records_from_frame(test)[:args.predict_rows]
+    predict = user_function(function_app.predict)
+
+    def predict_single():
+        predictions = []
+        for record in records:
+            response = predict(func.HttpRequest("POST", "/api/predict", body=json.dumps(record).encode()))
+            if response.status_code != 200:
+                raise RuntimeError(f"predict: HTTP {response.status_code} {response.get_body()[:200]}")
+            predictions.append(json.loads(response.get_body())["prediction"])
+        return predictions
+
+    def predict_batch():
+        response = user_function(function_app.predict_batch)(
+            func.HttpRequest("POST", "/api/predict/batch", body=json.dumps(records).encode()))
+        if response.status_code != 200:
+            raise RuntimeError(f"predict/batch: HTTP {response.status_code} {response.get_body()[:200]}")
+        print(f"  Server-Timing: {response.headers.get('Server-Timing')}")
+        return [r.get("prediction") for r in json.loads(response.get_body())["results"]]
+
+    single = stage("predict", predict_single)
+    batch = stage("predict_batch", predict_batch)
+
+    if "Label" in test.columns:
+        labels = test["Label"].astype(str).tolist()[:len(records)]
+        accuracy = sum(p == l for p, l in zip(batch, labels)) / len(labels)
+        print(f"Accuratezza sul test set ({len(labels)} righe): {accuracy:.3f}")
+    if single != batch:
+        print("ATTENZIONE: predict e predict/batch danno risultati diversi.")
+
+    print(f"Blob: { {c: storage.list_blobs(c) for c in ('input-data', 'processed-data', 'models')} }")
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pipeline completa in locale (senza Azure)")
+    parser.add_argument("--backend", choices=["memory", "local"], default="memory")
+    parser.add_argument("--root", default=storage.STORAGE_LOCAL_ROOT, help="cartella del backend 'local'")
+    parser.add_argument("--train", default=DEFAULT_TRAIN)
+    parser.add_argument("--test", default=DEFAULT_TEST)
+    parser.add_argument("--predict-rows", type=int, default=100, help="righe del test set da predire")
+    parser.add_argument("--profile", help="file in cui salvare il profilo cProfile")
+    parser.add_argument("--output", help="file JSON con le durate degli stadi")
+    args = parser.parse_args(argv)
+
+    storage.set_backend(args.backend, args.root)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    started = time.perf_counter()
+    timings = run(args)
+    timings["total"] = time.perf_counter() - started
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profilo salvato in {args.profile} (python -m pstats {args.profile})")
+    print(f"Totale: {timings['total']:.3f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(timings, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""Micro-benchmark offline di preprocessing, training e inferenza.
+
+Esegue la logica degli stadi della pipeline su dati locali, senza Azure:
+il CSV di training incluso nel repository e versioni sintetiche 10x, 100x,
+1000x. Ogni stadio gira in un processo separato per misurarne il picco di
+memoria (RSS).
+
+Esempi:
+    python -m benchmarks.pipeline_bench --scales 1 10
+    python -m benchmarks.pipeline_bench --scales 1 10 100 --save-baseline
+    python -m benchmarks.pipeline_bench --scales 1 10 100 --baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline_bench --scales 1 10 --compare-pruning
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_DATASET = os.path.join("dashboard", "DIA_trainingset_RDKit_descriptors.csv")
+DEFAULT_BASELINE = os.path.join("benchmarks", "baseline.json")
+TARGET_COLUMN = "Label"
+
+
+def peak_rss_mb():
+    # ru_maxrss è in KB su Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_dataset(path, scale, seed=42):
+    # Dataset sintetico: righe ricampionate con rumore dell'1% sui descrittori
+    # continui (le colonne intere e la Label restano valori plausibili)
+    df = pd.read_csv(path)
+    if scale > 1:
+        rng = np.random.default_rng(seed)
+        df = df.sample(len(df) * scale, replace=True, random_state=seed).reset_index(drop=True)
+        floats = df.select_dtypes(include="float").columns
+        df[floats] = df[floats] * (1 + rng.normal(0, 0.01, size=(len(df), len(floats))))
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    return buffer.getvalue().encode()
+
+
+# --- Stadi (eseguiti nei processi figli) ---
+
+def stage_preprocess(workdir, fmt, prune=True):
+    from preprocessing import clean_frame, fit_transform, serialize_processed
+
+    with open(os.path.join(workdir, "input.csv"), "rb") as f:
+        data = f.read()
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    df = pd.read_csv(io.BytesIO(data))
+    df_clean = clean_frame(df, target=TARGET_COLUMN)
+    transform, pruning = fit_transform(df_clean, target=TARGET_COLUMN, prune=prune)
+    df_clean = transform.transform_frame(df_clean, target=TARGET_COLUMN)
+    output = serialize_processed(df_clean, target=TARGET_COLUMN, fmt=fmt)
+    elapsed = time.perf_counter() - started
+    if isinstance(output, str):
+        output = output.encode()
+    name = "processed.npy" if fmt == "npy" else "processed.csv"
+    with open(os.path.join(workdir, name), "wb") as f:
+        f.write(output)
+    with open(os.path.join(workdir, "transform.npz"), "wb") as f:
+        f.write(transform.to_bytes())
+    return {"wall_s": elapsed, "rss_before_mb": rss_before, "peak_rss_mb": peak_rss_mb(),
+            "rows": len(df_clean), "features": len(df_clean.columns) - 1, "input_bytes": len(data),
+            "artifact_bytes": len(output),
+            "record_bytes": pruning["record_bytes_after"] if pruning else None}
+
+
+def stage_train(workdir, fmt):
+    import joblib
+    from compiled_forest import build_compiled, COMPILED_FILENAME
+    from preprocessing import read_processed
+    from schema import FeatureSchema
+    from training import select_model
+
+    name = "processed.npy" if fmt == "npy" else "processed.csv"
+    with open(os.path.join(workdir, name), "rb") as f:
+        data = f.read()
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    df = read_processed(name, data)
+    X = df.drop(columns=[TARGET_COLUMN])
+    X_train = X.to_numpy(dtype=np.float32)
+    load_s = time.perf_counter() - started
+    result = select_model(X_train, df[TARGET_COLUMN].to_numpy())
+    fit_s = time.perf_counter() - started - load_s
+    model_buffer = io.BytesIO()
+    joblib.dump(result.model, model_buffer)
+    compiled, _ = build_compiled(result.model, X_train)
+    elapsed = time.perf_counter() - started
+
+    with open(os.path.join(workdir, "model.pkl"), "wb") as f:
+        f.write(model_buffer.getvalue())
+    if compiled is not None:
+        with open(os.path.join(workdir, COMPILED_FILENAME), "wb") as f:
+            f.write(compiled)
+    schema = FeatureSchema.from_training_frame(X, target=TARGET_COLUMN, classes=result.model.classes_.tolist())
+    with open(os.path.join(workdir, "manifest.json"), "w") as f:
+        f.write(schema.to_manifest())
+    return {"wall_s": elapsed, "load_s": load_s, "fit_s": fit_s, "rss_before_mb": rss_before,
+            "peak_rss_mb": peak_rss_mb(), "model": result.name,
+            "artifact_bytes": len(model_buffer.getvalue()),
+            "compiled_bytes": len(compiled) if compiled is not None else None}
+
+
+def stage_predict(workdir, dataset_path, repeats=200, batch_rows=1000):
+    import joblib
+    from compiled_forest import CompiledForest, COMPILED_FILENAME, map_fields
+    from schema import FeatureSchema
+    from transform import FittedTransform
+    # Import di scikit-learn fuori dalla misura del caricamento del modello
+    import sklearn.ensemble  # noqa: F401
+
+    with open(os.path.join(workdir, "manifest.json")) as f:
+        schema = FeatureSchema.from_manifest(f.read())
+    with open(os.path.join(workdir, "transform.npz"), "rb") as f:
+        vectorizer = FittedTransform.from_bytes(f.read())
+    records = pd.read_csv(dataset_path).drop(columns=[TARGET_COLUMN, "SMILES"], errors="ignore").to_dict("records")
+    batch = (records * (batch_rows // len(records) + 1))[:batch_rows]
+    rss_before = peak_rss_mb()
+    stage_started = time.perf_counter()
+
+    models = {}
+    started = time.perf_counter()
+    models["sklearn"] = joblib.load(os.path.join(workdir, "model.pkl"))
+    load_times = {"sklearn": time.perf_counter() - started}
+    compiled_path = os.path.join(workdir, COMPILED_FILENAME)
+    if os.path.exists(compiled_path):
+        started = time.perf_counter()
+        models["compiled"] = CompiledForest(map_fields(compiled_path), schema.classes)
+        load_times["compiled"] = time.perf_counter() - started
+
+    out = {"rss_before_mb": rss_before}
+    for kind, model in models.items():
+        # Stesso percorso di predict: JSON -> array trasformato -> modello
+        timings = []
+        for i in range(repeats):
+            t = time.perf_counter()
+            model.predict(vectorizer.vectorize(records[i % len(records)]))
+            timings.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        X, _, _ = vectorizer.vectorize_many(batch)
+        model.predict_proba(X)
+        batch_s = time.perf_counter() - t
+        out[kind] = {
+            "load_ms": load_times[kind] * 1000,
+            "single_p50_ms": float(np.percentile(timings, 50) * 1000),
+            "single_p95_ms": float(np.percentile(timings, 95) * 1000),
+            "batch_rows_per_s": batch_rows / batch_s,
+        }
+    # Tempo dell'intero stadio: caricamento dei modelli, predizioni singole e batch
+    out["wall_s"] = time.perf_counter() - stage_started
+    out["peak_rss_mb"] = peak_rss_mb()
+    return out
+
+
+def _child(queue, fn, args):
+    try:
+        queue.put(("ok", fn(*args)))
+    except Exception as e:
+        queue.put(("error", repr(e)))
+
+
+def run_isolated(fn, *args):
+    # Processo nuovo per ogni stadio: il picco RSS non è "sporcato" dagli altri
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(queue, fn, args))
+    process.start()
+    status, value = queue.get()
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"{fn.__name__}: {value}")
+    return value
+
+
+def compare(results, baseline, tolerance):
+    # Confronto di tempo, memoria e dimensione degli artefatti per stadio
+    regressions = []
+    for key, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(key, {}).get(stage)
+            if not base:
+                continue
+            for metric in ("wall_s", "peak_rss_mb", "artifact_bytes"):
+                cur, ref = metrics.get(metric), base.get(metric)
+                if cur is not None and ref and cur > ref * (1 + tolerance):
+                    regressions.append(f"{key}/{stage}/{metric}: {cur:.3f} > {ref:.3f}")
+            # Latenza e throughput di predict, per tipo di modello
+            for kind in ("sklearn", "compiled"):
+                cur, ref = metrics.get(kind), base.get(kind)
+                if not isinstance(cur, dict) or not isinstance(ref, dict):
+                    continue
+                if ref.get("single_p95_ms") and cur["single_p95_ms"] > ref["single_p95_ms"] * (1 + tolerance):
+                    regressions.append(f"{key}/{stage}/{kind}/single_p95_ms: "
+                                       f"{cur['single_p95_ms']:.3f} > {ref['single_p95_ms']:.3f}")
+                if ref.get("batch_rows_per_s") and cur["batch_rows_per_s"] < ref["batch_rows_per_s"] / (1 + tolerance):
+                    regressions.append(f"{key}/{stage}/{kind}/batch_rows_per_s: "
+                                       f"{cur['batch_rows_per_s']:.0f} < {ref['batch_rows_per_s']:.0f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline degli stadi della pipeline")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="formato di processed-data")
+    parser.add_argument("--output", help="file JSON con i risultati")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="salva i risultati come nuovo baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--no-prune", action="store_true", help="disattiva la riduzione dei descrittori")
+    parser.add_argument("--compare-pruning", action="store_true",
+                        help="ripete preprocess e train senza riduzione dei descrittori e mostra il risparmio")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for scale in args.scales:
+        key = f"{scale}x-{args.format}"
+        with tempfile.TemporaryDirectory() as workdir:
+            with open(os.path.join(workdir, "input.csv"), "wb") as f:
+                f.write(make_dataset(args.dataset, scale))
+            stages = {
+                "preprocess": run_isolated(stage_preprocess, workdir, args.format, not args.no_prune),
+                "train": run_isolated(stage_train, workdir, args.format),
+                "predict": run_isolated(stage_predict, workdir, args.dataset),
+            }
+            if args.compare_pruning and not args.no_prune:
+                unpruned = {
+                    "preprocess": run_isolated(stage_preprocess, workdir, args.format, False),
+                    "train": run_isolated(stage_train, workdir, args.format),
+                }
+                full_record = len(json.dumps(pd.read_csv(args.dataset, nrows=1)
+                                             .drop(columns=[TARGET_COLUMN, "SMILES"], errors="ignore")
+                                             .to_dict("records")[0]))
+                stages["pruning"] = {
+                    "features": [unpruned["preprocess"]["features"], stages["preprocess"]["features"]],
+                    "fit_s_saved": unpruned["train"]["fit_s"] - stages["train"]["fit_s"],
+                    "model_bytes_saved": unpruned["train"]["artifact_bytes"] - stages["train"]["artifact_bytes"],
+                    "processed_bytes_saved": (unpruned["preprocess"]["artifact_bytes"]
+                                              - stages["preprocess"]["artifact_bytes"]),
+                    "record_bytes": [full_record, stages["preprocess"]["record_bytes"]],
+                }
+        results[key] = stages
+        for stage, m in stages.items():
+            if stage == "pruning":
+                continue
+            extra = f", artefatto {m['artifact_bytes'] / 1024:.0f} KB" if m.get("artifact_bytes") else ""
+            print(f"[{key}] {stage}: {m['wall_s']:.3f}s, picco RSS {m['peak_rss_mb']:.0f} MB{extra}")
+        for kind in ("sklearn", "compiled"):
+            if kind in stages["predict"]:
+                p = stages["predict"][kind]
+                print(f"[{key}] predict/{kind}: load {p['load_ms']:.1f} ms, singola p50 {p['single_p50_ms']:.3f} ms, "
+                      f"batch {p['batch_rows_per_s']:.0f} righe/s")
+        if "pruning" in stages:
+            p = stages["pruning"]
+            print(f"[{key}] riduzione descrittori: {p['features'][0]} -> {p['features'][1]} feature, "
+                  f"fit -{p['fit_s_saved']:.2f}s, modello -{p['model_bytes_saved'] / 1024:.0f} KB, "
+                  f"processed -{p['processed_bytes_saved'] / 1024:.0f} KB, "
+                  f"record JSON {p['record_bytes'][0]} -> {p['record_bytes'][1]} bytes")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline salvato in {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONE rispetto al baseline:\n  " + "\n  ".join(regressions))
+            return 1
+        print("Nessuna regressione rispetto al baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
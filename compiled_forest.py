@@ -0,0 +1,207 @@
+import glob
+import io
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+
+# --- FOREST COMPILATA (inferenza vettoriale su array NumPy) ---
+# Tutti gli alberi del modello vengono appiattiti in un array piatto per ogni
+# campo dei nodi: feature, soglia, figli e probabilità delle foglie.
+# L'artefatto è la sequenza dei cinque array in formato .npy: ognuno viene
+# mappato in memoria direttamente dal file (np.memmap) senza copie né
+# deserializzazione di oggetti scikit-learn, e la predizione è una visita
+# vettoriale di tutti gli alberi.
+
+COMPILED_FILENAME = "model_compiled.bin"
+# "float32" = soglie e probabilità in float32 (artefatto più piccolo, usato
+# solo se supera il controllo di parità), "float64" = copia esatta
+COMPILED_PRECISION = os.getenv("COMPILED_PRECISION", "float32")
+# Cartella locale, riservata alla forest compilata, in cui l'artefatto viene
+# salvato per essere mappato in memoria (le versioni precedenti vi vengono cancellate)
+COMPILED_CACHE_DIR = os.getenv("COMPILED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sdcc-compiled"))
+# Oltre questo numero di righe per chiamata il pickle scikit-learn (visita
+# in C albero per albero) è più veloce della visita vettoriale: i batch
+# grandi usano quello, caricato alla prima richiesta (vedi model_cache.py)
+COMPILED_MAX_BATCH_ROWS = int(os.getenv("COMPILED_MAX_BATCH_ROWS", "256"))
+
+# Campi dei nodi, nell'ordine in cui sono scritti nell'artefatto
+FIELDS = ("feature", "threshold", "left", "right", "value")
+
+_TREE_LEAF = -1
+
+
+def compile_model(model, precision=COMPILED_PRECISION):
+    # Ritorna i campi dei nodi {nome: array}, oppure None se il modello non è
+    # un albero/ensemble di alberi (es. regressione logistica, SVM).
+    if hasattr(model, "estimators_") and all(hasattr(e, "tree_") for e in np.ravel(model.estimators_)):
+        trees = [e.tree_ for e in np.ravel(model.estimators_)]
+    elif hasattr(model, "tree_"):
+        trees = [model.tree_]
+    else:
+        return None
+    if getattr(model, "n_outputs_", 1) != 1:
+        return None
+
+    real = np.float32 if precision == "float32" else np.float64
+    n_nodes = sum(t.node_count for t in trees)
+    fields = {
+        "feature": np.empty(n_nodes, dtype="<i4"),
+        "threshold": np.empty(n_nodes, dtype=real),
+        "left": np.empty(n_nodes, dtype="<i4"),
+        "right": np.empty(n_nodes, dtype="<i4"),
+        "value": np.empty((n_nodes, len(model.classes_)), dtype=real),
+    }
+    offset = 0
+    for tree in trees:
+        n = tree.node_count
+        ids = np.arange(offset, offset + n, dtype=np.int32)
+        leaf = tree.children_left == _TREE_LEAF
+        block = slice(offset, offset + n)
+        # Le foglie puntano a se stesse: la visita può proseguire per un
+        # numero fisso di passi senza rami condizionali
+        fields["feature"][block] = np.where(leaf, 0, tree.feature)
+        fields["threshold"][block] = np.where(leaf, np.inf, tree.threshold)
+        fields["left"][block] = np.where(leaf, ids, tree.children_left + offset)
+        fields["right"][block] = np.where(leaf, ids, tree.children_right + offset)
+        value = tree.value[:, 0, :]
+        fields["value"][block] = value / value.sum(axis=1, keepdims=True)
+        offset += n
+    return fields
+
+
+def to_bytes(fields):
+    # I campi uno dopo l'altro, ognuno come .npy: l'intestazione .npy allinea
+    # i dati a 64 byte, così ogni campo si mappa direttamente dal file
+    buffer = io.BytesIO()
+    for field in FIELDS:
+        np.save(buffer, np.ascontiguousarray(fields[field]), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def map_fields(path):
+    # Un np.memmap in sola lettura per ogni campo dell'artefatto in `path`
+    fields = {}
+    with open(path, "rb") as f:
+        for field in FIELDS:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+            fields[field] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                                      order="F" if fortran_order else "C")
+            f.seek(offset + fields[field].nbytes)
+    return fields
+
+
+def remove_stale(path):
+    # Cancella gli artefatti delle versioni precedenti, solo dentro
+    # COMPILED_CACHE_DIR: le mappature ancora aperte restano valide fino a
+    # quando il modello vecchio viene rilasciato (su Windows il file in uso
+    # non si può cancellare: ci si riprova al caricamento successivo)
+    for stale in glob.glob(os.path.join(COMPILED_CACHE_DIR, "model_*.bin")):
+        if stale == path or os.path.basename(stale) == COMPILED_FILENAME:
+            continue
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+
+class CompiledForest:
+    # Stessa interfaccia di predict/predict_proba/classes_ dei modelli
+    # scikit-learn, così predict non deve distinguere i due casi.
+    def __init__(self, fields, classes):
+        self.classes_ = np.asarray(classes)
+        # Array piatti (o memmap) usati così come sono, senza copie
+        self.feature = fields["feature"]
+        self.threshold = fields["threshold"]
+        self.left = fields["left"]
+        self.right = fields["right"]
+        self.value = fields["value"]
+        # Le radici sono i nodi che non sono figli di nessun altro nodo
+        n_nodes = len(self.left)
+        is_child = np.zeros(n_nodes, dtype=bool)
+        internal = self.left != np.arange(n_nodes)
+        is_child[self.left[internal]] = True
+        is_child[self.right[internal]] = True
+        self.roots = np.flatnonzero(~is_child).astype(np.int32)
+        self.n_trees = len(self.roots)
+
+    @classmethod
+    def load(cls, data, classes, version=None):
+        # Salviamo l'artefatto su disco locale e lo mappiamo in memoria: il
+        # caricamento non copia né deserializza i nodi.
+        os.makedirs(COMPILED_CACHE_DIR, exist_ok=True)
+        path = os.path.join(COMPILED_CACHE_DIR, f"model_{version}.bin" if version else COMPILED_FILENAME)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        forest = cls(map_fields(path), classes)
+        if version:
+            remove_stale(path)
+        return forest
+
+
+    def apply(self, X):
+        # Indice della foglia raggiunta da ogni riga in ogni albero: (n_righe, n_alberi)
+        X = np.asarray(X, dtype=np.float32)
+        if self.threshold.dtype == np.float64:
+            # Stesso confronto di scikit-learn: input float32, soglie float64
+            X = X.astype(np.float64)
+        # Coppie (riga, albero) appiattite: a ogni passo avanzano solo quelle
+        # non ancora arrivate a una foglia (le foglie puntano a se stesse),
+        # così il costo segue la profondità effettiva di ogni percorso e non
+        # quella della foglia più profonda
+        n_rows, n_features = X.shape
+        X = np.ascontiguousarray(X).ravel()
+        offset = np.repeat(np.arange(n_rows, dtype=np.intp) * n_features, self.n_trees)
+        node = np.tile(self.roots.astype(np.intp), n_rows)
+        active = np.flatnonzero(self.left[node] != node)
+        while active.size:
+            current = node[active]
+            go_left = X[offset[active] + self.feature[current]] <= self.threshold[current]
+            next_node = np.where(go_left, self.left[current], self.right[current])
+            node[active] = next_node
+            active = active[self.left[next_node] != next_node]
+        return node.reshape(n_rows, self.n_trees)
+
+    def predict_proba(self, X):
+        return self.value[self.apply(X)].mean(axis=1, dtype=np.float64)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def parity_check(model, compiled, X):
+    # Confronto con il modello scikit-learn sui dati di training
+    expected = model.predict_proba(X)
+    actual = compiled.predict_proba(X)
+    return {
+        "rows": int(len(X)),
+        "prediction_mismatches": int(np.sum(np.argmax(expected, axis=1) != np.argmax(actual, axis=1))),
+        "max_proba_abs_diff": float(np.max(np.abs(expected - actual))) if len(X) else 0.0,
+    }
+
+
+def build_compiled(model, X, precision=COMPILED_PRECISION):
+    # Compila il modello e verifica la parità; se la variante float32 non
+    # riproduce esattamente le predizioni si ripiega sulla versione float64.
+    # Ritorna (bytes dell'artefatto, report) oppure (None, None).
+    for candidate in dict.fromkeys([precision, "float64"]):
+        fields = compile_model(model, candidate)
+        if fields is None:
+            return None, None
+        parity = parity_check(model, CompiledForest(fields, model.classes_), X)
+        parity["precision"] = candidate
+        if parity["prediction_mismatches"] == 0:
+            data = to_bytes(fields)
+            parity["size_bytes"] = len(data)
+            return data, parity
+        logging.warning(f"Forest compilata ({candidate}) non coerente con scikit-learn: {parity}")
+    return None, parity
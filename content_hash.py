@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import os
+
+from azure.core.exceptions import ResourceNotFoundError
+
+import storage
+
+
+# --- CACHE CONTENT-ADDRESSED DEGLI STADI DELLA PIPELINE ---
+# Ogni stadio calcola un'impronta del proprio input + versione del codice +
+# configurazione e la salva nei metadati del blob prodotto. Se l'artefatto
+# esistente ha già la stessa impronta, lo stadio può essere saltato.
+
+# PIPELINE_CONTENT_CACHE=0 forza la riesecuzione di tutti gli stadi
+CONTENT_CACHE_ENABLED = os.getenv("PIPELINE_CONTENT_CACHE", "1") != "0"
+
+HASH_METADATA_KEY = "content_hash"
+ELAPSED_METADATA_KEY = "stage_elapsed_ms"
+
+_HASH_BLOCK_BYTES = 4 * 1024 * 1024
+_code_versions = {}
+
+
+def code_version(*modules):
+    # Hash del sorgente dei moduli che implementano lo stadio: cambiando il
+    # codice cambia l'impronta e gli artefatti vengono rigenerati.
+    key = tuple(m.__name__ for m in modules)
+    if key not in _code_versions:
+        digest = hashlib.sha256()
+        for module in modules:
+            with open(module.__file__, "rb") as f:
+                digest.update(f.read())
+        _code_versions[key] = digest.hexdigest()[:16]
+    return _code_versions[key]
+
+
+def fingerprint(data, code, config=None):
+    # `data` può essere bytes, un file-like oppure un iterabile di blocchi di
+    # bytes (es. i chunk di un download): non serve tenerlo tutto in memoria.
+    # Un file-like seekable viene riportato alla posizione iniziale; uno non
+    # seekable (es. uno stream di download) viene consumato.
+    digest = hashlib.sha256()
+    digest.update(code.encode())
+    digest.update(json.dumps(config or {}, sort_keys=True, default=str).encode())
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        digest.update(data)
+    elif hasattr(data, "read"):
+        seekable = getattr(data, "seekable", lambda: False)()
+        start = data.tell() if seekable else None
+        for block in iter(lambda: data.read(_HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+        if seekable:
+            data.seek(start)
+    else:
+        for block in data:
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_artifact(blob_client, content_hash):
+    # Ritorna i metadati dell'artefatto se è già stato prodotto dallo stesso
+    # input con lo stesso codice/configurazione, altrimenti None.
+    try:
+        metadata = storage.blob_properties(blob_client).metadata or {}
+    except ResourceNotFoundError:
+        return None
+    if metadata.get(HASH_METADATA_KEY) == content_hash:
+        return metadata
+    return None
+
+
+def log_skip(stage, blob_name, metadata):
+    saved = metadata.get(ELAPSED_METADATA_KEY)
+    saved_text = f"~{float(saved) / 1000:.1f}s risparmiati" if saved else "tempo risparmiato non noto"
+    logging.info(f"[{stage}] Input invariato: '{blob_name}' è già aggiornato, stadio saltato ({saved_text}).")
+
+
+def stage_metadata(content_hash, elapsed_seconds, extra=None):
+    metadata = dict(extra or {})
+    metadata[HASH_METADATA_KEY] = content_hash
+    metadata[ELAPSED_METADATA_KEY] = f"{elapsed_seconds * 1000:.0f}"
+    return metadata
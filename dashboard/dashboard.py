@@ -1,11 +1,10 @@
 import streamlit as st
 import pandas as pd
-import requests
 import json
 import os
-import time
-from azure.storage.blob import BlobServiceClient
 from dotenv import load_dotenv
+import storage
+from predict_client import PredictClient, records_from_frame
 
 load_dotenv()           # per leggere file nascosto che contiene chiave di connessione
 
@@ -14,12 +13,21 @@ load_dotenv()           # per leggere file nascosto che contiene chiave di conne
 API_URL = "https://sdcc-gallo-fabrizio-app-c9bjg6bbcsa4aph3.italynorth-01.azurewebsites.net/api/predict" 
 CONTAINER_INPUT = "input-data"
 
+# Richieste in parallelo e righe per richiesta nell'analisi massiva
+MAX_WORKERS = 8
+BATCH_SIZE = 25
+
 
 CONNECTION_STRING = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
 
 if not CONNECTION_STRING:
     st.error("⚠️ ERRORE CRITICO: Connection String non trovata! Configura le variabili d'ambiente.")
     st.stop() # Ferma l'app se manca la chiave
+@st.cache_resource
+def get_client():
+    # Un solo client (e una sola sessione keep-alive) per tutti i rerun
+    return PredictClient(API_URL, max_workers=MAX_WORKERS, batch_size=BATCH_SIZE)
+
 # --- UI SETUP ---
 st.set_page_config(page_title="SDCC Drug AI", page_icon="💊", layout="centered")
 
@@ -76,7 +84,7 @@ if df is not None:
         with st.spinner("Chiamata al Cloud Azure in corso..."):
             try:
                 payload = input_data.to_dict()
-                response = requests.post(API_URL, json=payload)
+                response = get_client().session.post(API_URL, json=payload, timeout=get_client().timeout)
                 
                 if response.status_code == 200:
                     result = response.json()
@@ -154,47 +162,40 @@ if df is not None:
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        for i, (idx, batch_row) in enumerate(subset_to_analyze.iterrows()):
-            # Aggiorna progress bar
-            progress_bar.progress((i + 1) / total)
-            status_text.text(f"Analisi riga {idx} ({i+1}/{total})...")
+        # Prepara dati (conversione in blocco di tutte le righe)
+        payloads = records_from_frame(subset_to_analyze)
+        
+        def update_progress(done, total_rows):
+            # Aggiorna progress bar man mano che arrivano le risposte
+            progress_bar.progress(done / total_rows)
+            status_text.text(f"Analisi in corso ({done}/{total_rows})...")
+        
+        # Chiamate API concorrenti; i risultati tornano nell'ordine delle righe
+        api_results = get_client().predict_many(payloads, on_progress=update_progress)
+        
+        labels = subset_to_analyze['Label'] if 'Label' in subset_to_analyze.columns else [None] * total
+        for idx, real_label, r_json in zip(subset_to_analyze.index, labels, api_results):
+            if "error" in r_json:
+                results_list.append({"ID Riga": idx, "Esito": f"Errore: {r_json['error']}"})
+                continue
             
-            # Prepara dati
-            b_input = batch_row.drop(['Label', 'SMILES', 'Unnamed: 0'], errors='ignore').to_dict()
-            real_label = batch_row.get('Label', None)
+            pred_val = r_json.get('prediction', -1)
             
-            try:
-                # Chiamata API
-                resp = requests.post(API_URL, json=b_input)
-                outcome = "Errore"
-                pred_val = -1
-                
-                if resp.status_code == 200:
-                    r_json = resp.json()
-                    pred_val = r_json.get('prediction', -1)
-                    
-                    # Verifica correttezza
-                    match = False
-                    if real_label is not None:
-                        if str(pred_val) == str(int(real_label)):
-                            match = True
-                            correct_count += 1
-                        outcome = "✅ Corretto" if match else "❌ Errato"
-                    else:
-                        outcome = "N/A (No Label)"
-                
-                results_list.append({
-                    "ID Riga": idx,
-                    "Label Reale": int(real_label) if real_label is not None else "N/A",
-                    "Predizione AI": pred_val,
-                    "Esito": outcome
-                })
-                
-            except Exception as e:
-                results_list.append({"ID Riga": idx, "Esito": "Errore Conn"})
+            # Verifica correttezza
+            if real_label is not None:
+                match = str(pred_val) == str(int(real_label))
+                if match:
+                    correct_count += 1
+                outcome = "✅ Corretto" if match else "❌ Errato"
+            else:
+                outcome = "N/A (No Label)"
             
-            # Pausa minima per stabilità
-            time.sleep(0.02) 
+            results_list.append({
+                "ID Riga": idx,
+                "Label Reale": int(real_label) if real_label is not None else "N/A",
+                "Predizione AI": pred_val,
+                "Esito": outcome
+            })
             
         status_text.text("Analisi Completata!")
         
@@ -234,12 +235,11 @@ if train_file_buffer is not None:
         else:
             with st.spinner(f"Sto caricando '{train_file_buffer.name}' nel container '{CONTAINER_INPUT}'..."):
                 try:
-                    # Connessione al Blob Storage
-                    blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
-                    blob_client = blob_service_client.get_blob_client(container=CONTAINER_INPUT, blob=train_file_buffer.name)
+                    # Connessione al Blob Storage (client condiviso tra i rerun di Streamlit)
+                    blob_client = storage.get_blob_client(CONTAINER_INPUT, train_file_buffer.name, CONNECTION_STRING)
                     
-                    # Upload (overwrite=True sovrascrive se esiste già un file con lo stesso nome)
-                    blob_client.upload_blob(train_file_buffer, overwrite=True)
+                    # Upload a blocchi paralleli (overwrite=True sovrascrive se esiste già un file con lo stesso nome)
+                    storage.write_blob(blob_client, train_file_buffer.getvalue(), overwrite=True)
                     
                     st.success("✅ Upload completato con successo!")
                     st.balloons()
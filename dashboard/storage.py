@@ -0,0 +1,61 @@
+import os
+import threading
+
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+
+
+# --- ACCESSO ALLO STORAGE (client condiviso, upload paralleli) ---
+# Sottoinsieme di ../storage.py usato dalla dashboard (pubblicata da sola
+# come App Service): client condiviso e upload dei file in 'input-data'.
+# Un solo BlobServiceClient per processo: i caricamenti successivi riusano
+# le connessioni HTTPS già aperte invece di rifare handshake TLS e setup.
+
+# Connessioni HTTP tenute aperte nel pool del client
+STORAGE_POOL_SIZE = int(os.getenv("STORAGE_POOL_SIZE", "32"))
+# Richieste parallele per ogni upload (a blocchi)
+STORAGE_MAX_CONCURRENCY = int(os.getenv("STORAGE_MAX_CONCURRENCY", "4"))
+# Dimensione dei blocchi caricati in parallelo
+STORAGE_CHUNK_BYTES = int(os.getenv("STORAGE_CHUNK_BYTES", str(4 * 1024 * 1024)))
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _connection_string(connection_string=None):
+    return connection_string or os.getenv('AzureWebJobsStorage')
+
+
+def get_service_client(connection_string=None):
+    # Client creato alla prima chiamata e poi condiviso da tutto il processo
+    connect_str = _connection_string(connection_string)
+    client = _clients.get(connect_str)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(connect_str)
+            if client is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=STORAGE_POOL_SIZE,
+                                                        pool_maxsize=STORAGE_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                client = BlobServiceClient.from_connection_string(
+                    connect_str,
+                    transport=RequestsTransport(session=session, session_owner=False),
+                    max_single_put_size=STORAGE_CHUNK_BYTES,
+                    max_block_size=STORAGE_CHUNK_BYTES,
+                )
+                _clients[connect_str] = client
+    return client
+
+
+def get_blob_client(container, blob, connection_string=None):
+    return get_service_client(connection_string).get_blob_client(container=container, blob=blob)
+
+
+def write_blob(blob_client, data, metadata=None, overwrite=True, max_concurrency=STORAGE_MAX_CONCURRENCY):
+    # Upload a blocchi paralleli (sopra STORAGE_CHUNK_BYTES)
+    if isinstance(data, str):
+        data = data.encode()
+    return blob_client.upload_blob(data, overwrite=overwrite, metadata=metadata, max_concurrency=max_concurrency)
@@ -0,0 +1,325 @@
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import telemetry
+from schema import SchemaError
+
+try:
+    from rdkit import Chem, RDLogger, rdBase
+    from rdkit.Chem import Descriptors
+    # Niente log di RDKit per ogni SMILES non valido: l'errore torna al client
+    RDLogger.DisableLog("rdApp.*")
+except ImportError:  # rdkit non installato: predizione da SMILES non disponibile
+    Chem = Descriptors = rdBase = None
+
+
+# --- DESCRITTORI RDKit CALCOLATI DAL SERVER A PARTIRE DA SMILES ---
+# predict accetta anche solo le stringhe SMILES: i descrittori usati in
+# training vengono calcolati qui. I risultati restano in una cache LRU
+# indicizzata dallo SMILES canonico (la stessa molecola scritta in modi
+# diversi è una sola voce); i batch grandi vengono calcolati in un pool di
+# processi.
+
+# Numero massimo di molecole tenute in cache (ognuna ~8 byte per descrittore)
+DESCRIPTOR_CACHE_SIZE = int(os.getenv("DESCRIPTOR_CACHE_SIZE", "10000"))
+# Sotto questo numero di molecole da calcolare non conviene usare il pool
+DESCRIPTOR_POOL_MIN_BATCH = int(os.getenv("DESCRIPTOR_POOL_MIN_BATCH", "64"))
+# Processi del pool (0 = numero di CPU; 1 = calcolo sempre nel processo)
+DESCRIPTOR_POOL_WORKERS = int(os.getenv("DESCRIPTOR_POOL_WORKERS", "0")) or (os.cpu_count() or 1)
+
+# Nomi accettati per il campo SMILES nei payload
+SMILES_FIELDS = ("SMILES", "smiles")
+
+# Controllo di parità nel preprocessing: su un campione di righe i
+# descrittori forniti nel file vengono confrontati con quelli calcolati da
+# questo RDKit (i CSV hanno 3 decimali, da cui la tolleranza assoluta; una
+# differenza anche su una sola molecola basta per segnalare la colonna).
+# Versione di RDKit e colonne diverse finiscono nel manifest del modello.
+DESCRIPTOR_PARITY_ROWS = int(os.getenv("DESCRIPTOR_PARITY_ROWS", "1000"))
+DESCRIPTOR_PARITY_RTOL = float(os.getenv("DESCRIPTOR_PARITY_RTOL", "1e-4"))
+DESCRIPTOR_PARITY_ATOL = float(os.getenv("DESCRIPTOR_PARITY_ATOL", "1e-3"))
+# Con "1" la predizione da SMILES viene rifiutata se i descrittori calcolati
+# possono differire da quelli del training, altrimenti viene segnalato
+DESCRIPTOR_PARITY_STRICT = os.getenv("DESCRIPTOR_PARITY_STRICT", "0") != "0"
+
+_pool = None
+_pool_lock = threading.Lock()
+_calculators = {}
+# Modelli per cui la mancata parità è già stata scritta nel log
+_warned = set()
+
+
+def available():
+    return Chem is not None
+
+
+def rdkit_version():
+    return rdBase.rdkitVersion if available() else None
+
+
+class DescriptorCache:
+    # LRU thread-safe: SMILES canonico -> riga di descrittori (array float64)
+    def __init__(self, max_size=DESCRIPTOR_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._entries.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return row
+
+    def put(self, key, row):
+        with self._lock:
+            self._entries[key] = row
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+DESCRIPTOR_CACHE = DescriptorCache()
+
+
+def _descriptor_functions(names):
+    functions = dict(Descriptors.descList)
+    missing = [n for n in names if n not in functions]
+    if missing:
+        raise SchemaError(f"feature non calcolabili da SMILES ({len(missing)}): {missing[:10]}")
+    return [functions[n] for n in names]
+
+
+def _compute_row(functions, mol):
+    row = np.empty(len(functions), dtype=np.float64)
+    for j, fn in enumerate(functions):
+        try:
+            row[j] = fn(mol)
+        except Exception:
+            # Descrittore non definito per la molecola: verrà imputato
+            row[j] = np.nan
+    row.flags.writeable = False
+    return row
+
+
+def _compute_chunk(names, smiles):
+    # Eseguita nei processi del pool: riceve SMILES canonici già validati
+    functions = _descriptor_functions(names)
+    return [_compute_row(functions, Chem.MolFromSmiles(s)) for s in smiles]
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn: il worker delle Function ha thread attivi, fork non è sicuro
+                _pool = ProcessPoolExecutor(max_workers=DESCRIPTOR_POOL_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+class DescriptorCalculator:
+    def __init__(self, names):
+        self.names = list(names)
+        self.functions = _descriptor_functions(self.names)
+        # Le voci in cache valgono solo per lo stesso insieme di descrittori
+        self.key = hash(tuple(self.names))
+
+    def compute(self, smiles_list, cache=DESCRIPTOR_CACHE):
+        # Ritorna (matrice delle molecole valide, posizioni valide, errori per posizione)
+        rows = {}
+        errors = {}
+        pending = {}
+        for i, smiles in enumerate(smiles_list):
+            if not isinstance(smiles, str) or not smiles.strip():
+                errors[i] = "SMILES mancante o non testuale"
+                continue
+            mol = Chem.MolFromSmiles(smiles)
+            if mol is None:
+                errors[i] = f"SMILES non valido: {smiles[:100]}"
+                continue
+            canonical = Chem.MolToSmiles(mol)
+            row = cache.get((self.key, canonical))
+            if row is not None:
+                rows[i] = row
+            else:
+                pending.setdefault(canonical, (mol, []))[1].append(i)
+
+        if pending:
+            canonicals = list(pending)
+            if len(canonicals) >= DESCRIPTOR_POOL_MIN_BATCH and DESCRIPTOR_POOL_WORKERS > 1:
+                size = math.ceil(len(canonicals) / (DESCRIPTOR_POOL_WORKERS * 4))
+                chunks = [canonicals[k:k + size] for k in range(0, len(canonicals), size)]
+                computed = [row for chunk in _get_pool().map(_compute_chunk, [self.names] * len(chunks), chunks)
+                            for row in chunk]
+            else:
+                computed = [_compute_row(self.functions, pending[c][0]) for c in canonicals]
+            for canonical, row in zip(canonicals, computed):
+                cache.put((self.key, canonical), row)
+                for i in pending[canonical][1]:
+                    rows[i] = row
+
+        valid = sorted(rows)
+        X = np.vstack([rows[i] for i in valid]) if valid else np.empty((0, len(self.names)))
+        return X, valid, errors
+
+
+def calculator(names):
+    # Un calcolatore per insieme di descrittori (cambia solo con il modello)
+    key = tuple(names)
+    calc = _calculators.get(key)
+    if calc is None:
+        calc = DescriptorCalculator(names)
+        _calculators.clear()
+        _calculators[key] = calc
+    return calc
+
+
+def parity_check(frame, rows=DESCRIPTOR_PARITY_ROWS):
+    # Descrittori del file (colonne con il nome di un descrittore RDKit)
+    # ricalcolati dagli SMILES di `rows` righe distribuite sul file. Ritorna
+    # {"rdkit_version", "rows", "mismatched"} oppure None se non applicabile.
+    field = next((f for f in SMILES_FIELDS if f in frame.columns), None)
+    if not available() or field is None:
+        return None
+    functions = dict(Descriptors.descList)
+    names = [c for c in frame.columns if c in functions]
+    sample = frame[frame[field].notna()]
+    if not names or sample.empty:
+        return None
+    sample = sample.iloc[np.unique(np.linspace(0, len(sample) - 1, min(rows, len(sample))).astype(int))]
+    calc = [functions[n] for n in names]
+    computed = []
+    positions = []
+    for pos, smiles in enumerate(sample[field]):
+        mol = Chem.MolFromSmiles(str(smiles))
+        if mol is not None:
+            computed.append(_compute_row(calc, mol))
+            positions.append(pos)
+    if not computed:
+        return None
+    provided = sample.iloc[positions][names].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    close = np.isclose(np.vstack(computed), provided, rtol=DESCRIPTOR_PARITY_RTOL, atol=DESCRIPTOR_PARITY_ATOL,
+                       equal_nan=True)
+    return {
+        "rdkit_version": rdkit_version(),
+        "rows": len(computed),
+        "mismatched": [n for n, ok in zip(names, close.all(axis=0)) if not ok],
+    }
+
+
+def merge_parity(reports):
+    # Un solo risultato per più file (training su più input)
+    reports = [r for r in reports if r]
+    if not reports:
+        return None
+    versions = sorted({r["rdkit_version"] for r in reports})
+    return {
+        "rdkit_version": ",".join(versions),
+        "rows": sum(r["rows"] for r in reports),
+        "mismatched": sorted({n for r in reports for n in r["mismatched"]}),
+    }
+
+
+def parity_warnings(schema, input_columns):
+    # Avvisi sui descrittori calcolati da SMILES per il modello di `schema`:
+    # versione di RDKit diversa da quella del controllo di parità, o
+    # descrittori usati dal modello che non coincidono con quelli del
+    # training. Con DESCRIPTOR_PARITY_STRICT solleva SchemaError.
+    parity = getattr(schema, "descriptors", None)
+    warnings = []
+    if not parity:
+        warnings.append("parità tra descrittori del training e RDKit non verificata")
+    else:
+        if parity["rdkit_version"] != rdkit_version():
+            warnings.append(f"descrittori del training verificati con RDKit {parity['rdkit_version']}, "
+                            f"server con RDKit {rdkit_version()}")
+        columns = set(input_columns)
+        mismatched = [n for n in parity["mismatched"] if n in columns]
+        if mismatched:
+            warnings.append(f"{len(mismatched)} descrittori calcolati da SMILES diversi da quelli del "
+                            f"training: {mismatched[:10]}")
+    if warnings and DESCRIPTOR_PARITY_STRICT:
+        raise SchemaError(f"predizione da SMILES non disponibile per questo modello ({'; '.join(warnings)})")
+    key = getattr(schema, "model_version", None)
+    if warnings and key not in _warned:
+        _warned.add(key)
+        logging.warning(f"Predizione da SMILES con descrittori non allineati al training: {'; '.join(warnings)}")
+    return warnings
+
+
+def extract_smiles(body, input_columns):
+    # Se il payload contiene solo SMILES (e non le feature del modello)
+    # ritorna la lista degli SMILES, altrimenti None. Formati accettati:
+    # "CCO", ["CCO", ...], {"SMILES": "CCO"}, {"SMILES": ["CCO", ...]},
+    # [{"SMILES": "CCO"}, ...] e CSV con la sola colonna SMILES.
+    first_feature = input_columns[0] if input_columns else None
+    if isinstance(body, str):
+        return [body]
+    if isinstance(body, pd.DataFrame):
+        field = next((f for f in SMILES_FIELDS if f in body.columns), None)
+        if field is not None and first_feature not in body.columns:
+            return body[field].where(body[field].notna(), None).tolist()
+        return None
+    if isinstance(body, dict):
+        field = next((f for f in SMILES_FIELDS if f in body), None)
+        if field is None or first_feature in body:
+            return None
+        value = body[field]
+        return list(value) if isinstance(value, list) else [value]
+    if isinstance(body, list) and body:
+        if all(isinstance(item, str) for item in body):
+            return list(body)
+        if all(isinstance(item, dict) for item in body):
+            field = next((f for f in SMILES_FIELDS if f in body[0]), None)
+            if field is not None and first_feature not in body[0]:
+                return [item.get(field) for item in body]
+    return None
+
+
+def vectorize_smiles(smiles_list, vectorizer):
+    # SMILES -> descrittori (cache / pool) -> stessa matrice di vectorize_many
+    if not available():
+        raise SchemaError("predizione da SMILES non disponibile: rdkit non installato")
+    with telemetry.phase("descriptors", rows=len(smiles_list)) as ph:
+        hits = DESCRIPTOR_CACHE.hits
+        D, valid, errors = calculator(vectorizer.input_columns).compute(smiles_list)
+        ph.set("cache_hits", DESCRIPTOR_CACHE.hits - hits)
+    X, frame_valid, frame_errors = vectorizer.vectorize_frame(pd.DataFrame(D, columns=vectorizer.input_columns))
+    # Le posizioni di vectorize_frame sono relative alle molecole valide
+    for j, message in frame_errors.items():
+        errors[valid[j]] = message
+    return X, [valid[j] for j in frame_valid], errors
+
+
+def cache_stats():
+    stats = DESCRIPTOR_CACHE.stats()
+    stats["available"] = available()
+    stats["rdkit_version"] = rdkit_version()
+    return stats
+
@@ -1,127 +1,568 @@
 import logging
 import azure.functions as func
+import azurefunctions.extensions.bindings.blob as blob
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 import pandas as pd
 import io
 import os
-from azure.storage.blob import BlobServiceClient
 import joblib
 import json
-from sklearn.ensemble import RandomForestClassifier
+import time
+import uuid
+import numpy as np
+import preprocessing
+import scheduler
+import schema
+import storage
+import telemetry
+import descriptors
+import incremental
+import training
+import transform
+from content_hash import (cached_artifact, code_version, fingerprint, log_skip, stage_metadata,
+                          CONTENT_CACHE_ENABLED, HASH_METADATA_KEY)
+from compiled_forest import build_compiled, COMPILED_FILENAME
+from descriptors import extract_smiles, parity_warnings, vectorize_smiles, DESCRIPTOR_PARITY_ROWS
+from incremental import (checkpoint_transform, pin_transform, pinned_transform, train_incremental,
+                         TRAINING_CHUNK_ROWS, TRAINING_INCREMENTAL, TRAINING_TREES_PER_CHUNK)
+from scheduler import TRAINING_QUIET_SECONDS, TRAINING_SCHEDULE, TRAINING_SCHEDULER
+from prediction_cache import PredictionCache, model_key, row_keys
+from model_cache import ModelCache
+from preprocessing import (clean_frame, fit_sources, fit_transform, iter_processed, preprocess_chunked,
+                           processed_filename, read_processed, serialize_processed, CHUNKED_MIN_BYTES, CHUNK_ROWS,
+                           PROCESSED_FORMAT, PRUNE_ENABLED, PRUNE_CORRELATION_THRESHOLD, PRUNE_VARIANCE_THRESHOLD)
+from training import (select_model, report_to_json, REPORT_FILENAME, TRAINING_CANDIDATES, TRAINING_CV_FOLDS,
+                      TRAINING_METRIC, TRAINING_TIME_BUDGET_SECONDS)
+from schema import FeatureSchema, SchemaError, MANIFEST_FILENAME
+from transform import TRANSFORM_PREFIX
 
 app = func.FunctionApp()
 
-# CONFIGURAZIONE: Questa funzione scatta quando un file entra in "input-data"
-@app.blob_trigger(arg_name="myblob", path="input-data/{name}", connection="AzureWebJobsStorage")
-def data_preprocessing(myblob: func.InputStream):
-    logging.info(f"Python blob trigger function processed blob \n"
-                 f"Name: {myblob.name} \n"
-                 f"Blob Size: {myblob.length} bytes")
+# Span e metriche per fase (exporter scelto con TELEMETRY_EXPORTER, vedi telemetry.py)
+telemetry.configure()
 
+# --- CONFIGURAZIONE GLOBALE ---
+
+TARGET_COLUMN = "Label"   #colonna da predire
+
+# CONFIGURAZIONE: Questa funzione scatta quando un file entra in "input-data".
+# Il trigger riceve solo il riferimento al blob (binding di tipo SDK), non il
+# contenuto: i dati vengono letti dallo storage da questa funzione, una volta
+# sola per i file piccoli e in streaming per quelli grandi.
+@app.blob_trigger(arg_name="client", path="input-data/{name}", connection="AzureWebJobsStorage")
+def data_preprocessing(client: blob.BlobClient):
+    started = time.monotonic()
     try:
+        # Percorso del blob dentro 'input-data'
+        input_name = client.blob_name
+        input_filename = os.path.basename(input_name)
+        # Definiamo il nome del file di output (stesso nome dell'input,
+        # con estensione .npy se PROCESSED_FORMAT=npy)
+        output_filename = processed_filename(input_filename)
+        # Client dello storage condiviso tra le invocazioni (vedi storage.py)
+        input_blob = storage.get_blob_client("input-data", input_name)
+        output_blob = storage.get_blob_client("processed-data", output_filename)
+        properties = storage.blob_properties(input_blob)
+        logging.info(f"Python blob trigger function processed blob \n"
+                     f"Name: {input_name} \n"
+                     f"Blob Size: {properties.size} bytes")
+
         # --- STEP 1: LETTURA DATI --- 
-        # Leggiamo il contenuto del file caricato (CSV) in memoria
-        file_content = myblob.read()
-        
+        # File piccoli: leggiamo il contenuto del file caricato (CSV) in
+        # memoria, una volta sola; l'impronta è quella dei byte letti.
+        # File grandi: nessun download per l'impronta, che usa il Content-MD5
+        # del blob (o l'ETag se manca); i due passaggi del preprocessing a
+        # blocchi leggono in streaming sempre la stessa versione (ETag), così
+        # la memoria resta proporzionale a STORAGE_CHUNK_BYTES.
+        chunked = properties.size >= CHUNKED_MIN_BYTES
+        if chunked:
+            source = storage.blob_identity(properties).encode()
+        else:
+            with telemetry.phase("blob_download") as ph:
+                file_content, properties = storage.read_blob(input_blob)
+                ph.set("bytes", len(file_content))
+            source = file_content
+        # Versione dell'input elaborata: salvata nei metadati del file
+        # processato, il training completo rilegge esattamente questa
+        input_etag = properties.etag
+
+        # Con il training incrementale i nuovi dati vanno trasformati come
+        # quelli già nel modello o in coda: si riusa la trasformazione fissata
+        # dal primo file (vedi incremental.py)
+        frozen = checkpoint_transform() if TRAINING_INCREMENTAL else None
+
+        # Impronta dell'input + codice + configurazione: se il file processato
+        # esistente viene dallo stesso input non rifacciamo il lavoro
+        # (e non riattiviamo train_model riscrivendo 'processed-data').
+        content_hash = fingerprint(source, code_version(preprocessing, transform, descriptors),
+                                   {"format": PROCESSED_FORMAT, "target": TARGET_COLUMN,
+                                    "prune": [PRUNE_ENABLED, PRUNE_VARIANCE_THRESHOLD, PRUNE_CORRELATION_THRESHOLD],
+                                    "transform": frozen[0] if frozen else None,
+                                    "rdkit": descriptors.rdkit_version()})
+        if CONTENT_CACHE_ENABLED:
+            cached = cached_artifact(output_blob, content_hash)
+            if cached is not None:
+                log_skip("data_preprocessing", output_filename, cached)
+                if cached.get("source_etag") != input_etag:
+                    # Stesso contenuto ricaricato (nuovo ETag): il file
+                    # processato deve puntare alla versione attuale dell'input
+                    storage.set_metadata(output_blob, {**cached, "source_etag": input_etag})
+                return
+
+        # La trasformazione fittata va nel container 'models', con un nome
+        # legato all'impronta dell'input; train_model la associa al modello.
+        if frozen is not None:
+            logging.info(f"Training incrementale: riuso la trasformazione {frozen[0]}.")
+            transform_blob = storage.get_blob_client("models", frozen[0])
+        else:
+            transform_blob = storage.get_blob_client("models", f"{TRANSFORM_PREFIX}{content_hash[:32]}.npz")
+
+        # File grandi: elaborazione a blocchi di righe con upload a blocchi,
+        # la memoria dei DataFrame resta proporzionale a PREPROCESS_CHUNK_ROWS.
+        if chunked:
+            logging.info(f"File di grandi dimensioni: elaborazione a blocchi da {CHUNK_ROWS} righe.")
+            # Parità dei descrittori sulle prime righe del file
+            with storage.open_blob(input_blob, input_etag) as stream:
+                parity = descriptor_parity(pd.read_csv(stream, nrows=DESCRIPTOR_PARITY_ROWS))
+            with telemetry.phase("preprocess_chunked", bytes=properties.size) as ph:
+                total_rows, _ = preprocess_chunked(
+                    lambda: storage.open_blob(input_blob, input_etag), output_blob, target=TARGET_COLUMN,
+                    metadata_fn=lambda: stage_metadata(content_hash, time.monotonic() - started,
+                                                       {"source": input_name, "source_etag": input_etag,
+                                                        **parity}),
+                    transform_client=transform_blob, transform=frozen[1] if frozen else None
+                )
+                if TRAINING_INCREMENTAL and frozen is None:
+                    pin_transform(transform_blob.blob_name)
+                ph.set("rows", total_rows)
+            logging.info(f"File {output_filename} ({total_rows} righe) salvato correttamente in 'processed-data'")
+            return
+
         # Trasformiamo i byte in un DataFrame Pandas
         # Usiamo io.BytesIO perché pandas si aspetta un file-like object
-        df = pd.read_csv(io.BytesIO(file_content))
+        with telemetry.phase("parse", bytes=len(file_content)) as ph:
+            df = pd.read_csv(io.BytesIO(file_content))
+            ph.set("rows", len(df))
         logging.info(f"Dataset caricato. Dimensioni originali: {df.shape}")
 
+        # Descrittori del file confrontati con quelli calcolati da SMILES
+        # (prima che clean_frame tolga la colonna SMILES)
+        parity = descriptor_parity(df)
+
         # --- STEP 2: PREPROCESSING --- 
-        # Eseguiamo le operazioni richieste dal progetto:
-        
-        # 1. Rimozione valori nulli
-        df_clean = df.dropna()
-
-        # 2. Rimozione colonna SMILES
-        # La formula chimica testuale non serve al modello matematico, 
-        # usiamo solo i descrittori numerici già calcolati.
-        if "SMILES" in df_clean.columns:
-            df_clean = df_clean.drop(columns=["SMILES"])
-        
-        # 2. Codifica variabili categoriche 
-        # Trasforma colonne di testo in numeri (es. "Maschio/Femmina" -> 0/1)
-        # drop_first=True evita la collinearità
-        df_clean = pd.get_dummies(df_clean, drop_first=True)
+        # Rimozione SMILES e delle righe senza target (vedi preprocessing.clean_frame)
+        df_clean = clean_frame(df, target=TARGET_COLUMN)
+
+        # Riduzione dei descrittori quasi costanti o fortemente correlati e
+        # fit della trasformazione (imputazione dei mancanti, standardizzazione,
+        # codifica delle variabili categoriche). Training e manifest (quindi
+        # anche predict) useranno solo le colonne rimaste.
+        if frozen is not None:
+            fitted, pruning = frozen[1], None
+        else:
+            fitted, pruning = fit_transform(df_clean, target=TARGET_COLUMN)
+        df_clean = fitted.transform_frame(df_clean, target=TARGET_COLUMN)
+        extra_metadata = {"transform": transform_blob.blob_name, "source": input_name, "source_etag": input_etag,
+                          **parity}
+        if pruning is not None:
+            extra_metadata["pruning"] = json.dumps(pruning)
         
         logging.info(f"Dataset pulito. Dimensioni finali: {df_clean.shape}")
 
         # --- SALVATAGGIO SU STORAGE (processed-data) 
-        # Prepariamo il buffer per salvare il CSV
-        output_buffer = io.StringIO()
-        df_clean.to_csv(output_buffer, index=False)
+        # Serializziamo in CSV oppure nel formato binario .npy
+        output_data = serialize_processed(df_clean, target=TARGET_COLUMN)
         
-        # Recuperiamo la stringa di connessione dalle variabili d'ambiente
-        connect_str = os.getenv('AzureWebJobsStorage')
+        # Carichiamo prima la trasformazione e poi il file processato nel
+        # container "processed-data" (che fa partire il training)
+        with telemetry.phase("upload", bytes=len(output_data)):
+            if frozen is None:
+                storage.write_blob(transform_blob, fitted.to_bytes())
+                if TRAINING_INCREMENTAL:
+                    pin_transform(transform_blob.blob_name)
+            storage.write_blob(
+                output_blob,
+                output_data,
+                metadata=stage_metadata(content_hash, time.monotonic() - started,
+                                        {"dummy_columns": json.dumps(fitted.dummy_columns),
+                                         "format": PROCESSED_FORMAT, **extra_metadata})
+            )
         
-        # Creiamo il client per connetterci allo storage
-        blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-        
-        # Definiamo il nome del file di output (stesso nome dell'input)
-        input_filename = os.path.basename(myblob.name)
-        container_client = blob_service_client.get_container_client("processed-data")
-        
-        # Carichiamo il file processato nel container "processed-data"
-        container_client.upload_blob(name=input_filename, data=output_buffer.getvalue(), overwrite=True)
-        
-        logging.info(f"File {input_filename} salvato correttamente in 'processed-data'")
+        logging.info(f"File {output_filename} ({len(output_data)} bytes) salvato correttamente in 'processed-data'")
+        storage.log_stats()
 
     except Exception as e:
         logging.error(f"Errore durante l'elaborazione: {e}")
         raise e
     
 
-# --- CONFIGURAZIONE GLOBALE ---
+def descriptor_parity(df):
+    # Metadati del file processato con l'esito di descriptors.parity_check
+    with telemetry.phase("descriptor_parity") as ph:
+        parity = descriptors.parity_check(df)
+        if parity is None:
+            return {}
+        ph.set("mismatched", len(parity["mismatched"]))
+    if parity["mismatched"]:
+        logging.warning(f"{len(parity['mismatched'])} descrittori del file diversi da quelli calcolati con "
+                        f"RDKit {parity['rdkit_version']} su {parity['rows']} righe: {parity['mismatched'][:10]}")
+    return {"descriptors": json.dumps(parity)}
 
-TARGET_COLUMN = "Label"   #colonna da predire
 
 # --- STEP 3: TRAINING DEL MODELLO ---
-# Questa funzione parte automaticamente quando un file pulito arriva in 'processed-data'
-@app.blob_trigger(arg_name="myblob", path="processed-data/{name}", connection="AzureWebJobsStorage")
-def train_model(myblob: func.InputStream):
+# Questa funzione parte automaticamente quando un file pulito arriva in 'processed-data'.
+# Come data_preprocessing riceve solo il riferimento al blob: il file viene
+# letto dallo storage solo quando serve davvero per il training.
+# Con lo scheduler attivo (default) il file viene solo messo in coda: una
+# raffica di upload produce un solo training, avviato da scheduled_training.
+@app.blob_trigger(arg_name="client", path="processed-data/{name}", connection="AzureWebJobsStorage")
+def train_model(client: blob.BlobClient):
+    name = os.path.basename(client.blob_name)
+    if TRAINING_SCHEDULER:
+        scheduler.enqueue(name)
+        logging.info(f"File '{name}' in coda per il training (dopo {TRAINING_QUIET_SECONDS:.0f}s senza nuovi file).")
+        return
+
+    # Training immediato, comunque uno alla volta: se il lock è occupato
+    # l'eccezione fa ripetere il trigger più tardi
+    with scheduler.training_lock() as lease:
+        if lease is None:
+            raise RuntimeError("Training già in corso su un'altra istanza.")
+        train_processed([name])
+
+
+# Timer dello scheduler: addestra una volta sola con tutti i file in coda,
+# quando è trascorso il periodo di quiete (vedi scheduler.py)
+@app.timer_trigger(arg_name="timer", schedule=TRAINING_SCHEDULE, run_on_startup=False)
+def scheduled_training(timer: func.TimerRequest):
+    if TRAINING_SCHEDULER:
+        scheduler.run_pending(train_processed)
+
+
+def processed_metadata(name):
+    # Colonne dummy, riepilogo della riduzione dei descrittori e
+    # trasformazione, salvati da data_preprocessing nei metadati del blob
+    dummy_columns = None
+    pruning = None
+    transform_name = None
+    try:
+        processed_blob = storage.get_blob_client("processed-data", name)
+        metadata = storage.blob_properties(processed_blob).metadata or {}
+        if "dummy_columns" in metadata:
+            dummy_columns = json.loads(metadata["dummy_columns"])
+        if "pruning" in metadata:
+            pruning = json.loads(metadata["pruning"])
+        transform_name = metadata.get("transform")
+    except Exception as e:
+        logging.warning(f"Metadati del preprocessing non disponibili: {e}")
+    return dummy_columns, pruning, transform_name
+
+
+def training_parity(names):
+    # Parità dei descrittori di tutti i file di training (per il manifest)
+    reports = []
+    for name in names:
+        try:
+            metadata = storage.blob_properties(storage.get_blob_client("processed-data", name)).metadata or {}
+        except ResourceNotFoundError:
+            continue
+        if "descriptors" in metadata:
+            reports.append(json.loads(metadata["descriptors"]))
+    return descriptors.merge_parity(reports)
+
+
+def training_set():
+    # Tutti i file di 'processed-data' con le loro proprietà, in ordine di
+    # nome: il training completo usa sempre l'intero contenuto del
+    # container, quindi il modello dipende solo dai dati presenti e non
+    # dall'ordine o dai tempi degli upload
+    files = []
+    for name in storage.list_blobs("processed-data"):
+        try:
+            files.append((name, storage.blob_properties(storage.get_blob_client("processed-data", name))))
+        except ResourceNotFoundError:
+            continue
+    return files
+
+
+def training_set_hash(files, code, config):
+    # Impronta dell'insieme dai metadati (impronta del file processato o, se
+    # manca, il suo ETag): nessun download per decidere se ripetere il training
+    entries = [[name, (props.metadata or {}).get(HASH_METADATA_KEY) or props.etag] for name, props in files]
+    return fingerprint(json.dumps(entries).encode(), code, config)
+
+
+def transform_available(metadata):
+    # I file processati senza trasformazione (formato precedente) non ne hanno bisogno
+    name = metadata.get("transform")
+    if not name:
+        return True
+    try:
+        storage.blob_properties(storage.get_blob_client("models", name))
+        return True
+    except ResourceNotFoundError:
+        return False
+
+
+def fit_combined(sources, content_hash):
+    # Un solo dataset da più input originali ('input-data'), ognuno nella
+    # versione elaborata da data_preprocessing (ETag nei metadati), con una
+    # sola trasformazione fittata sull'insieme a blocchi (vedi
+    # preprocessing.fit_sources), caricata in 'models' come quelle del
+    # preprocessing. `sources`: lista di (input, ETag).
+    # Ritorna (DataFrame trasformato, colonne dummy, riduzione, nome della
+    # trasformazione) oppure None se un input è stato sovrascritto.
+    inputs = []
+    for source, etag in sources:
+        client = storage.get_blob_client("input-data", source)
+        try:
+            current = storage.blob_properties(client).etag
+        except ResourceNotFoundError:
+            logging.warning(f"Input '{source}' non più presente in 'input-data', escluso dal training.")
+            continue
+        if current != etag:
+            # Il nuovo preprocessing riscriverà il file processato e farà
+            # ripartire il training
+            logging.warning(f"Input '{source}' sovrascritto dopo il preprocessing: training rimandato.")
+            return None
+        inputs.append((client, etag))
+    if not inputs:
+        return None
+    try:
+        with telemetry.phase("fit_transform", files=len(inputs)) as ph:
+            df, fitted, pruning = fit_sources([lambda c=client, e=etag: storage.open_blob(c, e)
+                                               for client, etag in inputs], target=TARGET_COLUMN)
+            ph.set("rows", len(df))
+    except ResourceModifiedError as e:
+        logging.warning(f"Input sovrascritto durante la lettura: training rimandato ({e}).")
+        return None
+    transform_blob = storage.get_blob_client("models", f"{TRANSFORM_PREFIX}{content_hash[:32]}.npz")
+    storage.write_blob(transform_blob, fitted.to_bytes())
+    return df, fitted.dummy_columns, pruning, transform_blob.blob_name
+
+
+def published_transform(model_filename):
+    # Trasformazione del modello pubblicato, None se non c'è
+    try:
+        metadata = storage.blob_properties(storage.get_blob_client("models", model_filename)).metadata or {}
+    except ResourceNotFoundError:
+        return None
+    return metadata.get("transform")
+
+
+def remove_stale_transforms(keep):
+    # Le trasformazioni in 'models' non vengono mai sovrascritte: dopo una
+    # pubblicazione restano solo quelle in `keep` (modello nuovo, modello
+    # precedente che altre istanze possono ancora caricare, trasformazione
+    # fissata dal training incrementale). Un file processato la cui
+    # trasformazione è stata cancellata viene riaddestrato dall'input originale.
+    for name in storage.list_blobs("models", prefix=TRANSFORM_PREFIX):
+        if name in keep:
+            continue
+        try:
+            storage.delete_blob(storage.get_blob_client("models", name))
+        except ResourceNotFoundError:
+            pass
+
+
+def train_processed(names):
+    # Addestra e pubblica un solo modello a partire dai file di
+    # 'processed-data' `names` (in ordine di arrivo), letti dallo storage.
     logging.info(f"--- INIZIO TRAINING ---")
-    logging.info(f"File rilevato: {myblob.name}")
+    logging.info(f"File: {names}")
+    started = time.monotonic()
+
+    def load(name):
+        # Dati puliti dallo storage (CSV oppure .npy binario, riconosciuto
+        # dall'estensione del blob); None se il file non esiste più
+        try:
+            with telemetry.phase("blob_download", blob=name) as ph:
+                data = storage.read_blob(storage.get_blob_client("processed-data", name))[0]
+                ph.set("bytes", len(data))
+            return data
+        except ResourceNotFoundError:
+            logging.warning(f"File '{name}' non più presente in 'processed-data', ignorato.")
+            return None
 
     try:
-        # 1. Lettura del Dataset Processato
-        # Leggiamo i dati puliti dallo storage
-        file_content = myblob.read()
-        df = pd.read_csv(io.BytesIO(file_content))
-        
-        # Verifica di sicurezza: controlliamo se la colonna target esiste
-        if TARGET_COLUMN not in df.columns:
-            logging.error(f"ERRORE CRITICO: La colonna '{TARGET_COLUMN}' non esiste nel file! Controlla il CSV.")
-            return
+        # Client dello storage condiviso tra le invocazioni (vedi storage.py)
+        model_filename = "model.pkl"
+        code = code_version(training, schema, preprocessing, transform, incremental)
+        config = {
+            "target": TARGET_COLUMN, "metric": TRAINING_METRIC, "folds": TRAINING_CV_FOLDS,
+            "candidates": TRAINING_CANDIDATES, "budget": TRAINING_TIME_BUDGET_SECONDS,
+            "incremental": [TRAINING_INCREMENTAL, TRAINING_CHUNK_ROWS, TRAINING_TREES_PER_CHUNK],
+        }
 
-        # 2. Preparazione Dati (X e y)
-        # X: Tutte le colonne tranne il target (sono le caratteristiche chimiche)
-        X = df.drop(columns=[TARGET_COLUMN])
-        # y: Solo la colonna target (0 o 1)
-        y = df[TARGET_COLUMN]
-        
-        logging.info(f"Training su {len(df)} righe e {len(X.columns)} features.")
+        if TRAINING_INCREMENTAL:
+            # Training incrementale: ogni file viene letto a blocchi e ogni
+            # blocco aggiunge alberi alla forest del checkpoint (vedi
+            # incremental.py), quindi il costo dipende solo dai dati nuovi.
+            # L'impronta dei soli dati evita di addestrare due volte lo stesso file.
+            # I file vengono letti in streaming dallo storage, un blocco alla
+            # volta: la memoria dipende da TRAINING_CHUNK_ROWS, non dal file.
+            # Come identificativo dei dati basta l'impronta salvata da
+            # data_preprocessing (o l'ETag del blob se manca).
+            result = None
+            hashes = []
+            new_rows = new_chunks = 0
+            for name in names:
+                processed_blob = storage.get_blob_client("processed-data", name)
+                try:
+                    properties = storage.blob_properties(processed_blob)
+                except ResourceNotFoundError:
+                    logging.warning(f"File '{name}' non più presente in 'processed-data', ignorato.")
+                    continue
+                source = (properties.metadata or {}).get("content_hash") or properties.etag.strip('"')
+                hashes.append(fingerprint(source.encode(), code, config))
+                metadata = processed_metadata(name)
+                with telemetry.phase("fit", bytes=properties.size, mode="incremental") as ph, \
+                        storage.open_blob(processed_blob, properties.etag) as stream:
+                    trained = train_incremental(iter_processed(name, stream, TRAINING_CHUNK_ROWS),
+                                                source=source, transform_name=metadata[2],
+                                                target=TARGET_COLUMN)
+                    if trained is not None:
+                        result, X = trained
+                        dummy_columns, pruning, transform_name = metadata
+                        new_rows += result.report["rows"]["new"]
+                        new_chunks += result.report["chunks"]["new"]
+                        ph.set("rows", result.report["rows"]["new"])
+            if result is None:
+                return
+            result.report["rows"]["new"] = new_rows
+            result.report["chunks"]["new"] = new_chunks
+            result.report["files"] = names
+            content_hash = fingerprint(",".join(hashes).encode(), code)
+            X_train = X.to_numpy(dtype=np.float32)
+        else:
+            # Training completo, sempre su tutti i file di 'processed-data'
+            # (vedi training_set), non solo su quelli appena arrivati.
+            # Ogni file processato ha la propria trasformazione, quindi con
+            # più file non si possono concatenare: si riparte dagli input
+            # originali e si addestra una volta sola su tutti con una
+            # trasformazione fittata sull'insieme. Lo stesso vale per un solo
+            # file la cui trasformazione non esiste più.
+            files = training_set()
+            if not files:
+                logging.warning("Nessun file in 'processed-data' da addestrare.")
+                return
+            sources = [(props.metadata["source"], props.metadata["source_etag"]) for _, props in files
+                       if (props.metadata or {}).get("source") and props.metadata.get("source_etag")]
+            combined = len(files) > 1 or not transform_available(files[0][1].metadata or {})
+            if combined and len(sources) < len(files):
+                legacy = [name for name, props in files if not (props.metadata or {}).get("source_etag")]
+                if sources:
+                    logging.warning(f"File processati senza riferimento all'input originale, esclusi: {legacy}")
+                    files = [(name, props) for name, props in files if name not in legacy]
+                else:
+                    # Solo file processati prima che data_preprocessing
+                    # salvasse l'input originale: vale il più recente
+                    logging.warning(f"Input originali non disponibili, uso solo '{names[-1]}'.")
+                    files = [(name, props) for name, props in files if name == names[-1]]
+                    combined = False
+                    if not files:
+                        return
+            content_hash = training_set_hash(files, code, config)
+            logging.info(f"Training su {len(files)} file di 'processed-data': {[name for name, _ in files]}")
+
+            # Se il modello pubblicato è stato addestrato esattamente su questi
+            # dati, con lo stesso codice e la stessa configurazione, non serve
+            # ripetere il training.
+            if CONTENT_CACHE_ENABLED:
+                cached = cached_artifact(storage.get_blob_client("models", model_filename), content_hash)
+                if cached is not None:
+                    log_skip("train_model", model_filename, cached)
+                    return
+
+            if combined:
+                fitted_set = fit_combined(sources, content_hash)
+                if fitted_set is None:
+                    return
+                df, dummy_columns, pruning, transform_name = fitted_set
+            else:
+                name = files[0][0]
+                file_content = load(name)
+                if file_content is None:
+                    return
+                dummy_columns, pruning, transform_name = processed_metadata(name)
+                df = read_processed(name, file_content)
+
+            # Verifica di sicurezza: controlliamo se la colonna target esiste
+            if TARGET_COLUMN not in df.columns:
+                logging.error(f"ERRORE CRITICO: La colonna '{TARGET_COLUMN}' non esiste nel file! Controlla il CSV.")
+                return
+
+            # 2. Preparazione Dati (X e y)
+            # X: Tutte le colonne tranne il target (sono le caratteristiche chimiche)
+            X = df.drop(columns=[TARGET_COLUMN])
+            # y: Solo la colonna target (0 o 1)
+            y = df[TARGET_COLUMN]
+
+            logging.info(f"Training su {len(df)} righe e {len(X.columns)} features.")
 
-        # 3. Addestramento (Random Forest)
-        # Usiamo 100 alberi decisionali per una buona accuratezza
-        clf = RandomForestClassifier(n_estimators=100, random_state=42)
-        clf.fit(X, y)
-        logging.info("Modello addestrato con successo.")
+            # 3. Addestramento e selezione del modello
+            # Regressione logistica, decision tree, random forest e SVM vengono
+            # valutati in parallelo con cross-validation entro un budget di tempo;
+            # viene promosso solo il migliore secondo TRAINING_METRIC.
+            # Il modello lavora su una matrice float nell'ordine del manifest:
+            # in inferenza costruiamo esattamente la stessa matrice.
+            X_train = X.to_numpy(dtype=np.float32)
+            with telemetry.phase("fit", rows=X_train.shape[0], features=X_train.shape[1]):
+                result = select_model(X_train, y.to_numpy())
+            result.report["files"] = [name for name, _ in files]
+        clf = result.model
+        logging.info(f"Modello addestrato con successo: {result.name} {result.params} "
+                     f"({result.report['metric']}={result.score:.4f}).")
+
+        classes = [c.item() if hasattr(c, "item") else c for c in clf.classes_]
+        feature_schema = FeatureSchema.from_training_frame(X, target=TARGET_COLUMN, classes=classes,
+                                                           dummy_columns=dummy_columns)
+        feature_schema.descriptors = training_parity(result.report["files"])
+        result.report["descriptors"] = feature_schema.descriptors
+
+        # Per i modelli ad albero esportiamo anche la versione compilata
+        # (array NumPy piatti), verificata contro il modello scikit-learn
+        with telemetry.phase("compile"):
+            compiled_data, parity = build_compiled(clf, X_train)
+        result.report["compiled"] = parity
+        if pruning is not None:
+            result.report["pruning"] = pruning
+        result.report["transform"] = transform_name
+        if compiled_data is not None:
+            logging.info(f"Forest compilata: {len(compiled_data)} bytes, parità {parity}")
 
         # 4. Serializzazione e Salvataggio
         # Salviamo il modello in un buffer di memoria come file .pkl
-        model_filename = "model.pkl"
-        model_buffer = io.BytesIO()
-        joblib.dump(clf, model_buffer)
-        
-        # Connessione allo storage per salvare il file finale
-        connect_str = os.getenv('AzureWebJobsStorage')
-        blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+        with telemetry.phase("serialize_model") as ph:
+            model_buffer = io.BytesIO()
+            joblib.dump(clf, model_buffer)
+            ph.set("bytes", model_buffer.tell())
         
-        # Carichiamo il modello nel container 'models'
-        container_client = blob_service_client.get_container_client("models")
-        container_client.upload_blob(name=model_filename, data=model_buffer.getvalue(), overwrite=True)
+        # Carichiamo prima manifest e forest compilata e per ultimo il modello
+        # nel container 'models': quando predict vede un nuovo model.pkl gli
+        # altri artefatti sono già aggiornati. model_version lega la forest
+        # compilata al model.pkl da cui è stata generata; "transform" indica
+        # la trasformazione (blob immutabile) con cui sono stati preparati i dati.
+        model_version = uuid.uuid4().hex
+        previous_transform = published_transform(model_filename)
+        model_metadata = {"model_version": model_version}
+        feature_schema.model_version = model_version
+        if transform_name:
+            model_metadata["transform"] = transform_name
+        with telemetry.phase("upload", bytes=model_buffer.tell() + len(compiled_data or b"")):
+            storage.write_blob(storage.get_blob_client("models", REPORT_FILENAME), report_to_json(result.report))
+            storage.write_blob(storage.get_blob_client("models", MANIFEST_FILENAME), feature_schema.to_manifest())
+            if compiled_data is not None:
+                storage.write_blob(storage.get_blob_client("models", COMPILED_FILENAME), compiled_data,
+                                   metadata={"model_version": model_version})
+            storage.write_blob(storage.get_blob_client("models", model_filename), model_buffer.getvalue(),
+                               metadata=stage_metadata(content_hash, time.monotonic() - started, model_metadata))
+        # I risultati in cache in questo processo si riferiscono al modello precedente
+        PREDICTION_CACHE.invalidate()
+        remove_stale_transforms({transform_name, previous_transform, pinned_transform()})
+        storage.log_stats()
         
-        logging.info(f"SUCCESS: Modello salvato come '{model_filename}' nel container 'models'.")
+        logging.info(f"SUCCESS: Modello salvato come '{model_filename}' (+ {MANIFEST_FILENAME}) nel container 'models'.")
 
     except Exception as e:
         logging.error(f"ERRORE TRAINING: {e}")
@@ -129,9 +570,34 @@ def train_model(myblob: func.InputStream):
 
 
 # --- STEP 4: API (PREDIZIONE) ---
+# Cache del modello condivisa tra le invocazioni dello stesso worker
+MODEL_CACHE = ModelCache(container="models", blob_name="model.pkl", manifest_blob=MANIFEST_FILENAME,
+                         compiled_blob=COMPILED_FILENAME)
+
+# Cache dei risultati (classe e probabilità) per riga e versione del modello
+PREDICTION_CACHE = PredictionCache()
+
+# Numero massimo di righe accettate in una singola richiesta batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+
+def with_server_timing(handler, req: func.HttpRequest) -> func.HttpResponse:
+    # Esegue `handler` raccogliendo la durata di ogni fase e la restituisce
+    # al client nell'header Server-Timing (visibile anche nei DevTools del browser)
+    started = time.perf_counter()
+    with telemetry.server_timing() as timing:
+        response = handler(req)
+    timing.add("total", (time.perf_counter() - started) * 1000)
+    response.headers["Server-Timing"] = timing.header()
+    return response
+
+
 # Questa funzione espone un indirizzo HTTP per ricevere dati e dare risposte
 @app.route(route="predict", auth_level=func.AuthLevel.ANONYMOUS)
 def predict(req: func.HttpRequest) -> func.HttpResponse:
+    return with_server_timing(handle_predict, req)
+
+
+def handle_predict(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Richiesta di predizione ricevuta.')
 
     try:
@@ -141,32 +607,41 @@ def predict(req: func.HttpRequest) -> func.HttpResponse:
         except ValueError:
             return func.HttpResponse("Errore: Il corpo della richiesta deve essere un JSON valido.", status_code=400)
 
-        # Trasformiamo il JSON ricevuto in un DataFrame (come se fosse una riga di CSV)
-        # Assumiamo che il JSON contenga già i descrittori RDKit corretti
-        input_data = pd.DataFrame([req_body])
+        # 2. Recupero del Modello (dalla cache di processo)
+        # Il download da Azure Storage avviene solo al primo avvio o quando
+        # train_model pubblica un nuovo model.pkl (ETag diverso).
+        with telemetry.phase("model_fetch"):
+            cached = MODEL_CACHE.get()
 
-        # 2. Recupero del Modello dallo Storage
-        logging.info("Scaricamento del modello da Azure Storage...")
-        connect_str = os.getenv('AzureWebJobsStorage')
-        blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-        
-        # Puntiamo al file 'model.pkl' nel container 'models'
-        blob_client = blob_service_client.get_blob_client(container="models", blob="model.pkl")
-        
-        if not blob_client.exists():
+        if cached is None:
              return func.HttpResponse("Errore: Modello non ancora addestrato (file model.pkl mancante).", status_code=500)
 
-        # Scarichiamo il modello in memoria
-        downloader = blob_client.download_blob()
-        model_buffer = io.BytesIO(downloader.readall())
-        
-        # 3. Caricamento e Predizione
-        loaded_model = joblib.load(model_buffer)
-        
-        # Il modello potrebbe aver bisogno che le colonne siano nello stesso ordine del training.
-        
-        
-        prediction = loaded_model.predict(input_data)
+        if cached.schema is None:
+             return func.HttpResponse("Errore: manifest delle feature mancante per il modello corrente.", status_code=500)
+
+        # 3. Costruzione dell'input e Predizione
+        # Il JSON viene convertito direttamente in un array float nell'ordine
+        # delle colonne del training (dal manifest), senza DataFrame, e
+        # trasformato come i dati di training (imputazione, scaling, dummy).
+        # In alternativa il client può inviare solo lo SMILES della molecola
+        # ("CCO" oppure {"SMILES": "CCO"}): i descrittori li calcola il server.
+        warnings = []
+        try:
+            smiles = extract_smiles(req_body, cached.vectorizer.input_columns)
+            if smiles is not None:
+                if len(smiles) != 1:
+                    raise SchemaError("per più molecole usare /api/predict/batch")
+                warnings = parity_warnings(cached.schema, cached.vectorizer.input_columns)
+                input_data, _, errors = vectorize_smiles(smiles, cached.vectorizer)
+                if errors:
+                    raise SchemaError(errors[0])
+            else:
+                with telemetry.phase("vectorize", rows=1):
+                    input_data = cached.vectorizer.vectorize(req_body)
+        except SchemaError as e:
+            return func.HttpResponse(f"Errore: payload non valido ({e}).", status_code=400)
+
+        prediction = predict_rows(cached, input_data)[0]
         
         # Risultato: 0 o 1 (o la classe originale)
         result_value = prediction[0]
@@ -177,6 +652,8 @@ def predict(req: func.HttpRequest) -> func.HttpResponse:
             "status": "success",
             "message": "Analisi completata."
         }
+        if warnings:
+            response_payload["warnings"] = warnings
         
         return func.HttpResponse(
             json.dumps(response_payload),
@@ -189,4 +666,173 @@ def predict(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(
              f"Errore interno del server: {str(e)}",
              status_code=500
-        )
\ No newline at end of file
+        )
+
+
+def parse_batch_body(req: func.HttpRequest):
+    # Accetta tre formati:
+    #  - CSV grezzo (Content-Type: text/csv), stesso formato dei file di test
+    #  - JSON lista di record: [{"BalabanJ": 1.2, ...}, ...]
+    #  - JSON colonnare: {"BalabanJ": [1.2, ...], "BertzCT": [...], ...}
+    # In ognuno le feature possono essere sostituite dai soli SMILES
+    # (colonna SMILES, ["CCO", ...] oppure {"SMILES": ["CCO", ...]}).
+    content_type = (req.headers.get("Content-Type") or "").lower()
+    if "csv" in content_type:
+        return pd.read_csv(io.BytesIO(req.get_body()))
+
+    body = req.get_json()
+    if isinstance(body, list):
+        return body
+    if isinstance(body, dict):
+        if "records" in body:
+            return body["records"]
+        return pd.DataFrame(body)
+    raise ValueError("Formato non supportato: serve una lista di record, un oggetto colonnare o un CSV.")
+
+
+def predict_rows(cached, X) -> list:
+    # Ritorna (classe, probabilità o None) per ogni riga di X. Le righe già
+    # viste con lo stesso modello vengono servite da PREDICTION_CACHE; le
+    # altre vengono predette insieme con una sola chiamata al modello.
+    version = model_key(cached)
+    keys = row_keys(X) if PREDICTION_CACHE.enabled else [None] * len(X)
+    results = PREDICTION_CACHE.get_many(version, keys)
+    missing = [i for i, r in enumerate(results) if r is None]
+    with telemetry.phase("predict", rows=len(missing)) as ph:
+        ph.set("cache_hits", len(results) - len(missing))
+        if missing:
+            model = cached.model_for(len(missing))
+            ph.set("model", type(model).__name__)
+            X_missing = X[missing] if len(missing) < len(X) else X
+            predictions = model.predict(X_missing)
+            probabilities = model.predict_proba(X_missing) if hasattr(model, "predict_proba") else None
+            classes = [str(c) for c in getattr(model, "classes_", [])]
+            for j, i in enumerate(missing):
+                proba = dict(zip(classes, probabilities[j].tolist())) if probabilities is not None else None
+                results[i] = (str(predictions[j]), proba)
+            PREDICTION_CACHE.put_many(version, [(keys[i], results[i]) for i in missing])
+    return results
+
+
+def score_batch(cached, body) -> tuple:
+    # Validazione per riga: le righe con feature mancanti o non numeriche
+    # vengono segnalate singolarmente, le altre vengono predette insieme
+    # con una sola chiamata vettoriale al modello.
+    # Ritorna (risultati, avvisi sui descrittori calcolati da SMILES).
+    vectorizer = cached.vectorizer
+    smiles = extract_smiles(body, vectorizer.input_columns)
+    warnings = []
+    with telemetry.phase("vectorize", rows=len(body)):
+        if smiles is not None:
+            warnings = parity_warnings(cached.schema, vectorizer.input_columns)
+            X, valid, errors = vectorize_smiles(smiles, vectorizer)
+        elif isinstance(body, pd.DataFrame):
+            X, valid, errors = vectorizer.vectorize_frame(body)
+        else:
+            X, valid, errors = vectorizer.vectorize_many(body)
+
+    results = [None] * (len(valid) + len(errors))
+    if valid:
+        for pos, (prediction, probabilities) in zip(valid, predict_rows(cached, X)):
+            item = {"index": pos, "prediction": prediction}
+            if probabilities is not None:
+                item["probabilities"] = probabilities
+            results[pos] = item
+
+    for pos, message in errors.items():
+        results[pos] = {"index": pos, "error": message}
+
+    return results, warnings
+
+
+# Predizione massiva: una sola richiesta HTTP e una sola chiamata al modello
+# per tutte le righe. L'ordine dei risultati è quello dell'input.
+@app.route(route="predict/batch", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def predict_batch(req: func.HttpRequest) -> func.HttpResponse:
+    return with_server_timing(handle_predict_batch, req)
+
+
+def handle_predict_batch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Richiesta di predizione batch ricevuta.')
+
+    try:
+        try:
+            with telemetry.phase("parse", bytes=len(req.get_body() or b"")):
+                input_data = parse_batch_body(req)
+        except ValueError as e:
+            return func.HttpResponse(f"Errore: corpo della richiesta non valido ({e}).", status_code=400)
+
+        if len(input_data) == 0:
+            return func.HttpResponse("Errore: nessuna riga da analizzare.", status_code=400)
+        if len(input_data) > MAX_BATCH_SIZE:
+            return func.HttpResponse(
+                f"Errore: batch troppo grande ({len(input_data)} righe, massimo {MAX_BATCH_SIZE}).",
+                status_code=413
+            )
+
+        with telemetry.phase("model_fetch"):
+            cached = MODEL_CACHE.get()
+        if cached is None:
+             return func.HttpResponse("Errore: Modello non ancora addestrato (file model.pkl mancante).", status_code=500)
+        if cached.schema is None:
+             return func.HttpResponse("Errore: manifest delle feature mancante per il modello corrente.", status_code=500)
+
+        try:
+            results, warnings = score_batch(cached, input_data)
+        except SchemaError as e:
+            return func.HttpResponse(f"Errore: payload non valido ({e}).", status_code=400)
+        errors = sum(1 for r in results if "error" in r)
+        logging.info(f"Batch completato: {len(results)} righe, {errors} errori.")
+
+        # Con ?format=ndjson ogni risultato è una riga JSON, così il client
+        # può elaborarli man mano che li legge (gli avvisi vanno in un header).
+        if req.params.get("format") == "ndjson":
+            return func.HttpResponse(
+                "\n".join(json.dumps(r) for r in results) + "\n",
+                mimetype="application/x-ndjson",
+                status_code=200,
+                headers={"X-Descriptor-Warnings": json.dumps(warnings, ensure_ascii=True)} if warnings else None
+            )
+
+        response_payload = {
+            "status": "success",
+            "count": len(results),
+            "errors": errors,
+            "results": results
+        }
+        if warnings:
+            response_payload["warnings"] = warnings
+        return func.HttpResponse(
+            json.dumps(response_payload),
+            mimetype="application/json",
+            status_code=200
+        )
+
+    except Exception as e:
+        logging.error(f"ERRORE INFERENZA BATCH: {str(e)}")
+        return func.HttpResponse(
+             f"Errore interno del server: {str(e)}",
+             status_code=500
+        )
+
+# Statistiche della cache del modello (hit/miss, versione caricata)
+@app.route(route="model/stats", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def model_stats(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps(MODEL_CACHE.stats() | {
+            "descriptor_cache": descriptors.cache_stats(),
+            "prediction_cache": PREDICTION_CACHE.stats(),
+        }),
+        mimetype="application/json",
+        status_code=200
+    )
+
+
+# Metriche dello storage (chiamate, byte trasferiti, latenza per operazione)
+@app.route(route="storage/stats", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def storage_stats(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps(storage.storage_stats()),
+        mimetype="application/json",
+        status_code=200
+    )
@@ -0,0 +1,231 @@
+import io
+import logging
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import get_scorer
+
+import storage
+import telemetry
+from training import TRAINING_METRIC, TRAINING_N_JOBS, TrainingResult
+from transform import FittedTransform
+
+
+# --- TRAINING INCREMENTALE (out-of-core, con checkpoint) ---
+# Alternativa a select_model per dataset che non stanno in memoria o che
+# arrivano a lotti: i dati processati vengono letti a blocchi di
+# TRAINING_CHUNK_ROWS righe e per ogni blocco vengono aggiunti
+# TRAINING_TREES_PER_CHUNK alberi a una random forest (warm_start), addestrati
+# solo su quel blocco. Lo stato della forest viene salvato nel container
+# 'models' ogni TRAINING_CHECKPOINT_CHUNKS blocchi e alla fine di ogni file:
+# un'invocazione interrotta riprende dall'ultimo checkpoint e un nuovo file
+# in 'processed-data' aggiunge alberi al modello esistente invece di
+# ripartire da zero.
+# I blocchi nuovi devono essere trasformati come quelli già visti: la prima
+# trasformazione fittata viene fissata (TRANSFORM_POINTER) e da lì in poi
+# data_preprocessing riusa sempre quella, anche per i file ancora in coda
+# per il training.
+
+TRAINING_INCREMENTAL = os.getenv("TRAINING_INCREMENTAL", "0") != "0"
+TRAINING_CHUNK_ROWS = int(os.getenv("TRAINING_CHUNK_ROWS", "50000"))
+TRAINING_TREES_PER_CHUNK = int(os.getenv("TRAINING_TREES_PER_CHUNK", "25"))
+# Blocchi addestrati tra un checkpoint e il successivo: ogni salvataggio
+# riscrive tutta la forest, salvare a ogni blocco renderebbe l'I/O quadratico
+TRAINING_CHECKPOINT_CHUNKS = int(os.getenv("TRAINING_CHECKPOINT_CHUNKS", "10"))
+
+CHECKPOINT_FILENAME = "checkpoints/incremental_forest.pkl"
+# Blob vuoto con il nome della trasformazione fissata nei metadati
+TRANSFORM_POINTER = "checkpoints/transform"
+# Impronte dei file già addestrati ricordate nel checkpoint (evita di
+# aggiungere due volte gli stessi dati se il trigger viene ripetuto)
+CHECKPOINT_MAX_SOURCES = 50
+
+
+def checkpoint_client():
+    return storage.get_blob_client("models", CHECKPOINT_FILENAME)
+
+
+def load_checkpoint(client):
+    try:
+        with telemetry.phase("checkpoint_load") as ph:
+            data = storage.read_blob(client)[0]
+            ph.set("bytes", len(data))
+    except ResourceNotFoundError:
+        return None
+    return joblib.load(io.BytesIO(data))
+
+
+def save_checkpoint(client, state):
+    with telemetry.phase("checkpoint_save") as ph:
+        buffer = io.BytesIO()
+        joblib.dump(state, buffer)
+        ph.set("bytes", buffer.tell())
+        # Nei metadati quanto serve a data_preprocessing senza scaricare la forest
+        storage.write_blob(client, buffer.getvalue(), metadata={
+            "transform": state["transform"] or "",
+            "rows": str(state["rows"]),
+            "trees": str(len(state["model"].estimators_)),
+        })
+
+
+def pin_transform(name):
+    # Fissa la trasformazione del modello incrementale; se un altro
+    # preprocessing l'ha già fissata vale la sua
+    try:
+        storage.write_blob(storage.get_blob_client("models", TRANSFORM_POINTER), b"",
+                           metadata={"transform": name}, overwrite=False)
+    except ResourceExistsError:
+        pass
+
+
+def pinned_transform():
+    # Nome del blob della trasformazione fissata, None se non c'è
+    try:
+        metadata = storage.blob_properties(storage.get_blob_client("models", TRANSFORM_POINTER)).metadata or {}
+    except ResourceNotFoundError:
+        return None
+    return metadata.get("transform") or None
+
+
+def checkpoint_transform():
+    # Trasformazione fissata: (nome del blob, FittedTransform) oppure None se
+    # non è ancora stato processato nessun file
+    name = pinned_transform()
+    if not name:
+        return None
+    data = storage.read_blob(storage.get_blob_client("models", name))[0]
+    return name, FittedTransform.from_bytes(data)
+
+
+def new_state(transform_name):
+    return {
+        "model": None,
+        "transform": transform_name,
+        "features": None,
+        "rows": 0,
+        "chunks": 0,
+        "sources": [],
+        # File in corso e righe già addestrate (per riprendere dopo un'interruzione)
+        "source": None,
+        "source_rows": 0,
+    }
+
+
+def train_incremental(chunks, source, transform_name, target, trees_per_chunk=TRAINING_TREES_PER_CHUNK,
+                      metric=TRAINING_METRIC, n_jobs=TRAINING_N_JOBS, client=None,
+                      checkpoint_chunks=TRAINING_CHECKPOINT_CHUNKS):
+    # `chunks`: DataFrame processati (target incluso), vedi
+    # preprocessing.iter_processed; `source`: identificativo dei dati.
+    # Ritorna (TrainingResult, feature dell'ultimo blocco) oppure None se
+    # questi dati sono già nel modello.
+    started = time.monotonic()
+    client = client or checkpoint_client()
+    state = load_checkpoint(client)
+    if state is not None and state["transform"] != transform_name:
+        logging.warning(f"Checkpoint con trasformazione diversa ({state['transform']} != {transform_name}): "
+                        f"il training incrementale riparte da zero.")
+        state = None
+    if state is None:
+        state = new_state(transform_name)
+    elif source in state["sources"]:
+        logging.info(f"Dati {source[:12]} già presenti nel modello incrementale.")
+        return None
+
+    skip = state["source_rows"] if state["source"] == source else 0
+    if skip:
+        logging.info(f"Ripresa del training incrementale dopo {skip} righe già addestrate.")
+    state["source"] = source
+    state["source_rows"] = skip
+
+    scorer = get_scorer(metric)
+    model = state["model"]
+    scores = []
+    new_rows = new_chunks = consumed = 0
+    pending = []
+    last = None
+    for chunk in chunks:
+        if target not in chunk.columns:
+            raise ValueError(f"La colonna '{target}' non esiste nei dati processati.")
+        # Campione per manifest e verifica della forest compilata
+        last = chunk.drop(columns=[target])
+        if consumed + len(chunk) <= skip:
+            consumed += len(chunk)
+            continue
+        if consumed < skip:
+            chunk = chunk.iloc[skip - consumed:]
+        consumed += len(chunk)
+        pending.append(chunk)
+
+        # Un blocco deve contenere tutte le classi del modello (warm_start
+        # ricalcola classes_ a ogni fit): altrimenti lo si unisce al successivo
+        df = pd.concat(pending) if len(pending) > 1 else chunk
+        y = df[target].to_numpy()
+        labels = np.unique(y)
+        if model is None:
+            if len(labels) < 2:
+                continue
+        else:
+            unknown = np.setdiff1d(labels, model.classes_)
+            if len(unknown):
+                raise ValueError(f"Classi non presenti nel modello incrementale: {unknown.tolist()} "
+                                 f"(serve un training completo, TRAINING_INCREMENTAL=0).")
+            if len(labels) < len(model.classes_):
+                continue
+        pending = []
+
+        X = df.drop(columns=[target])
+        X_chunk = X.to_numpy(dtype=np.float32)
+        with telemetry.phase("fit_chunk", rows=len(df), features=X_chunk.shape[1]):
+            if model is None:
+                model = RandomForestClassifier(n_estimators=trees_per_chunk, warm_start=True, random_state=42)
+                state["features"] = list(X.columns)
+            else:
+                if list(X.columns) != state["features"]:
+                    raise ValueError("Le colonne dei dati processati non corrispondono al modello incrementale.")
+                # Valutazione prequenziale: il modello viene misurato su ogni
+                # blocco prima di addestrarsi anche su quello
+                scores.append(float(scorer(model, X_chunk, y)))
+                model.set_params(n_estimators=len(model.estimators_) + trees_per_chunk)
+            model.set_params(n_jobs=n_jobs)
+            model.fit(X_chunk, y)
+            # In inferenza predict lavora su poche righe: niente pool di thread
+            model.set_params(n_jobs=None)
+
+        state["model"] = model
+        state["rows"] += len(df)
+        state["chunks"] += 1
+        state["source_rows"] = consumed
+        new_rows += len(df)
+        new_chunks += 1
+        if new_chunks % checkpoint_chunks == 0:
+            save_checkpoint(client, state)
+        logging.info(f"Blocco {state['chunks']}: {len(df)} righe, {len(model.estimators_)} alberi totali.")
+
+    skipped = sum(len(df) for df in pending)
+    if skipped:
+        logging.warning(f"{skipped} righe finali scartate: non contengono tutte le classi del modello.")
+    if model is None or last is None:
+        raise ValueError("Nessun blocco con almeno due classi: impossibile addestrare il modello.")
+
+    state["sources"] = (state["sources"] + [source])[-CHECKPOINT_MAX_SOURCES:]
+    state["source"] = None
+    state["source_rows"] = 0
+    save_checkpoint(client, state)
+
+    score = float(np.mean(scores)) if scores else float("nan")
+    params = {"trees_per_chunk": trees_per_chunk, "n_estimators": len(model.estimators_)}
+    report = {
+        "metric": metric,
+        "mode": "incremental",
+        "elapsed_seconds": time.monotonic() - started,
+        "rows": {"new": new_rows, "resumed": skip, "skipped": skipped, "total": state["rows"]},
+        "chunks": {"new": new_chunks, "total": state["chunks"]},
+        "prequential_scores": scores,
+        "best": {"name": "random_forest_incremental", "params": params, "score": score},
+    }
+    return TrainingResult(model, "random_forest_incremental", params, score, report), last
@@ -0,0 +1,292 @@
+import io
+import logging
+import os
+import threading
+import time
+
+import joblib
+from azure.core.exceptions import ResourceNotFoundError
+
+import storage
+import telemetry
+from compiled_forest import COMPILED_MAX_BATCH_ROWS, CompiledForest
+from schema import FeatureSchema
+from transform import FittedTransform
+
+
+# --- CACHE DEL MODELLO (condivisa da tutto il processo worker) ---
+# Il modello viene scaricato e deserializzato una sola volta; le chiamate
+# successive fanno solo un controllo leggero dell'ETag sul blob, al massimo
+# ogni MODEL_REVALIDATE_SECONDS secondi.
+# Se train_model ha pubblicato anche la forest compilata per la stessa
+# versione del modello, viene usata quella al posto del pickle scikit-learn.
+# La trasformazione fittata nel preprocessing (indicata nei metadati di
+# model.pkl) viene caricata insieme al modello e applicata a ogni richiesta.
+# Con la forest compilata, le chiamate con più di COMPILED_MAX_BATCH_ROWS
+# righe usano il pickle della stessa versione, scaricato solo alla prima
+# chiamata di questo tipo.
+
+MODEL_REVALIDATE_SECONDS = float(os.getenv("MODEL_REVALIDATE_SECONDS", "30"))
+
+
+class CachedModel:
+    # Fotografia immutabile del modello in memoria: viene sostituita in blocco
+    # quando arriva una nuova versione, quindi chi la sta usando non vede mai
+    # uno stato a metà.
+    def __init__(self, model, schema, etag, last_modified, loaded_at, version=None, transform=None,
+                 batch_loader=None):
+        self.model = model
+        self.schema = schema
+        self.transform = transform
+        self.version = version
+        self.etag = etag
+        self.last_modified = last_modified
+        self.loaded_at = loaded_at
+        self._batch_loader = batch_loader
+        self._batch_model = None
+        self._batch_lock = threading.Lock()
+
+    def model_for(self, n_rows):
+        # Modello da usare per una chiamata su n_rows righe
+        if self._batch_loader is None or n_rows <= COMPILED_MAX_BATCH_ROWS:
+            return self.model
+        with self._batch_lock:
+            if self._batch_model is None and self._batch_loader is not None:
+                try:
+                    self._batch_model = self._batch_loader()
+                except Exception as e:
+                    # Si continua con la forest compilata, più lenta ma corretta
+                    logging.warning(f"Modello scikit-learn per i batch non caricabile, uso la forest compilata: {e}")
+                    self._batch_loader = None
+                    return self.model
+        return self._batch_model
+
+    @property
+    def batch_model_loaded(self):
+        return self._batch_model is not None
+
+    @property
+    def vectorizer(self):
+        # Converte i record JSON/CSV nella matrice del modello: la
+        # trasformazione se il modello ne ha una, altrimenti il solo manifest
+        return self.transform if self.transform is not None else self.schema
+
+
+class ModelCache:
+    def __init__(self, container, blob_name, manifest_blob=None, compiled_blob=None, loader=None,
+                 revalidate_seconds=MODEL_REVALIDATE_SECONDS):
+        self.container = container
+        self.blob_name = blob_name
+        self.manifest_blob = manifest_blob
+        self.compiled_blob = compiled_blob
+        self.revalidate_seconds = revalidate_seconds
+        self._loader = loader or (lambda data: joblib.load(io.BytesIO(data)))
+        self._entry = None
+        self._checked_at = 0.0
+        self._client = None
+        self._manifest_client = None
+        self._compiled_client = None
+        # Un solo thread alla volta controlla/ricarica il modello (single-flight)
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.reloads = 0
+        self.load_errors = 0
+
+    def _blob_client(self):
+        if self._client is None:
+            # Client condiviso da tutto il processo (vedi storage.py)
+            self._client = storage.get_blob_client(self.container, self.blob_name)
+            if self.manifest_blob:
+                self._manifest_client = storage.get_blob_client(self.container, self.manifest_blob)
+            if self.compiled_blob:
+                self._compiled_client = storage.get_blob_client(self.container, self.compiled_blob)
+        return self._client
+
+    def _load_schema(self):
+        # train_model carica il manifest prima di model.pkl: durante una
+        # pubblicazione si può leggere il manifest nuovo con il modello
+        # vecchio, per questo _load confronta i model_version.
+        if self._manifest_client is not None:
+            try:
+                return FeatureSchema.from_manifest(storage.read_blob(self._manifest_client)[0])
+            except ResourceNotFoundError:
+                logging.warning(f"Manifest '{self.manifest_blob}' non trovato, uso le feature del modello.")
+        return None
+
+    def _load_compiled(self, version, schema):
+        # La forest compilata è valida solo se è stata pubblicata insieme a
+        # questa versione di model.pkl (stesso model_version nei metadati).
+        if self._compiled_client is None or not version or schema is None or not schema.classes:
+            return None
+        try:
+            with telemetry.phase("model_download", blob=self.compiled_blob) as ph:
+                data, properties = storage.read_blob(self._compiled_client)
+                ph.set("bytes", len(data))
+        except ResourceNotFoundError:
+            return None
+        if (properties.metadata or {}).get("model_version") != version:
+            return None
+        with telemetry.phase("model_load", kind="compiled"):
+            return CompiledForest.load(data, schema.classes, version=version)
+
+    def _load_transform(self, name, schema):
+        # Il blob della trasformazione non viene mai sovrascritto (il nome
+        # contiene l'impronta dei dati). Se manca non si può servire il
+        # modello: riceverebbe feature non trasformate.
+        if not name:
+            return None
+        with telemetry.phase("model_download", blob=name) as ph:
+            data = storage.read_blob(storage.get_blob_client(self.container, name))[0]
+            ph.set("bytes", len(data))
+        transform = FittedTransform.from_bytes(data)
+        if schema is not None and transform.features != schema.features:
+            raise ValueError(f"La trasformazione '{name}' non corrisponde alle feature del modello.")
+        return transform
+
+    def _load_pickle(self, blob_client, version):
+        # Pickle di model.pkl per i batch grandi: deve essere della stessa
+        # versione della forest compilata in uso
+        with telemetry.phase("model_download", blob=self.blob_name) as ph:
+            data, properties = storage.read_blob(blob_client)
+            ph.set("bytes", len(data))
+        if (properties.metadata or {}).get("model_version") != version:
+            raise ValueError(f"'{self.blob_name}' non è più della versione {version}.")
+        with telemetry.phase("model_load", kind="pickle"):
+            return self._loader(data)
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self):
+        # Ritorna il CachedModel corrente oppure None se il modello non esiste.
+        entry = self._entry
+        if entry is not None and time.monotonic() - self._checked_at < self.revalidate_seconds:
+            self._count("hits")
+            return entry
+
+        if entry is not None:
+            # Se un altro thread sta già verificando, serviamo la versione in
+            # memoria invece di metterci in coda.
+            if not self._lock.acquire(blocking=False):
+                self._count("hits")
+                return entry
+        else:
+            # Cold start: tutti aspettano il primo caricamento
+            self._lock.acquire()
+
+        try:
+            return self._refresh()
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        entry = self._entry
+        if entry is not None and time.monotonic() - self._checked_at < self.revalidate_seconds:
+            # Un altro thread ha appena aggiornato la cache
+            self._count("hits")
+            return entry
+
+        blob_client = self._blob_client()
+        if entry is not None:
+            self._count("revalidations")
+            try:
+                props = storage.blob_properties(blob_client)
+            except ResourceNotFoundError:
+                logging.warning(f"Il blob '{self.blob_name}' non esiste più, uso la versione in memoria.")
+                self._checked_at = time.monotonic()
+                self._count("hits")
+                return entry
+            if props.etag == entry.etag:
+                self._checked_at = time.monotonic()
+                self._count("hits")
+                return entry
+
+        self._count("misses")
+        if entry is None:
+            return self._load(blob_client)
+        try:
+            return self._load(blob_client) or entry
+        except Exception as e:
+            # Nuova versione non caricabile (blob mancanti, pickle corrotto...):
+            # continuiamo a servire quella in memoria e riproviamo solo alla
+            # prossima rivalidazione, invece di riscaricare a ogni richiesta
+            logging.error(f"Caricamento della nuova versione di '{self.blob_name}' non riuscito, "
+                          f"uso quella in memoria (ETag {entry.etag}): {e}")
+            self._checked_at = time.monotonic()
+            self._count("load_errors")
+            return entry
+
+    def _load(self, blob_client):
+        started = time.perf_counter()
+        try:
+            props = storage.blob_properties(blob_client)
+        except ResourceNotFoundError:
+            return None
+        version = (props.metadata or {}).get("model_version")
+        etag = props.etag
+
+        schema = self._load_schema()
+        model = self._load_compiled(version, schema)
+        if model is None:
+            try:
+                with telemetry.phase("model_download", blob=self.blob_name) as ph:
+                    data, properties = storage.read_blob(blob_client)
+                    ph.set("bytes", len(data))
+            except ResourceNotFoundError:
+                return None
+            with telemetry.phase("model_load", kind="pickle"):
+                model = self._loader(data)
+            # ETag e metadati vengono dalla stessa risposta del download, così
+            # corrispondono esattamente ai byte deserializzati.
+            props = properties
+            etag = properties.etag
+            version = (properties.metadata or {}).get("model_version")
+            if schema is None:
+                schema = FeatureSchema.from_model(model)
+        if schema is not None and schema.model_version and schema.model_version != version:
+            # Pubblicazione in corso (o non completata): manifest e modello
+            # sono di versioni diverse, non si possono servire insieme
+            raise ValueError(f"Manifest '{self.manifest_blob}' della versione {schema.model_version}, "
+                             f"modello '{self.blob_name}' della versione {version}.")
+        transform = self._load_transform((props.metadata or {}).get("transform"), schema)
+
+        new_entry = CachedModel(
+            model=model,
+            schema=schema,
+            etag=etag,
+            last_modified=props.last_modified,
+            loaded_at=time.time(),
+            version=version,
+            transform=transform,
+            batch_loader=(lambda: self._load_pickle(blob_client, version))
+            if isinstance(model, CompiledForest) else None,
+        )
+        self._entry = new_entry
+        self._checked_at = time.monotonic()
+        self._count("reloads")
+        logging.info(f"Modello '{self.blob_name}' ({type(model).__name__}) caricato in cache (ETag {new_entry.etag}) "
+                     f"in {(time.perf_counter() - started) * 1000:.1f} ms.")
+        return new_entry
+
+    def stats(self):
+        entry = self._entry
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "revalidations": self.revalidations,
+                "reloads": self.reloads,
+                "load_errors": self.load_errors,
+                "etag": entry.etag if entry else None,
+                "version": entry.version if entry else None,
+                "model_type": type(entry.model).__name__ if entry else None,
+                "batch_model_loaded": entry.batch_model_loaded if entry else None,
+                "transform": entry.transform is not None if entry else None,
+                "last_modified": entry.last_modified.isoformat() if entry and entry.last_modified else None,
+            }
@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# --- CLIENT DELL'API DI PREDIZIONE ---
+# (copiato anche in dashboard/, che viene pubblicata da sola come App Service)
+# Sessione HTTP keep-alive condivisa, richieste concorrenti limitate e
+# retry con backoff esponenziale su 429/5xx. I risultati tornano sempre
+# nell'ordine dei record in input.
+
+# Colonne del CSV che non vanno inviate all'API
+NON_FEATURE_COLUMNS = ["Label", "SMILES", "Unnamed: 0"]
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def records_from_frame(df):
+    # Conversione vettoriale del DataFrame in lista di payload JSON
+    return df.drop(columns=[c for c in NON_FEATURE_COLUMNS if c in df.columns]).to_dict("records")
+
+
+class PredictClient:
+    def __init__(self, api_url, max_workers=8, batch_size=25, retries=4, backoff=0.5, timeout=60):
+        # batch_size > 0: i record vengono inviati a gruppi all'endpoint
+        # /predict/batch; batch_size = 0: una richiesta /predict per record
+        self.api_url = api_url.rstrip("/")
+        self.batch_url = f"{self.api_url}/batch"
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=None,        # anche POST: la predizione è idempotente
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def predict_one(self, record):
+        # Risposta JSON di /predict (solleva eccezione su errori HTTP)
+        response = self.session.post(self.api_url, json=record, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _send_single(self, record):
+        try:
+            return [{"prediction": self.predict_one(record).get("prediction")}]
+        except requests.RequestException as e:
+            return [{"error": _error_text(e)}]
+
+    def _send_batch(self, records):
+        try:
+            response = self.session.post(self.batch_url, json=records, timeout=self.timeout)
+            response.raise_for_status()
+            results = response.json()["results"]
+        except requests.RequestException as e:
+            return [{"error": _error_text(e)} for _ in records]
+        return [{k: v for k, v in r.items() if k != "index"} for r in results]
+
+    def predict_many(self, records, on_progress=None):
+        # Invia tutti i record con al massimo `max_workers` richieste in volo.
+        # on_progress(completati, totale) viene chiamata a ogni risposta.
+        total = len(records)
+        results = [None] * total
+        size = self.batch_size or 1
+        groups = [(start, records[start:start + size]) for start in range(0, total, size)]
+        done = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._send_batch if self.batch_size else self._send_single,
+                                group if self.batch_size else group[0]): start
+                for start, group in groups
+            }
+            for future in as_completed(futures):
+                start = futures[future]
+                chunk = future.result()
+                results[start:start + len(chunk)] = chunk
+                done += len(chunk)
+                if on_progress is not None:
+                    on_progress(done, total)
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+def _error_text(error):
+    response = getattr(error, "response", None)
+    if response is not None:
+        return f"HTTP {response.status_code}: {response.text[:200]}"
+    return str(error)
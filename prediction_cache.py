@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# --- CACHE DEI RISULTATI DI PREDIZIONE ---
+# Dashboard e batch ripetuti sullo stesso CSV inviano spesso gli stessi
+# vettori di descrittori. Il risultato (classe e probabilità) viene tenuto in
+# una LRU con scadenza, indicizzata dall'hash della riga già trasformata
+# (ordine delle colonne del training, imputazione, scaling) e dalla versione
+# del modello: quando cambia il modello le voci precedenti vengono scartate.
+
+# Numero massimo di risultati in cache (0 = cache disattivata)
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "10000"))
+# Durata di una voce in secondi (0 = nessuna scadenza)
+PREDICTION_CACHE_TTL_SECONDS = float(os.getenv("PREDICTION_CACHE_TTL_SECONDS", "3600"))
+
+
+def model_key(cached):
+    # Identifica la versione del modello servita: l'ETag di model.pkl cambia
+    # a ogni pubblicazione, model_version distingue anche la forest compilata
+    return f"{cached.etag}:{cached.version}"
+
+
+def row_keys(X):
+    # Hash di ogni riga della matrice del modello. "+ 0.0" rende -0.0 uguale
+    # a 0.0, così righe numericamente identiche hanno la stessa chiave.
+    X = np.ascontiguousarray(X, dtype=np.float64) + 0.0
+    return [hashlib.blake2b(row.tobytes(), digest_size=16).digest() for row in X]
+
+
+class PredictionCache:
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, ttl_seconds=PREDICTION_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # chiave della riga -> (scadenza, classe, probabilità o None)
+        self._entries = OrderedDict()
+        self._model_key = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _check_model(self, key):
+        # Chiamata con il lock: un modello diverso invalida tutte le voci
+        if key != self._model_key:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._model_key = key
+
+    def invalidate(self):
+        # Da chiamare quando il processo stesso pubblica un nuovo modello;
+        # negli altri worker basta il cambio di ETag visto da ModelCache
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._model_key = None
+
+    def get_many(self, model, keys):
+        # Ritorna un risultato (classe, probabilità) o None per ogni chiave
+        results = [None] * len(keys)
+        if not self.enabled:
+            return results
+        now = time.monotonic()
+        with self._lock:
+            self._check_model(model)
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                if self.ttl_seconds and entry[0] < now:
+                    del self._entries[key]
+                    self.expired += 1
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                results[i] = entry[1:]
+        return results
+
+    def put_many(self, model, items):
+        # items: coppie (chiave, (classe, probabilità))
+        if not self.enabled:
+            return
+        expires = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._check_model(model)
+            for key, (prediction, probabilities) in items:
+                self._entries[key] = (expires, prediction, probabilities)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
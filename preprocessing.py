@@ -0,0 +1,388 @@
+import base64
+import io
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from azure.storage.blob import BlobBlock
+
+import storage
+import telemetry
+from transform import ColumnStats, FittedTransform
+
+
+# --- PREPROCESSING (logica condivisa tra modalità in memoria e a blocchi) ---
+
+# Sopra questa dimensione il file viene elaborato a blocchi di righe,
+# così la memoria usata dipende dal blocco e non dall'intero file.
+CHUNKED_MIN_BYTES = int(os.getenv("PREPROCESS_CHUNKED_MIN_BYTES", str(256 * 1024 * 1024)))
+CHUNK_ROWS = int(os.getenv("PREPROCESS_CHUNK_ROWS", "50000"))
+# Dimensione minima di ogni blocco caricato con stage_block
+UPLOAD_BLOCK_BYTES = int(os.getenv("PREPROCESS_UPLOAD_BLOCK_BYTES", str(8 * 1024 * 1024)))
+
+# Formato dei file in 'processed-data': "csv" (testo) oppure "npy"
+# (array strutturato NumPy binario: descrittori float32, dummy uint8)
+PROCESSED_FORMAT = os.getenv("PROCESSED_FORMAT", "csv").lower()
+# Cifre significative dei float nel CSV: i descrittori standardizzati non
+# hanno più poche cifre come quelli grezzi, e il training lavora comunque
+# in float32 (9 cifre bastano a ricostruirlo esattamente)
+CSV_FLOAT_FORMAT = "%.9g"
+
+DROP_COLUMNS = ["SMILES"]
+
+# Riduzione dei descrittori prima del training: vengono scartate le colonne
+# quasi costanti (varianza <= PREPROCESS_PRUNE_VARIANCE) e quelle con
+# correlazione assoluta > PREPROCESS_PRUNE_CORRELATION con una colonna
+# precedente (famiglie Chi*n/Chi*v, EState_VSA*, fr_*). Le colonne dummy e
+# il target non vengono mai scartati.
+PRUNE_ENABLED = os.getenv("PREPROCESS_PRUNE", "1") != "0"
+PRUNE_VARIANCE_THRESHOLD = float(os.getenv("PREPROCESS_PRUNE_VARIANCE", "1e-4"))
+PRUNE_CORRELATION_THRESHOLD = float(os.getenv("PREPROCESS_PRUNE_CORRELATION", "0.95"))
+
+
+def clean_frame(df, target=None):
+    # 1. Rimozione colonna SMILES
+    # La formula chimica testuale non serve al modello matematico,
+    # usiamo solo i descrittori numerici già calcolati.
+    df_clean = df.drop(columns=[c for c in DROP_COLUMNS if c in df.columns])
+
+    # 2. Rimozione delle righe senza target (inutilizzabili per il training).
+    # I valori mancanti nelle feature non fanno più scartare la riga: li
+    # imputa la trasformazione fittata (vedi transform.py), che in predict
+    # fa lo stesso sui record in arrivo.
+    if target is not None and target in df_clean.columns:
+        with telemetry.phase("dropna", rows=len(df_clean)) as ph:
+            df_clean = df_clean.dropna(subset=[target])
+            ph.set("rows_dropped", len(df) - len(df_clean))
+    return df_clean
+
+
+def categorical_columns(df, target=None):
+    # Colonne di testo da codificare come dummy (es. "Maschio/Femmina" -> 0/1)
+    return [c for c in df.select_dtypes(include=["object", "string", "category"]).columns if c != target]
+
+
+class FeatureMoments:
+    # Momenti del primo e secondo ordine delle colonne numeriche, accumulabili
+    # blocco per blocco: varianze e matrice di correlazione escono da un solo
+    # prodotto matriciale per blocco, senza tenere i dati in memoria.
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.n = 0
+        self.shift = None
+        self.sum = np.zeros(len(self.columns))
+        self.cross = np.zeros((len(self.columns), len(self.columns)))
+
+    def update(self, df):
+        if not self.columns or len(df) == 0:
+            return
+        X = df[self.columns].to_numpy(dtype=np.float64)
+        if self.shift is None:
+            # Traslazione sulla media del primo blocco per stabilità numerica
+            self.shift = X.mean(axis=0)
+        X = X - self.shift
+        self.n += len(X)
+        self.sum += X.sum(axis=0)
+        self.cross += X.T @ X
+
+    def select(self, variance_threshold=PRUNE_VARIANCE_THRESHOLD,
+               correlation_threshold=PRUNE_CORRELATION_THRESHOLD):
+        # Ritorna (colonne tenute, scartate per varianza, scartate per correlazione)
+        if self.n == 0:
+            return list(self.columns), [], []
+        mean = self.sum / self.n
+        cov = self.cross / self.n - np.outer(mean, mean)
+        variance = np.diag(cov)
+        low_variance = variance <= variance_threshold
+
+        idx = np.flatnonzero(~low_variance)
+        std = np.sqrt(variance[idx])
+        corr = np.abs(cov[np.ix_(idx, idx)] / np.outer(std, std))
+        # Selezione greedy nell'ordine delle colonne: una colonna viene
+        # scartata solo se è correlata con una colonna già tenuta
+        correlated = np.zeros(len(self.columns), dtype=bool)
+        kept_idx = []
+        for j in range(len(idx)):
+            if kept_idx and (corr[kept_idx, j] > correlation_threshold).any():
+                correlated[idx[j]] = True
+            else:
+                kept_idx.append(j)
+
+        names = np.array(self.columns, dtype=object)
+        kept = names[~low_variance & ~correlated].tolist()
+        return kept, names[low_variance].tolist(), names[correlated].tolist()
+
+
+def prunable_columns(df, target):
+    # Solo i descrittori numerici: niente target, dummy (bool) o testo
+    return [c for c in df.select_dtypes(include="number").columns if c != target]
+
+
+def pruning_summary(df, kept, low_variance, correlated):
+    # Quanto pesa il JSON di un record inviato a predict prima e dopo la
+    # riduzione (sulla prima riga del frame)
+    features = [c for c in df.columns if c not in low_variance and c not in correlated]
+    record = df.iloc[:1].to_dict("records")[0] if len(df) else {}
+    before = len(json.dumps(record, default=str))
+    after = len(json.dumps({k: v for k, v in record.items() if k in features}, default=str))
+    return {
+        "kept": kept,
+        "dropped_low_variance": low_variance,
+        "dropped_correlated": correlated,
+        "features_before": len(df.columns),
+        "features_after": len(features),
+        "record_bytes_before": before,
+        "record_bytes_after": after,
+    }
+
+
+def fit_transform(df, target, prune=PRUNE_ENABLED, variance_threshold=PRUNE_VARIANCE_THRESHOLD,
+                  correlation_threshold=PRUNE_CORRELATION_THRESHOLD):
+    # Fitta la trasformazione (imputazione, scaling, vocabolari) su un frame
+    # pulito con clean_frame, dopo l'eventuale riduzione dei descrittori.
+    # Ritorna (FittedTransform, riepilogo della riduzione oppure None).
+    with telemetry.phase("fit_transform", rows=len(df)):
+        numeric = prunable_columns(df, target)
+        stats = ColumnStats(numeric, categorical_columns(df, target))
+        stats.update(df)
+        moments = FeatureMoments(numeric)
+        moments.update(df[numeric].dropna())
+    return fit_from_statistics(stats, moments, df.drop(columns=[target], errors="ignore"), prune,
+                               variance_threshold, correlation_threshold)
+
+
+def fit_from_statistics(stats, moments, sample, prune=PRUNE_ENABLED, variance_threshold=PRUNE_VARIANCE_THRESHOLD,
+                        correlation_threshold=PRUNE_CORRELATION_THRESHOLD):
+    # La riduzione va decisa sulla scala originale, prima della
+    # standardizzazione (che porterebbe tutte le varianze a 1)
+    if not prune:
+        return FittedTransform.fit(stats), None
+    with telemetry.phase("prune") as ph:
+        kept, low_variance, correlated = moments.select(variance_threshold, correlation_threshold)
+        ph.set("features_dropped", len(low_variance) + len(correlated))
+    summary = pruning_summary(sample, kept, low_variance, correlated)
+    logging.info(f"Riduzione descrittori: {summary['features_before']} -> {summary['features_after']} feature "
+                 f"({len(low_variance)} quasi costanti, {len(correlated)} correlate), "
+                 f"record JSON {summary['record_bytes_before']} -> {summary['record_bytes_after']} bytes")
+    return FittedTransform.fit(stats, kept), summary
+
+
+def processed_filename(input_filename, fmt=PROCESSED_FORMAT):
+    # Il formato è riconoscibile dall'estensione del blob in 'processed-data'
+    if fmt == "npy":
+        return os.path.splitext(input_filename)[0] + ".npy"
+    return input_filename
+
+
+def structured_dtype(df, target, int_dtype=None):
+    # Descrittori float -> float32, colonne dummy (bool) -> uint8, descrittori
+    # interi (conteggi fr_*, Num*) -> il tipo intero più piccolo che li contiene
+    # (oppure `int_dtype` quando il range non è noto in anticipo, come nella
+    # modalità a blocchi). La colonna target mantiene il suo tipo.
+    fields = []
+    for col, dtype in df.dtypes.items():
+        if col == target:
+            fields.append((col, dtype.newbyteorder("<") if dtype.kind in "iuf" else np.int64))
+        elif dtype == bool:
+            fields.append((col, np.uint8))
+        elif dtype.kind in "iu":
+            if int_dtype is not None:
+                fields.append((col, int_dtype))
+            elif len(df):
+                values = df[col].to_numpy()
+                fields.append((col, np.result_type(np.min_scalar_type(values.min()),
+                                                   np.min_scalar_type(values.max()))))
+            else:
+                fields.append((col, np.int32))
+        else:
+            fields.append((col, np.float32))
+    return np.dtype(fields)
+
+
+def to_structured(df, dtype):
+    out = np.empty(len(df), dtype=dtype)
+    for col in dtype.names:
+        out[col] = df[col].to_numpy()
+    return out
+
+
+def npy_header(dtype, n_rows):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_2_0(header, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                                  "fortran_order": False, "shape": (n_rows,)})
+    return header.getvalue()
+
+
+def serialize_processed(df, target, fmt=PROCESSED_FORMAT):
+    with telemetry.phase("serialize", rows=len(df), format=fmt) as ph:
+        if fmt == "npy":
+            buffer = io.BytesIO()
+            np.save(buffer, to_structured(df, structured_dtype(df, target)), allow_pickle=False)
+            data = buffer.getvalue()
+        else:
+            output_buffer = io.StringIO()
+            df.to_csv(output_buffer, index=False, float_format=CSV_FLOAT_FORMAT)
+            data = output_buffer.getvalue()
+        ph.set("bytes", len(data))
+    return data
+
+
+def read_npy_buffer(data):
+    # Lettura senza copia: l'array è una vista diretta sui byte scaricati
+    fp = io.BytesIO(data)
+    version = np.lib.format.read_magic(fp)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(fp)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(fp)
+    return np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=fp.tell())
+
+
+def read_processed(name, data):
+    # Rileva il formato dal nome del blob
+    with telemetry.phase("parse", bytes=len(data)) as ph:
+        if name.endswith(".npy"):
+            df = pd.DataFrame(read_npy_buffer(data))
+        else:
+            df = pd.read_csv(io.BytesIO(data))
+        ph.set("rows", len(df))
+    return df
+
+
+def iter_processed(name, data, chunk_rows=CHUNK_ROWS):
+    # Come read_processed, ma un DataFrame di al più `chunk_rows` righe alla
+    # volta. `data`: bytes oppure un file-like letto in avanti (es.
+    # storage.open_blob), così il file non viene mai tenuto tutto in memoria.
+    stream = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    if name.endswith(".npy"):
+        version = np.lib.format.read_magic(stream)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(stream)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(stream)
+        remaining = int(np.prod(shape))
+        while remaining > 0:
+            rows = min(chunk_rows, remaining)
+            block = stream.read(rows * dtype.itemsize)
+            if len(block) < rows * dtype.itemsize:
+                raise ValueError(f"File '{name}' troncato: mancano {remaining} righe.")
+            yield pd.DataFrame(np.frombuffer(block, dtype=dtype))
+            remaining -= rows
+    else:
+        yield from pd.read_csv(stream, chunksize=chunk_rows)
+
+
+def read_csv_chunks(open_streams, chunk_rows=CHUNK_ROWS, **kwargs):
+    # Blocchi di `chunk_rows` righe di uno o più CSV, un file dopo l'altro.
+    # `open_streams`: funzioni che aprono ognuna un nuovo file-like (es.
+    # storage.open_blob), chiuso appena il file è stato letto tutto.
+    for open_stream in open_streams:
+        with open_stream() as stream:
+            yield from pd.read_csv(stream, chunksize=chunk_rows, **kwargs)
+
+
+def scan_statistics(chunks, target=None):
+    # Primo passaggio, un blocco alla volta: statistiche per la
+    # trasformazione (medie, deviazioni standard, categorie) e momenti dei
+    # descrittori per la riduzione delle feature.
+    # Ritorna (ColumnStats, FeatureMoments, prima riga come campione).
+    stats = moments = sample = None
+    for chunk in chunks:
+        chunk = clean_frame(chunk, target)
+        if stats is None:
+            numeric = prunable_columns(chunk, target)
+            stats = ColumnStats(numeric, categorical_columns(chunk, target))
+            moments = FeatureMoments(numeric)
+            sample = chunk.drop(columns=[target], errors="ignore").head(1)
+        stats.update(chunk)
+        moments.update(chunk[stats.numeric].dropna())
+    if stats is None:
+        return ColumnStats([], []), FeatureMoments([]), pd.DataFrame()
+    return stats, moments, sample
+
+
+def preprocess_chunked(open_stream, blob_client, target, chunk_rows=CHUNK_ROWS, fmt=PROCESSED_FORMAT,
+                       metadata_fn=None, prune=PRUNE_ENABLED, transform_client=None, transform=None):
+    # Elabora il CSV in blocchi di `chunk_rows` righe e carica il risultato
+    # come blocchi staged di un unico block blob. `open_stream()` ritorna un
+    # nuovo file-like sul CSV a ogni passaggio (es. storage.open_blob): il
+    # file non viene mai tenuto tutto in memoria né riavvolto. La
+    # trasformazione fittata viene caricata su `transform_client` prima del
+    # commit (che attiva il training). Con `transform` si applica una
+    # trasformazione già esistente (salvata in `transform_client`) senza il
+    # passaggio delle statistiche.
+    # Ritorna (righe, FittedTransform).
+    fit = transform is None
+    summary = None
+    if fit:
+        stats, moments, sample = scan_statistics(read_csv_chunks([open_stream], chunk_rows), target)
+        transform, summary = fit_from_statistics(stats, moments, sample, prune)
+    logging.info(f"Vocabolario categorico: { {c: len(v) for c, v in transform.vocabulary.items()} }")
+
+    block_ids = []
+    pending = io.BytesIO()
+    total_rows = 0
+    dtype = None
+    header = True
+
+    def stage(data):
+        block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+        storage.stage_block(blob_client, block_id, data)
+        block_ids.append(BlobBlock(block_id=block_id))
+
+    # Le colonne categoriche vengono lette come testo anche nei blocchi in
+    # cui sembrano numeriche, così combaciano con il vocabolario
+    for chunk in read_csv_chunks([open_stream], chunk_rows, dtype={col: str for col in transform.vocabulary}):
+        df_clean = transform.transform_frame(clean_frame(chunk, target), target=target)
+        if fmt == "npy":
+            # Il tipo strutturato è fissato dal primo blocco; l'header .npy
+            # (che contiene il numero di righe) viene scritto alla fine.
+            if dtype is None:
+                dtype = structured_dtype(df_clean, target, int_dtype=np.int32)
+            pending.write(to_structured(df_clean, dtype).tobytes())
+        else:
+            pending.write(df_clean.to_csv(index=False, header=header, float_format=CSV_FLOAT_FORMAT).encode())
+            header = False
+        total_rows += len(df_clean)
+        if pending.tell() >= UPLOAD_BLOCK_BYTES:
+            stage(pending.getvalue())
+            pending = io.BytesIO()
+
+    if pending.tell() > 0 or not block_ids:
+        stage(pending.getvalue())
+
+    if fmt == "npy":
+        # Il block blob viene composto in ordine di commit: header in testa
+        data_blocks = block_ids[:]
+        stage(npy_header(dtype if dtype is not None else np.dtype([]), total_rows))
+        block_ids = [block_ids[-1]] + data_blocks
+
+    # metadata_fn viene chiamata solo ora, a elaborazione conclusa
+    metadata = dict(metadata_fn() if metadata_fn else {})
+    metadata["dummy_columns"] = json.dumps(transform.dummy_columns)
+    metadata["format"] = fmt
+    if summary is not None:
+        metadata["pruning"] = json.dumps(summary)
+    if transform_client is not None:
+        if fit:
+            storage.write_blob(transform_client, transform.to_bytes())
+        metadata["transform"] = transform_client.blob_name
+    storage.commit_blocks(blob_client, block_ids, metadata=metadata)
+    logging.info(f"Caricati {len(block_ids)} blocchi, {total_rows} righe elaborate.")
+    return total_rows, transform
+
+
+def fit_sources(open_streams, target, chunk_rows=CHUNK_ROWS, prune=PRUNE_ENABLED):
+    # Un solo dataset da più CSV originali, con gli stessi due passaggi a
+    # blocchi di preprocess_chunked: statistiche di tutti i file e fit di una
+    # sola trasformazione, poi trasformazione blocco per blocco. In memoria
+    # resta solo il risultato trasformato (quello che serve al training).
+    # Ritorna (DataFrame trasformato, FittedTransform, riepilogo della riduzione).
+    stats, moments, sample = scan_statistics(read_csv_chunks(open_streams, chunk_rows), target)
+    transform, summary = fit_from_statistics(stats, moments, sample, prune)
+    frames = [transform.transform_frame(clean_frame(chunk, target), target=target)
+              for chunk in read_csv_chunks(open_streams, chunk_rows, dtype={col: str for col in transform.vocabulary})]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return df, transform, summary
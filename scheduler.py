@@ -0,0 +1,155 @@
+import logging
+import os
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+
+import storage
+
+
+# --- PIANIFICAZIONE DEL TRAINING (coda, periodo di quiete, un training alla volta) ---
+# Un file che arriva in 'processed-data' non fa partire subito il training:
+# train_model lo mette in coda (un blob segnaposto per file nel container
+# 'models'; lo stesso file riaccodato è una sola voce). Il timer
+# scheduled_training addestra una volta sola con tutti i file in coda quando
+# non ne arrivano di nuovi da TRAINING_QUIET_SECONDS secondi, o comunque dopo
+# TRAINING_MAX_DELAY_SECONDS dal primo. Il lease sul blob di lock garantisce
+# un solo training alla volta anche con più istanze della Function App.
+# Un training fallito lascia i file in coda con un tentativo in più nei
+# metadati del segnaposto; dopo TRAINING_MAX_ATTEMPTS tentativi il
+# segnaposto passa in FAILED_PREFIX (con l'errore) e il file esce dalla coda.
+
+TRAINING_SCHEDULER = os.getenv("TRAINING_SCHEDULER", "1") != "0"
+# Espressione NCRONTAB del timer (default: ogni minuto)
+TRAINING_SCHEDULE = os.getenv("TRAINING_SCHEDULE", "0 * * * * *")
+TRAINING_QUIET_SECONDS = float(os.getenv("TRAINING_QUIET_SECONDS", "60"))
+TRAINING_MAX_DELAY_SECONDS = float(os.getenv("TRAINING_MAX_DELAY_SECONDS", "900"))
+TRAINING_MAX_ATTEMPTS = int(os.getenv("TRAINING_MAX_ATTEMPTS", "5"))
+
+QUEUE_CONTAINER = "models"
+QUEUE_PREFIX = "training-queue/"
+FAILED_PREFIX = "training-queue-failed/"
+# Un lock per modello pubblicato
+LOCK_BLOB = "locks/model.pkl.lock"
+
+
+class QueuedFile:
+    def __init__(self, name, marker, etag, enqueued_at, attempts=0):
+        self.name = name
+        self.marker = marker
+        self.etag = etag
+        self.enqueued_at = enqueued_at
+        self.attempts = attempts
+
+
+def enqueue(processed_name):
+    # Riscrivere il segnaposto ne aggiorna la data: il periodo di quiete
+    # riparte anche quando arriva di nuovo lo stesso file. Un file
+    # riaccodato riparte da zero tentativi, anche se era in FAILED_PREFIX.
+    storage.write_blob(storage.get_blob_client(QUEUE_CONTAINER, QUEUE_PREFIX + processed_name), b"",
+                       metadata={"blob": processed_name})
+    try:
+        storage.delete_blob(storage.get_blob_client(QUEUE_CONTAINER, FAILED_PREFIX + processed_name))
+    except ResourceNotFoundError:
+        pass
+
+
+def pending():
+    # File in coda, dal più vecchio al più recente
+    entries = []
+    for marker in storage.list_blobs(QUEUE_CONTAINER, prefix=QUEUE_PREFIX):
+        try:
+            props = storage.blob_properties(storage.get_blob_client(QUEUE_CONTAINER, marker))
+        except ResourceNotFoundError:
+            continue
+        entries.append(QueuedFile(marker[len(QUEUE_PREFIX):], marker, props.etag, props.last_modified,
+                                  int((props.metadata or {}).get("attempts", "0"))))
+    return sorted(entries, key=lambda e: e.enqueued_at)
+
+
+def is_due(entries, now=None):
+    if not entries:
+        return False
+    now = now or datetime.now(timezone.utc)
+    quiet = (now - entries[-1].enqueued_at).total_seconds()
+    waiting = (now - entries[0].enqueued_at).total_seconds()
+    return quiet >= TRAINING_QUIET_SECONDS or waiting >= TRAINING_MAX_DELAY_SECONDS
+
+
+def acknowledge(entries):
+    # Toglie dalla coda i file addestrati, ma non quelli riaccodati durante
+    # il training: la cancellazione è condizionata all'ETag letto prima del
+    # training, quindi un segnaposto riscritto resta in coda per il giro dopo
+    for entry in entries:
+        client = storage.get_blob_client(QUEUE_CONTAINER, entry.marker)
+        try:
+            storage.delete_blob(client, etag=entry.etag)
+        except (ResourceModifiedError, ResourceNotFoundError):
+            pass
+
+
+def record_failure(entries, error):
+    # Un tentativo in più per ogni file del training fallito, sempre
+    # condizionato all'ETag: un segnaposto riscritto nel frattempo riparte
+    # da zero. Aggiornare i metadati sposta anche la data del segnaposto,
+    # quindi il nuovo tentativo aspetta un altro periodo di quiete.
+    # I metadati accettano solo ASCII su una riga.
+    message = " ".join(str(error).split()).encode("ascii", "replace").decode()[:1024]
+    for entry in entries:
+        client = storage.get_blob_client(QUEUE_CONTAINER, entry.marker)
+        metadata = {"blob": entry.name, "attempts": str(entry.attempts + 1), "error": message}
+        try:
+            if entry.attempts + 1 < TRAINING_MAX_ATTEMPTS:
+                storage.set_metadata(client, metadata, etag=entry.etag)
+                continue
+            storage.write_blob(storage.get_blob_client(QUEUE_CONTAINER, FAILED_PREFIX + entry.name), b"",
+                               metadata=metadata)
+            storage.delete_blob(client, etag=entry.etag)
+            logging.error(f"File '{entry.name}' tolto dalla coda dopo {TRAINING_MAX_ATTEMPTS} training falliti "
+                          f"(segnaposto in '{FAILED_PREFIX}'): {message}")
+        except (ResourceModifiedError, ResourceNotFoundError):
+            pass
+
+
+def failed():
+    # Nomi dei file tolti dalla coda dopo troppi training falliti
+    return [marker[len(FAILED_PREFIX):] for marker in storage.list_blobs(QUEUE_CONTAINER, prefix=FAILED_PREFIX)]
+
+
+def training_lock():
+    # Context manager: lease sul lock del modello oppure None se un'altra
+    # istanza sta già addestrando
+    return storage.held_lease(storage.get_blob_client(QUEUE_CONTAINER, LOCK_BLOB))
+
+
+def run_pending(train, force=False):
+    # Se la coda è pronta (o `force`) chiama train(nomi dei file in coda)
+    # sotto lock. Ritorna i nomi addestrati, lista vuota se non c'era niente da fare.
+    entries = pending()
+    if not entries or not (force or is_due(entries)):
+        return []
+    with training_lock() as lease:
+        if lease is None:
+            logging.info("Training già in corso su un'altra istanza: la coda verrà ripresa al prossimo timer.")
+            return []
+        # La coda può essere cambiata mentre acquisivamo il lock
+        entries = pending()
+        if not entries:
+            return []
+        names = [e.name for e in entries]
+        logging.info(f"Training pianificato su {len(names)} file in coda: {names}")
+        # Dopo un training fallito i file vengono riprovati uno alla volta:
+        # un file che fa fallire il training non blocca gli altri
+        batches = [[e] for e in entries] if any(e.attempts for e in entries) else [entries]
+        trained = []
+        for batch in batches:
+            batch_names = [e.name for e in batch]
+            try:
+                train(batch_names)
+            except Exception as e:
+                logging.error(f"Training fallito su {batch_names}: {e}")
+                record_failure(batch, e)
+                continue
+            acknowledge(batch)
+            trained.extend(batch_names)
+        return trained
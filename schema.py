@@ -0,0 +1,164 @@
+import json
+import math
+
+import numpy as np
+
+
+# --- SCHEMA DELLE FEATURE (manifest salvato insieme al modello) ---
+# Il manifest descrive esattamente le colonne usate in training, nel loro
+# ordine. In inferenza viene usato per costruire direttamente la matrice
+# float del modello, senza passare da un DataFrame pandas.
+
+MANIFEST_FILENAME = "model_manifest.json"
+MANIFEST_VERSION = 1
+
+
+class SchemaError(ValueError):
+    # Payload non conforme allo schema del modello (risposta 400 al client)
+    pass
+
+
+class FeatureSchema:
+    def __init__(self, features, dtypes=None, dummy_columns=None, target=None, classes=None, model_version=None,
+                 descriptors=None):
+        self.features = list(features)
+        self.dtypes = dict(dtypes or {})
+        self.dummy_columns = dict(dummy_columns or {})
+        self.target = target
+        self.classes = list(classes) if classes is not None else None
+        # Versione di model.pkl pubblicata insieme al manifest
+        self.model_version = model_version
+        # Versione di RDKit e descrittori fuori parità (vedi descriptors.parity_check)
+        self.descriptors = descriptors
+        # Mappa precalcolata nome -> posizione nella matrice di input
+        self.index = {name: i for i, name in enumerate(self.features)}
+
+    @property
+    def n_features(self):
+        return len(self.features)
+
+    @property
+    def input_columns(self):
+        # Colonne che il client deve inviare (senza trasformazione coincidono
+        # con le feature del modello)
+        return self.features
+
+    # --- Costruzione / serializzazione ---
+
+    @classmethod
+    def from_training_frame(cls, X, target=None, classes=None, dummy_columns=None):
+        dtypes = {c: str(t) for c, t in X.dtypes.items()}
+        if dummy_columns is None:
+            # Senza informazioni dal preprocessing, le colonne booleane (uint8
+            # nel formato .npy) sono quelle generate da pd.get_dummies
+            bool_columns = [c for c, t in dtypes.items() if t in ("bool", "uint8")]
+            dummy_columns = {"": bool_columns} if bool_columns else {}
+        return cls(list(X.columns), dtypes, dummy_columns, target, classes)
+
+    @classmethod
+    def from_model(cls, model):
+        # Ripiego per modelli addestrati prima dell'introduzione del manifest
+        names = getattr(model, "feature_names_in_", None)
+        if names is None:
+            return None
+        classes = [c.item() if hasattr(c, "item") else c for c in getattr(model, "classes_", [])]
+        return cls([str(n) for n in names], classes=classes or None)
+
+    @classmethod
+    def from_manifest(cls, data):
+        manifest = json.loads(data)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Versione del manifest non supportata: {manifest.get('version')}")
+        return cls(
+            features=manifest["features"],
+            dtypes=manifest.get("dtypes"),
+            dummy_columns=manifest.get("dummy_columns"),
+            target=manifest.get("target"),
+            classes=manifest.get("classes"),
+            model_version=manifest.get("model_version"),
+            descriptors=manifest.get("descriptors"),
+        )
+
+    def to_manifest(self):
+        return json.dumps({
+            "version": MANIFEST_VERSION,
+            "model_version": self.model_version,
+            "target": self.target,
+            "classes": self.classes,
+            "n_features": self.n_features,
+            "features": self.features,
+            "dtypes": self.dtypes,
+            "dummy_columns": self.dummy_columns,
+            "descriptors": self.descriptors,
+        }, indent=2)
+
+    # --- Inferenza ---
+
+    def _fill_row(self, out, record):
+        # Scrive il record nella riga `out` (già allocata) seguendo l'ordine
+        # del training. Solleva SchemaError se il record non è valido.
+        if not isinstance(record, dict):
+            raise SchemaError("ogni record deve essere un oggetto JSON")
+
+        seen = 0
+        bad = []
+        for name, value in record.items():
+            pos = self.index.get(name)
+            if pos is None:
+                # Colonne extra (Label, SMILES, descrittori non usati) ignorate
+                continue
+            seen += 1
+            if isinstance(value, bool):
+                value = float(value)
+            elif not isinstance(value, (int, float)):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    bad.append(name)
+                    continue
+            if not math.isfinite(value):
+                bad.append(name)
+                continue
+            out[pos] = value
+
+        if bad:
+            raise SchemaError(f"valori non numerici o non finiti: {bad[:10]}")
+        if seen != self.n_features:
+            missing = [f for f in self.features if f not in record]
+            raise SchemaError(f"feature mancanti ({len(missing)}): {missing[:10]}")
+
+    def vectorize(self, record):
+        # Singolo record -> array contiguo di forma (1, n_features)
+        X = np.empty((1, self.n_features), dtype=np.float64)
+        self._fill_row(X[0], record)
+        return X
+
+    def vectorize_many(self, records):
+        # Lista di record -> (matrice delle righe valide, posizioni valide, errori per riga)
+        X = np.empty((len(records), self.n_features), dtype=np.float64)
+        valid = []
+        errors = {}
+        for i, record in enumerate(records):
+            try:
+                self._fill_row(X[len(valid)], record)
+                valid.append(i)
+            except SchemaError as e:
+                errors[i] = str(e)
+        return X[:len(valid)], valid, errors
+
+    def vectorize_frame(self, df):
+        # DataFrame (es. CSV caricato) -> stessa uscita di vectorize_many,
+        # ma con un solo reindex vettoriale sulle colonne del training.
+        import pandas as pd
+
+        missing = [f for f in self.features if f not in df.columns]
+        if missing:
+            raise SchemaError(f"feature mancanti ({len(missing)}): {missing[:10]}")
+        X = df[self.features].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        finite = np.isfinite(X)
+        row_ok = finite.all(axis=1)
+        errors = {}
+        for i in np.flatnonzero(~row_ok):
+            bad = [self.features[j] for j in np.flatnonzero(~finite[i])]
+            errors[int(i)] = f"valori non numerici o non finiti: {bad[:10]}"
+        return np.ascontiguousarray(X[row_ok]), np.flatnonzero(row_ok).tolist(), errors
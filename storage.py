@@ -0,0 +1,542 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import requests
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+
+
+# --- ACCESSO ALLO STORAGE (client condiviso, trasferimenti paralleli, metriche) ---
+# Un solo BlobServiceClient per processo: le invocazioni successive riusano
+# le connessioni HTTPS già aperte invece di rifare handshake TLS e setup.
+
+# Connessioni HTTP tenute aperte nel pool del client
+STORAGE_POOL_SIZE = int(os.getenv("STORAGE_POOL_SIZE", "32"))
+# Richieste parallele per ogni download (a range) o upload (a blocchi)
+STORAGE_MAX_CONCURRENCY = int(os.getenv("STORAGE_MAX_CONCURRENCY", "4"))
+# Dimensione dei range scaricati e dei blocchi caricati in parallelo
+STORAGE_CHUNK_BYTES = int(os.getenv("STORAGE_CHUNK_BYTES", str(4 * 1024 * 1024)))
+# Durata dei lease sui blob (Azure accetta 15-60 secondi): vengono rinnovati
+# in background finché chi li possiede non li rilascia
+STORAGE_LEASE_SECONDS = int(os.getenv("STORAGE_LEASE_SECONDS", "60"))
+
+# Backend dei container (input-data, processed-data, models):
+#  - "azure": Blob Storage tramite AzureWebJobsStorage (default)
+#  - "local": una cartella per container sotto STORAGE_LOCAL_ROOT
+#  - "memory": dizionario nel processo (test, benchmark, profiling)
+# I backend locali espongono lo stesso sottoinsieme di BlobClient usato
+# dalla pipeline, quindi il resto del codice non cambia.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure").lower()
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT", ".storage")
+
+_clients = {}
+_clients_lock = threading.Lock()
+_metrics = {}
+_metrics_lock = threading.Lock()
+_backend = {"name": STORAGE_BACKEND, "root": STORAGE_LOCAL_ROOT, "store": None}
+
+
+def _connection_string(connection_string=None):
+    return connection_string or os.getenv('AzureWebJobsStorage')
+
+
+def get_service_client(connection_string=None):
+    # Client creato alla prima chiamata e poi condiviso da tutto il processo
+    connect_str = _connection_string(connection_string)
+    client = _clients.get(connect_str)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(connect_str)
+            if client is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=STORAGE_POOL_SIZE,
+                                                        pool_maxsize=STORAGE_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                client = BlobServiceClient.from_connection_string(
+                    connect_str,
+                    transport=RequestsTransport(session=session, session_owner=False),
+                    max_single_get_size=STORAGE_CHUNK_BYTES,
+                    max_chunk_get_size=STORAGE_CHUNK_BYTES,
+                    max_single_put_size=STORAGE_CHUNK_BYTES,
+                    max_block_size=STORAGE_CHUNK_BYTES,
+                )
+                _clients[connect_str] = client
+    return client
+
+
+def get_container_client(container, connection_string=None):
+    return get_service_client(connection_string).get_container_client(container)
+
+
+def get_blob_client(container, blob, connection_string=None):
+    if _backend["name"] == "azure":
+        return get_service_client(connection_string).get_blob_client(container=container, blob=blob)
+    return LocalBlobClient(_local_store(), container, blob)
+
+
+def set_backend(name, root=None):
+    # Cambia backend a runtime (es. il driver locale della pipeline); i
+    # client già creati restano legati al backend precedente.
+    if name not in ("azure", "local", "memory"):
+        raise ValueError(f"Backend di storage sconosciuto: {name}")
+    with _clients_lock:
+        _backend.update(name=name, root=root or STORAGE_LOCAL_ROOT, store=None)
+
+
+def _local_store():
+    store = _backend["store"]
+    if store is None:
+        with _clients_lock:
+            store = _backend["store"]
+            if store is None:
+                if _backend["name"] == "memory":
+                    store = MemoryStore()
+                elif _backend["name"] == "local":
+                    store = DirectoryStore(_backend["root"])
+                else:
+                    raise ValueError(f"Backend di storage sconosciuto: {_backend['name']}")
+                _backend["store"] = store
+    return store
+
+
+# --- Backend locali (cartella su disco o memoria del processo) ---
+
+class BlobProperties:
+    # Sottoinsieme delle proprietà di azure.storage.blob.BlobProperties
+    def __init__(self, name, container, size, etag, last_modified, metadata):
+        self.name = name
+        self.container = container
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.metadata = metadata
+
+
+class _Download:
+    def __init__(self, data, properties):
+        self._data = data
+        self.properties = properties
+        self.size = len(data)
+
+    def readall(self):
+        return self._data
+
+    def chunks(self):
+        for start in range(0, self.size, STORAGE_CHUNK_BYTES):
+            yield self._data[start:start + STORAGE_CHUNK_BYTES]
+
+
+def _check_condition(props, etag, match_condition):
+    # Condizione sull'ETag come nelle richieste condizionali di Azure
+    if etag is not None and match_condition == MatchConditions.IfNotModified and props.etag != etag:
+        raise ResourceModifiedError(f"Blob '{props.container}/{props.name}' modificato (ETag {props.etag} != {etag})")
+
+
+class LeaseTable:
+    # Lease esclusivi sui blob, con la semantica di Azure (scadenza, rinnovo,
+    # rilascio). Validi solo all'interno del processo.
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, container, blob, lease_id, duration):
+        now = time.monotonic()
+        with self._lock:
+            current = self._leases.get((container, blob))
+            if current is not None and current[0] != lease_id and (current[1] is None or current[1] > now):
+                raise ResourceExistsError(f"Lease già presente sul blob '{container}/{blob}'")
+            self._leases[(container, blob)] = (lease_id, now + duration if duration > 0 else None)
+
+    def release(self, container, blob, lease_id):
+        with self._lock:
+            current = self._leases.get((container, blob))
+            if current is not None and current[0] == lease_id:
+                del self._leases[(container, blob)]
+
+
+class LocalLease:
+    # Sottoinsieme di azure.storage.blob.BlobLeaseClient
+    def __init__(self, client, lease_id, duration):
+        self.client = client
+        self.id = lease_id
+        self.duration = duration
+
+    def renew(self, **kwargs):
+        self.client.store.leases.acquire(self.client.container_name, self.client.blob_name, self.id, self.duration)
+
+    def release(self, **kwargs):
+        self.client.store.leases.release(self.client.container_name, self.client.blob_name, self.id)
+
+
+class MemoryStore:
+    def __init__(self):
+        self._blobs = {}
+        self._lock = threading.Lock()
+        self.leases = LeaseTable()
+
+    def get(self, container, blob):
+        with self._lock:
+            if (container, blob) not in self._blobs:
+                raise ResourceNotFoundError(f"Blob '{container}/{blob}' non trovato")
+            return self._blobs[(container, blob)]
+
+    def properties(self, container, blob):
+        return self.get(container, blob)[1]
+
+    def put(self, container, blob, data, metadata=None):
+        props = BlobProperties(blob, container, len(data), f'"{uuid.uuid4().hex}"',
+                               datetime.now(timezone.utc), dict(metadata or {}))
+        with self._lock:
+            self._blobs[(container, blob)] = (bytes(data), props)
+        return props
+
+    def set_metadata(self, container, blob, metadata, etag=None):
+        with self._lock:
+            if (container, blob) not in self._blobs:
+                raise ResourceNotFoundError(f"Blob '{container}/{blob}' non trovato")
+            data, props = self._blobs[(container, blob)]
+            _check_condition(props, etag, MatchConditions.IfNotModified)
+            props = BlobProperties(blob, container, props.size, f'"{uuid.uuid4().hex}"',
+                                   datetime.now(timezone.utc), dict(metadata or {}))
+            self._blobs[(container, blob)] = (data, props)
+        return props
+
+    def delete(self, container, blob, etag=None):
+        with self._lock:
+            if (container, blob) not in self._blobs:
+                raise ResourceNotFoundError(f"Blob '{container}/{blob}' non trovato")
+            _check_condition(self._blobs[(container, blob)][1], etag, MatchConditions.IfNotModified)
+            del self._blobs[(container, blob)]
+
+    def list(self, container):
+        with self._lock:
+            return sorted(b for c, b in self._blobs if c == container)
+
+
+class DirectoryStore:
+    # <root>/<container>/<blob>; ETag e metadati in <root>/<container>/.meta/<blob>.json
+    def __init__(self, root):
+        self.root = root
+        self.leases = LeaseTable()
+
+    def _paths(self, container, blob):
+        return (os.path.join(self.root, container, blob),
+                os.path.join(self.root, container, ".meta", blob + ".json"))
+
+    def properties(self, container, blob):
+        path, meta_path = self._paths(container, blob)
+        if not os.path.exists(path):
+            raise ResourceNotFoundError(f"Blob '{container}/{blob}' non trovato")
+        info = {}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                info = json.load(f)
+        stat = os.stat(path)
+        return BlobProperties(blob, container, stat.st_size,
+                              info.get("etag", f'"{stat.st_mtime_ns:x}"'),
+                              datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+                              info.get("metadata", {}))
+
+    def get(self, container, blob):
+        props = self.properties(container, blob)
+        with open(self._paths(container, blob)[0], "rb") as f:
+            return f.read(), props
+
+    def put(self, container, blob, data, metadata=None):
+        path, meta_path = self._paths(container, blob)
+        for target, content in ((path, bytes(data)),
+                                (meta_path, json.dumps({"etag": f'"{uuid.uuid4().hex}"',
+                                                        "metadata": dict(metadata or {})}).encode())):
+            # Scrittura atomica: chi legge vede il file vecchio o quello nuovo
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, target)
+        return self.properties(container, blob)
+
+    def set_metadata(self, container, blob, metadata, etag=None):
+        path, meta_path = self._paths(container, blob)
+        _check_condition(self.properties(container, blob), etag, MatchConditions.IfNotModified)
+        tmp = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump({"etag": f'"{uuid.uuid4().hex}"', "metadata": dict(metadata or {})}, f)
+        os.replace(tmp, meta_path)
+        return self.properties(container, blob)
+
+    def delete(self, container, blob, etag=None):
+        path, meta_path = self._paths(container, blob)
+        _check_condition(self.properties(container, blob), etag, MatchConditions.IfNotModified)
+        os.remove(path)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+    def list(self, container):
+        base = os.path.join(self.root, container)
+        names = []
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames[:] = [d for d in dirnames if d != ".meta"]
+            names.extend(os.path.relpath(os.path.join(dirpath, f), base).replace(os.sep, "/")
+                         for f in filenames if not f.endswith(".tmp"))
+        return sorted(names)
+
+
+class LocalBlobClient:
+    # Stessi metodi di azure BlobClient usati dalla pipeline, su MemoryStore
+    # o DirectoryStore. I blocchi staged restano in memoria fino al commit.
+    def __init__(self, store, container, blob):
+        self.store = store
+        self.container_name = container
+        self.blob_name = blob
+        self._blocks = {}
+
+    def exists(self):
+        try:
+            self.store.properties(self.container_name, self.blob_name)
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def download_blob(self, etag=None, match_condition=None, **kwargs):
+        data, props = self.store.get(self.container_name, self.blob_name)
+        _check_condition(props, etag, match_condition)
+        return _Download(data, props)
+
+    def upload_blob(self, data, overwrite=False, metadata=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode()
+        if not overwrite and self.exists():
+            raise ResourceExistsError(f"Blob '{self.container_name}/{self.blob_name}' già esistente")
+        props = self.store.put(self.container_name, self.blob_name, data, metadata)
+        return {"etag": props.etag, "last_modified": props.last_modified}
+
+    def get_blob_properties(self, **kwargs):
+        return self.store.properties(self.container_name, self.blob_name)
+
+    def set_blob_metadata(self, metadata=None, etag=None, match_condition=None, **kwargs):
+        props = self.store.set_metadata(self.container_name, self.blob_name, metadata,
+                                        etag if match_condition == MatchConditions.IfNotModified else None)
+        return {"etag": props.etag, "last_modified": props.last_modified}
+
+    def delete_blob(self, etag=None, match_condition=None, **kwargs):
+        self.store.delete(self.container_name, self.blob_name,
+                          etag if match_condition == MatchConditions.IfNotModified else None)
+
+    def acquire_lease(self, lease_duration=-1, lease_id=None, **kwargs):
+        self.store.properties(self.container_name, self.blob_name)
+        lease = LocalLease(self, lease_id or str(uuid.uuid4()), lease_duration)
+        self.store.leases.acquire(self.container_name, self.blob_name, lease.id, lease_duration)
+        return lease
+
+    def stage_block(self, block_id, data, **kwargs):
+        self._blocks[block_id] = bytes(data)
+
+    def commit_block_list(self, block_list, metadata=None, **kwargs):
+        ids = [getattr(block, "id", block) for block in block_list]
+        data = b"".join(self._blocks[block_id] for block_id in ids)
+        props = self.store.put(self.container_name, self.blob_name, data, metadata)
+        self._blocks.clear()
+        return {"etag": props.etag, "last_modified": props.last_modified}
+
+
+# --- Metriche per operazione ---
+
+@contextmanager
+def timed(operation, nbytes=0):
+    # Registra numero di chiamate, byte trasferiti e latenza di `operation`.
+    # Se il numero di byte è noto solo alla fine, il chiamante può
+    # aggiornarlo tramite il dizionario restituito.
+    record = {"bytes": nbytes}
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _metrics_lock:
+            m = _metrics.setdefault(operation, {"count": 0, "bytes": 0, "total_ms": 0.0, "max_ms": 0.0})
+            m["count"] += 1
+            m["bytes"] += record["bytes"]
+            m["total_ms"] += elapsed_ms
+            m["max_ms"] = max(m["max_ms"], elapsed_ms)
+
+
+def storage_stats():
+    with _metrics_lock:
+        return {
+            op: dict(m, avg_ms=m["total_ms"] / m["count"] if m["count"] else 0.0)
+            for op, m in _metrics.items()
+        }
+
+
+# --- Operazioni sui blob ---
+
+def read_blob(blob_client, max_concurrency=STORAGE_MAX_CONCURRENCY):
+    # Download a range paralleli; ritorna (bytes, proprietà del blob)
+    with timed("download") as record:
+        downloader = blob_client.download_blob(max_concurrency=max_concurrency)
+        data = downloader.readall()
+        record["bytes"] = len(data)
+    return data, downloader.properties
+
+
+def iter_blob(blob_client, etag=None):
+    # Download a blocchi di STORAGE_CHUNK_BYTES, senza tenere in memoria
+    # l'intero blob. Con `etag` tutti i blocchi vengono dalla stessa versione:
+    # se il blob è stato sovrascritto si ottiene ResourceModifiedError.
+    condition = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+    with timed("download") as record:
+        for chunk in blob_client.download_blob(**condition).chunks():
+            record["bytes"] += len(chunk)
+            yield chunk
+
+
+class ChunkReader(io.RawIOBase):
+    # File-like in sola lettura su un iterabile di blocchi di bytes, per
+    # passare un download in streaming a chi si aspetta un file (pd.read_csv)
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = memoryview(chunk)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def open_blob(blob_client, etag=None):
+    # Come iter_blob, ma come file-like bufferizzato
+    return io.BufferedReader(ChunkReader(iter_blob(blob_client, etag)), buffer_size=STORAGE_CHUNK_BYTES)
+
+
+def write_blob(blob_client, data, metadata=None, overwrite=True, max_concurrency=STORAGE_MAX_CONCURRENCY):
+    # Upload a blocchi paralleli (sopra STORAGE_CHUNK_BYTES)
+    if isinstance(data, str):
+        data = data.encode()
+    with timed("upload", len(data)):
+        return blob_client.upload_blob(data, overwrite=overwrite, metadata=metadata,
+                                       max_concurrency=max_concurrency)
+
+
+def blob_properties(blob_client):
+    with timed("get_properties"):
+        return blob_client.get_blob_properties()
+
+
+def blob_identity(properties):
+    # Identifica il contenuto del blob senza scaricarlo: il Content-MD5
+    # (calcolato dal servizio per gli upload in una sola richiesta) resta
+    # uguale se lo stesso file viene ricaricato, l'ETag cambia a ogni scrittura
+    settings = getattr(properties, "content_settings", None)
+    md5 = getattr(settings, "content_md5", None)
+    if md5:
+        return f"md5:{bytes(md5).hex()}"
+    return "etag:" + properties.etag.strip('"')
+
+
+def stage_block(blob_client, block_id, data):
+    with timed("stage_block", len(data)):
+        blob_client.stage_block(block_id=block_id, data=data)
+
+
+def commit_blocks(blob_client, block_list, metadata=None):
+    with timed("commit_block_list"):
+        return blob_client.commit_block_list(block_list, metadata=metadata)
+
+
+def set_metadata(blob_client, metadata, etag=None):
+    # Sostituisce i metadati del blob senza riscriverne il contenuto; con
+    # `etag` solo se il blob non è cambiato (altrimenti ResourceModifiedError)
+    condition = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+    with timed("set_metadata"):
+        return blob_client.set_blob_metadata(metadata=metadata, **condition)
+
+
+def delete_blob(blob_client, etag=None):
+    # Con `etag` la cancellazione è condizionale: se il blob è stato
+    # riscritto nel frattempo si ottiene ResourceModifiedError
+    condition = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+    with timed("delete"):
+        blob_client.delete_blob(**condition)
+
+
+def list_blobs(container, prefix=None, connection_string=None):
+    # Nomi dei blob di un container (qualsiasi backend), eventualmente solo
+    # quelli che iniziano con `prefix`
+    if _backend["name"] == "azure":
+        return [b.name for b in get_container_client(container, connection_string).list_blobs(name_starts_with=prefix)]
+    return [name for name in _local_store().list(container) if not prefix or name.startswith(prefix)]
+
+
+def acquire_lease(blob_client, duration=STORAGE_LEASE_SECONDS):
+    # Lease esclusivo sul blob (creato vuoto se non esiste). Ritorna None
+    # se il lease è già di qualcun altro.
+    try:
+        write_blob(blob_client, b"", overwrite=False)
+    except ResourceExistsError:
+        pass
+    try:
+        with timed("acquire_lease"):
+            return blob_client.acquire_lease(lease_duration=duration)
+    except HttpResponseError as e:
+        if isinstance(e, ResourceExistsError) or e.status_code == 409:
+            return None
+        raise
+
+
+@contextmanager
+def held_lease(blob_client, duration=STORAGE_LEASE_SECONDS):
+    # Mantiene il lease (rinnovandolo) per tutto il blocco with e lo rilascia
+    # all'uscita; restituisce None se il lease è già di qualcun altro.
+    lease = acquire_lease(blob_client, duration)
+    if lease is None:
+        yield None
+        return
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(duration / 3):
+            try:
+                lease.renew()
+            except Exception as e:
+                logging.warning(f"Rinnovo del lease su '{blob_client.blob_name}' non riuscito: {e}")
+                return
+
+    renewer = threading.Thread(target=renew, name="lease-renew", daemon=True)
+    renewer.start()
+    try:
+        yield lease
+    finally:
+        stop.set()
+        renewer.join()
+        try:
+            lease.release()
+        except Exception as e:
+            logging.warning(f"Rilascio del lease su '{blob_client.blob_name}' non riuscito: {e}")
+
+
+def log_stats():
+    for op, m in storage_stats().items():
+        logging.info(f"[storage] {op}: {m['count']} chiamate, {m['bytes']} bytes, "
+                     f"media {m['avg_ms']:.1f} ms, max {m['max_ms']:.1f} ms")
@@ -0,0 +1,161 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import metrics, trace
+except ImportError:  # opentelemetry non installato: solo tempi locali (Server-Timing)
+    metrics = trace = None
+
+
+# --- TELEMETRIA DELLA PIPELINE (span e istogrammi per fase) ---
+# Ogni fase (download, parse, dropna, get_dummies, fit, predict, ...) viene
+# misurata con telemetry.phase(): diventa uno span OpenTelemetry, un punto
+# dell'istogramma "pipeline.phase.duration" e una voce dell'header
+# Server-Timing della richiesta HTTP corrente.
+
+# Exporter: "none", "console", "file" (JSON lines in TELEMETRY_FILE),
+# "otlp" (collector OTLP/HTTP) oppure "azure" (Azure Monitor / App Insights)
+TELEMETRY_EXPORTER = os.getenv("TELEMETRY_EXPORTER", "none").lower()
+TELEMETRY_FILE = os.getenv("TELEMETRY_FILE", "telemetry.jsonl")
+TELEMETRY_EXPORT_INTERVAL_MS = int(os.getenv("TELEMETRY_EXPORT_INTERVAL_MS", "15000"))
+
+_tracer = None
+_instruments = {}
+_configured = False
+_configure_lock = threading.Lock()
+_server_timing = contextvars.ContextVar("server_timing", default=None)
+
+
+def _exporters(kind):
+    # Ritorna (span exporter, metric exporter) per il tipo richiesto
+    if kind == "console":
+        from opentelemetry.sdk.metrics.export import ConsoleMetricExporter
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        return ConsoleSpanExporter(), ConsoleMetricExporter()
+    if kind == "file":
+        from opentelemetry.sdk.metrics.export import ConsoleMetricExporter
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        out = open(TELEMETRY_FILE, "a", buffering=1)
+        return (
+            ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n"),
+            ConsoleMetricExporter(out=out, formatter=lambda data: data.to_json(indent=None) + "\n"),
+        )
+    if kind == "otlp":
+        # Richiede opentelemetry-exporter-otlp-proto-http; endpoint da
+        # OTEL_EXPORTER_OTLP_ENDPOINT
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter(), OTLPMetricExporter()
+    raise ValueError(f"Exporter di telemetria sconosciuto: {kind}")
+
+
+def configure(exporter=TELEMETRY_EXPORTER):
+    # Da chiamare una volta all'avvio del processo; le chiamate successive
+    # non hanno effetto.
+    global _tracer, _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+        if trace is None:
+            if exporter != "none":
+                logging.warning("opentelemetry non installato: telemetria disattivata.")
+            return
+        try:
+            if exporter == "azure":
+                # Richiede azure-monitor-opentelemetry e APPLICATIONINSIGHTS_CONNECTION_STRING
+                from azure.monitor.opentelemetry import configure_azure_monitor
+                configure_azure_monitor()
+            elif exporter != "none":
+                from opentelemetry.sdk.metrics import MeterProvider
+                from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+                span_exporter, metric_exporter = _exporters(exporter)
+                resource = Resource.create({"service.name": os.getenv("WEBSITE_SITE_NAME", "sdcc-pipeline")})
+                tracer_provider = TracerProvider(resource=resource)
+                tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+                trace.set_tracer_provider(tracer_provider)
+                reader = PeriodicExportingMetricReader(metric_exporter,
+                                                       export_interval_millis=TELEMETRY_EXPORT_INTERVAL_MS)
+                metrics.set_meter_provider(MeterProvider(resource=resource, metric_readers=[reader]))
+        except Exception as e:
+            logging.warning(f"Configurazione della telemetria ({exporter}) non riuscita: {e}")
+
+        _tracer = trace.get_tracer("sdcc.pipeline")
+        meter = metrics.get_meter("sdcc.pipeline")
+        _instruments["duration"] = meter.create_histogram(
+            "pipeline.phase.duration", unit="ms", description="Durata di ogni fase della pipeline")
+        _instruments["bytes"] = meter.create_histogram(
+            "pipeline.phase.bytes", unit="By", description="Dimensione dei dati elaborati da una fase")
+        _instruments["rows"] = meter.create_histogram(
+            "pipeline.phase.rows", description="Righe elaborate da una fase")
+
+
+class Phase:
+    # Handle restituito da phase(): permette di aggiungere dimensioni e
+    # numero di righe mentre la fase è in corso
+    def __init__(self, name, span):
+        self.name = name
+        self.span = span
+        self.attributes = {}
+
+    def set(self, key, value):
+        self.attributes[key] = value
+        if self.span is not None:
+            self.span.set_attribute(f"pipeline.{key}", value)
+
+
+class ServerTiming:
+    def __init__(self):
+        self.entries = []
+
+    def add(self, name, duration_ms):
+        self.entries.append((name, duration_ms))
+
+    def header(self):
+        # Formato dell'header HTTP Server-Timing: "fase;dur=1.23, ..."
+        return ", ".join(f"{name};dur={duration:.2f}" for name, duration in self.entries)
+
+
+@contextmanager
+def phase(name, **attributes):
+    span_cm = _tracer.start_as_current_span(f"pipeline.{name}") if _tracer is not None else None
+    span = span_cm.__enter__() if span_cm is not None else None
+    handle = Phase(name, span)
+    for key, value in attributes.items():
+        handle.set(key, value)
+    started = time.perf_counter()
+    try:
+        yield handle
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        labels = {"phase": name}
+        if "duration" in _instruments:
+            _instruments["duration"].record(duration_ms, labels)
+            if "bytes" in handle.attributes:
+                _instruments["bytes"].record(handle.attributes["bytes"], labels)
+            if "rows" in handle.attributes:
+                _instruments["rows"].record(handle.attributes["rows"], labels)
+        timing = _server_timing.get()
+        if timing is not None:
+            timing.add(name, duration_ms)
+        if span_cm is not None:
+            span_cm.__exit__(None, None, None)
+
+
+@contextmanager
+def server_timing():
+    # Raccoglie le fasi eseguite nella richiesta corrente per l'header Server-Timing
+    timing = ServerTiming()
+    token = _server_timing.set(timing)
+    try:
+        yield timing
+    finally:
+        _server_timing.reset(token)
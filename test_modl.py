@@ -1,7 +1,6 @@
 import pandas as pd
-import requests
-import json
 import time
+from predict_client import PredictClient, records_from_frame
 
 # --- CONFIGURAZIONE ---
 # 1. L'URL della tua API (Controlla il terminale quando premi F5)
@@ -14,6 +13,10 @@ TEST_FILE = "DIA_testset_RDKit_descriptors.csv"
 # Ho controllato il tuo file: la colonna si chiama "Label"
 TARGET_COLUMN = "Label" 
 
+# 4. Richieste in parallelo e righe per richiesta (endpoint /predict/batch)
+MAX_WORKERS = 8
+BATCH_SIZE = 25
+
 def test_pipeline():
     print(f"--- AVVIO TEST MODELLE ---")
     
@@ -25,58 +28,49 @@ def test_pipeline():
         print(f"ERRORE: Non trovo il file '{TEST_FILE}'.")
         return
 
-    # Prendiamo un campione di 10 farmaci a caso per il test
-    sample = df.sample(120)
+    # Prendiamo un campione di farmaci a caso per il test
+    sample = df.sample(min(120, len(df)))
     
     correct_predictions = 0
     total_tests = len(sample)
 
     print("\nInizio invio richieste all'API...\n")
 
-    for index, row in sample.iterrows():
-        # --- PREPARAZIONE DATI ---
-        # 1. Salviamo il valore vero (la risposta corretta)
-        real_label = row[TARGET_COLUMN]
-        
-        # 2. Prepariamo il pacchetto dati (Payload) da inviare
-        # Dobbiamo togliere la risposta ('Label') perché l'API deve indovinarla
-        # Dobbiamo togliere 'SMILES' perché è testo e rompe il modello
-        input_data = row.drop([TARGET_COLUMN, 'SMILES'], errors='ignore')
-        
-        # Convertiamo in dizionario
-        payload = input_data.to_dict()
+    # --- PREPARAZIONE DATI ---
+    # Dobbiamo togliere la risposta ('Label') perché l'API deve indovinarla
+    # e 'SMILES' perché è testo: conversione in blocco di tutte le righe
+    payloads = records_from_frame(sample)
 
-        # --- CHIAMATA API ---
-        try:
-            # Inviamo la richiesta POST
-            response = requests.post(API_URL, json=payload)
-            
-            if response.status_code == 200:
-                # Leggiamo la risposta JSON dell'API
-                api_response = response.json()
-                
-                # La predizione arriva come stringa ("0" o "1"), la convertiamo in intero
-                prediction = int(float(api_response.get("prediction")))
-                
-                # --- VERIFICA ---
-                if prediction == real_label:
-                    esito = "✅ CORRETTO"
-                    correct_predictions += 1
-                else:
-                    esito = "❌ ERRORE  "
-                
-                print(f"Farmaco #{index} -> Reale: {real_label} | Predetto: {prediction} | {esito}")
-            
-            else:
-                print(f"Farmaco #{index} -> Errore API: {response.status_code} - {response.text}")
+    # --- CHIAMATE API (concorrenti, con la stessa connessione keep-alive) ---
+    client = PredictClient(API_URL, max_workers=MAX_WORKERS, batch_size=BATCH_SIZE)
+    started = time.perf_counter()
+    results = client.predict_many(payloads)
+    elapsed = time.perf_counter() - started
+    client.close()
 
-        except Exception as e:
-            print(f"Errore di connessione: {e}")
+    # I risultati sono nello stesso ordine delle righe del campione
+    for index, real_label, result in zip(sample.index, sample[TARGET_COLUMN], results):
+        if "error" in result:
+            print(f"Farmaco #{index} -> Errore API: {result['error']}")
+            continue
+
+        # La predizione arriva come stringa ("0" o "1"), la convertiamo in intero
+        prediction = int(float(result.get("prediction")))
+        
+        # --- VERIFICA ---
+        if prediction == real_label:
+            esito = "✅ CORRETTO"
+            correct_predictions += 1
+        else:
+            esito = "❌ ERRORE  "
+        
+        print(f"Farmaco #{index} -> Reale: {real_label} | Predetto: {prediction} | {esito}")
 
     # --- RISULTATO FINALE ---
     accuracy = (correct_predictions / total_tests) * 100
     print(f"\n--- TEST COMPLETATO ---")
     print(f"Accuratezza sul campione: {accuracy}% ({correct_predictions}/{total_tests})")
+    print(f"Tempo totale: {elapsed:.2f}s")
 
 if __name__ == "__main__":
-    test_pipeline()
\ No newline at end of file
+    test_pipeline()
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+from joblib import effective_n_jobs
+from joblib.externals.loky import get_reusable_executor
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import ParameterGrid, StratifiedKFold, cross_validate
+from sklearn.svm import SVC
+from sklearn.tree import DecisionTreeClassifier
+
+
+# --- MOTORE DI TRAINING (più algoritmi in parallelo, con budget di tempo) ---
+
+# Metrica (nome scikit-learn) usata per scegliere il modello da promuovere
+TRAINING_METRIC = os.getenv("TRAINING_METRIC", "roc_auc")
+TRAINING_CV_FOLDS = int(os.getenv("TRAINING_CV_FOLDS", "5"))
+# Budget in secondi per la ricerca: deve restare sotto il timeout della
+# Function (5 minuti sul piano Consumption) lasciando margine per il salvataggio
+TRAINING_TIME_BUDGET_SECONDS = float(os.getenv("TRAINING_TIME_BUDGET_SECONDS", "180"))
+# Frazione del budget riservata al fit finale sul dataset completo: la
+# ricerca si ferma prima, così anche il refit rientra nel budget
+TRAINING_REFIT_RESERVE = float(os.getenv("TRAINING_REFIT_RESERVE", "0.25"))
+TRAINING_N_JOBS = int(os.getenv("TRAINING_N_JOBS", "-1"))
+# Algoritmi da provare (separati da virgola); vuoto = tutti
+TRAINING_CANDIDATES = [c.strip() for c in os.getenv("TRAINING_CANDIDATES", "").split(",") if c.strip()]
+
+REPORT_FILENAME = "training_report.json"
+
+# Algoritmi candidati (quelli indicati nel README) e relative griglie di
+# iperparametri. Le feature arrivano già standardizzate dalla trasformazione
+# del preprocessing (vedi transform.py), quindi regressione logistica e SVM
+# non hanno bisogno di uno StandardScaler in Pipeline.
+CANDIDATES = {
+    "logistic_regression": (
+        lambda: LogisticRegression(max_iter=2000),
+        {"C": [0.1, 1.0, 10.0]},
+    ),
+    "decision_tree": (
+        lambda: DecisionTreeClassifier(random_state=42),
+        {"max_depth": [None, 5, 10], "min_samples_leaf": [1, 5]},
+    ),
+    "random_forest": (
+        lambda: RandomForestClassifier(random_state=42),
+        {"n_estimators": [100, 300], "max_features": ["sqrt", 0.3]},
+    ),
+    "svm": (
+        lambda: SVC(probability=True, random_state=42),
+        {"C": [0.5, 1.0, 5.0], "gamma": ["scale"]},
+    ),
+}
+
+
+class TrainingResult:
+    def __init__(self, model, name, params, score, report):
+        self.model = model
+        self.name = name
+        self.params = params
+        self.score = score
+        self.report = report
+
+
+def candidate_grid(names=None):
+    names = names or TRAINING_CANDIDATES or list(CANDIDATES)
+    for name in names:
+        if name not in CANDIDATES:
+            raise ValueError(f"Algoritmo sconosciuto: {name}")
+        factory, grid = CANDIDATES[name]
+        for params in ParameterGrid(grid):
+            yield name, params
+
+
+def predict_latency_ms(model, X, repeats=20):
+    # Latenza mediana di una predizione su una singola riga
+    row = X[:1]
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        model.predict(row)
+        timings.append(time.perf_counter() - started)
+    return float(np.median(timings) * 1000)
+
+
+def evaluate_candidate(name, params, X, y, metric, folds):
+    # Eseguita nei processi worker: cross-validation di una configurazione
+    estimator = CANDIDATES[name][0]().set_params(**params)
+    cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=42)
+    started = time.perf_counter()
+    scores = cross_validate(estimator, X, y, cv=cv, scoring=metric, return_estimator=True)
+    score = float(np.mean(scores["test_score"]))
+    return {
+        "name": name,
+        "params": params,
+        "score": score,
+        "score_std": float(np.std(scores["test_score"])),
+        "fit_time_s": float(np.mean(scores["fit_time"])),
+        # Con fold fallite (punteggio NaN) il primo estimatore può non essere fittato
+        "predict_latency_ms": predict_latency_ms(scores["estimator"][0], X) if np.isfinite(score) else None,
+        "cv_time_s": time.perf_counter() - started,
+    }
+
+
+def estimated_refit_s(result, folds):
+    # Il fit finale usa tutti i dati, le fold ne usano (folds - 1) / folds
+    return result["fit_time_s"] * folds / max(folds - 1, 1)
+
+
+def select_model(X, y, metric=TRAINING_METRIC, folds=TRAINING_CV_FOLDS,
+                 budget_seconds=TRAINING_TIME_BUDGET_SECONDS, n_jobs=TRAINING_N_JOBS, names=None,
+                 refit_reserve=TRAINING_REFIT_RESERVE):
+    # Valuta tutte le configurazioni in parallelo su tutti i core e promuove
+    # la migliore secondo `metric`. Le configurazioni non completate entro il
+    # budget della ricerca vengono scartate; il resto del budget è per il refit.
+    started = time.monotonic()
+    deadline = started + budget_seconds
+    search_deadline = started + budget_seconds * (1 - refit_reserve)
+    tasks = list(candidate_grid(names))
+    logging.info(f"Valutazione di {len(tasks)} configurazioni ({metric}, {folds}-fold CV, "
+                 f"budget {budget_seconds:.0f}s, di cui {budget_seconds * refit_reserve:.0f}s per il refit).")
+
+    completed = []
+    failed = []
+    workers = min(effective_n_jobs(n_jobs), len(tasks))
+    executor = get_reusable_executor(max_workers=workers)
+    queue = iter(tasks)
+    running = set()
+    # Al massimo una configurazione per worker: alla scadenza non resta nulla
+    # in coda e basta fermare quelle in esecuzione
+    for name, params in queue:
+        running.add(executor.submit(evaluate_candidate, name, params, X, y, metric, folds))
+        if len(running) == workers:
+            break
+    while running:
+        # L'attesa stessa è limitata dal budget: non serve che arrivi un
+        # risultato per accorgersi che il tempo è finito
+        remaining = search_deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, running = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            task = next(queue, None)
+            if task is not None:
+                running.add(executor.submit(evaluate_candidate, *task, X, y, metric, folds))
+            try:
+                result = future.result()
+            except Exception as e:
+                # Tutti i fit della configurazione falliti (cross_validate solleva)
+                logging.warning(f"  Configurazione fallita: {e}")
+                failed.append({"error": str(e)})
+                continue
+            if not np.isfinite(result["score"]):
+                # Con error_score=nan (default di cross_validate) una fold
+                # fallita dà punteggio NaN, che non si può ordinare
+                logging.warning(f"  {result['name']} {result['params']}: punteggio non valido, scartata.")
+                failed.append(result)
+                continue
+            completed.append(result)
+            logging.info(f"  {result['name']} {result['params']}: {metric}={result['score']:.4f} "
+                         f"fit={result['fit_time_s']:.2f}s predict={result['predict_latency_ms']:.2f}ms")
+    if len(completed) + len(failed) < len(tasks):
+        logging.warning(f"Budget di ricerca di {budget_seconds * (1 - refit_reserve):.0f}s esaurito: "
+                        f"{len(tasks) - len(completed) - len(failed)} configurazioni non valutate.")
+        # Le configurazioni in esecuzione non si possono annullare: si fermano
+        # i worker, il prossimo training ne crea di nuovi
+        executor.shutdown(wait=False, kill_workers=True)
+
+    if not completed:
+        if failed:
+            raise ValueError(f"Nessuna configurazione con un punteggio valido ({len(failed)} fallite).")
+        raise TimeoutError("Nessuna configurazione completata entro il budget di training.")
+
+    # A parità di punteggio vince il modello più veloce in inferenza. Si
+    # promuove la migliore configurazione il cui refit (stimato dai tempi di
+    # fit della CV) rientra nel budget rimasto; se nessuna ci sta, la più rapida.
+    remaining = deadline - time.monotonic()
+    ranked = sorted(completed, key=lambda r: (-r["score"], r["predict_latency_ms"]))
+    fitting = [r for r in ranked if estimated_refit_s(r, folds) <= remaining]
+    if fitting:
+        best = fitting[0]
+    else:
+        best = min(completed, key=lambda r: estimated_refit_s(r, folds))
+        logging.warning(f"Nessun refit stimato entro i {max(remaining, 0):.0f}s rimasti: "
+                        f"uso la configurazione più rapida da addestrare.")
+    if best is not ranked[0]:
+        logging.info(f"Promosso {best['name']} {best['params']} al posto di {ranked[0]['name']} "
+                     f"{ranked[0]['params']}: refit stimato fuori budget.")
+    model = CANDIDATES[best["name"]][0]().set_params(**best["params"])
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=n_jobs)
+    refit_started = time.perf_counter()
+    model.fit(X, y)
+    if "n_jobs" in model.get_params():
+        # In inferenza predict lavora su poche righe: niente pool di thread
+        model.set_params(n_jobs=None)
+
+    report = {
+        "metric": metric,
+        "cv_folds": folds,
+        "budget_seconds": budget_seconds,
+        "refit_reserve": refit_reserve,
+        "elapsed_seconds": time.monotonic() - started,
+        "evaluated": len(completed),
+        "total": len(tasks),
+        "best": {"name": best["name"], "params": best["params"], "score": best["score"],
+                 "refit_time_s": time.perf_counter() - refit_started},
+        "candidates": sorted(completed, key=lambda r: -r["score"]),
+        "failed": failed,
+    }
+    return TrainingResult(model, best["name"], best["params"], best["score"], report)
+
+
+def report_to_json(report):
+    return json.dumps(report, indent=2, default=str)
@@ -0,0 +1,279 @@
+import io
+import math
+
+import numpy as np
+import pandas as pd
+
+import telemetry
+from schema import SchemaError
+
+
+# --- TRASFORMAZIONE FITTATA NEL PREPROCESSING (riusata in inferenza) ---
+# Valori di imputazione, parametri di scaling (media e deviazione standard)
+# e vocabolari delle colonne categoriche, salvati come array NumPy (.npz,
+# senza pickle). data_preprocessing la applica ai dati di training e
+# predict ai record in arrivo, quindi il modello vede sempre la stessa
+# matrice: valori mancanti imputati, descrittori standardizzati, dummy 0/1.
+
+# Prefisso dei blob della trasformazione nel container 'models'; il nome
+# contiene l'impronta dell'input, quindi un blob non viene mai sovrascritto.
+TRANSFORM_PREFIX = "transforms/"
+
+
+class ColumnStats:
+    # Statistiche per colonna accumulabili blocco per blocco (NaN esclusi):
+    # conteggi, somme e somme dei quadrati dei descrittori numerici e
+    # frequenze delle categorie.
+    def __init__(self, numeric, categorical):
+        self.numeric = list(numeric)
+        self.categorical = list(categorical)
+        self.count = np.zeros(len(self.numeric))
+        self.sum = np.zeros(len(self.numeric))
+        self.sumsq = np.zeros(len(self.numeric))
+        self.shift = None
+        self.categories = {col: {} for col in self.categorical}
+
+    def update(self, df):
+        if self.numeric and len(df):
+            X = df[self.numeric].to_numpy(dtype=np.float64)
+            valid = ~np.isnan(X)
+            if self.shift is None:
+                # Traslazione sul primo valore osservato per stabilità numerica
+                first = np.where(valid.any(axis=0), X[valid.argmax(axis=0), np.arange(X.shape[1])], 0.0)
+                self.shift = np.nan_to_num(first)
+            X = np.where(valid, X - self.shift, 0.0)
+            self.count += valid.sum(axis=0)
+            self.sum += X.sum(axis=0)
+            self.sumsq += np.einsum("ij,ij->j", X, X)
+        for col in self.categorical:
+            counts = self.categories[col]
+            for value, n in df[col].dropna().astype(str).value_counts().items():
+                counts[value] = counts.get(value, 0) + int(n)
+
+
+class FittedTransform:
+    def __init__(self, numeric, fill, center, scale, vocabulary=None, fill_categories=None):
+        self.numeric = list(numeric)
+        self.fill = np.asarray(fill, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.inv_scale = 1.0 / self.scale
+        self.vocabulary = {col: list(categories) for col, categories in (vocabulary or {}).items()}
+        # Categoria usata al posto dei valori mancanti (la più frequente)
+        self.fill_categories = dict(fill_categories or {})
+
+        # Stesso ordine di colonne di pd.get_dummies(drop_first=True):
+        # descrittori numerici, poi le dummy di ogni colonna categorica
+        self.dummy_columns = {col: [f"{col}_{c}" for c in categories[1:]]
+                              for col, categories in self.vocabulary.items()}
+        self.features = self.numeric + [name for names in self.dummy_columns.values() for name in names]
+        self.n_numeric = len(self.numeric)
+        self.index = {name: i for i, name in enumerate(self.numeric)}
+        self._codes = {col: {c: i for i, c in enumerate(categories)} for col, categories in self.vocabulary.items()}
+        self._offsets = {}
+        offset = self.n_numeric
+        for col, names in self.dummy_columns.items():
+            self._offsets[col] = offset
+            offset += len(names)
+
+    @property
+    def n_features(self):
+        return len(self.features)
+
+    @property
+    def input_columns(self):
+        # Colonne grezze attese nei record: descrittori e colonne categoriche
+        return self.numeric + list(self.vocabulary)
+
+    # --- Costruzione / serializzazione ---
+
+    @classmethod
+    def fit(cls, stats, numeric=None):
+        # `numeric`: sottoinsieme (ordinato) delle colonne di stats.numeric da
+        # tenere, ad esempio dopo la riduzione dei descrittori
+        numeric = stats.numeric if numeric is None else list(numeric)
+        idx = np.array([stats.numeric.index(c) for c in numeric], dtype=np.intp)
+        count = stats.count[idx]
+        observed = count > 0
+        safe = np.where(observed, count, 1.0)
+        shift = stats.shift[idx] if stats.shift is not None else np.zeros(len(idx))
+        mean_shifted = stats.sum[idx] / safe
+        variance = np.maximum(stats.sumsq[idx] / safe - mean_shifted ** 2, 0.0)
+        std = np.sqrt(variance)
+        mean = np.where(observed, shift + mean_shifted, 0.0)
+        # Colonne costanti: scala 1, così restano a 0 dopo la trasformazione
+        scale = np.where(std > 0, std, 1.0)
+
+        vocabulary = {}
+        fill_categories = {}
+        for col in stats.categorical:
+            counts = stats.categories[col]
+            # Ordine alfabetico, come pd.get_dummies
+            vocabulary[col] = sorted(counts)
+            if counts:
+                fill_categories[col] = max(sorted(counts), key=lambda c: counts[c])
+        return cls(numeric, fill=mean, center=mean, scale=scale, vocabulary=vocabulary,
+                   fill_categories=fill_categories)
+
+    def to_bytes(self):
+        categorical = list(self.vocabulary)
+        arrays = {
+            "numeric": np.array(self.numeric, dtype=str),
+            "fill": self.fill,
+            "center": self.center,
+            "scale": self.scale,
+            "categorical": np.array(categorical, dtype=str),
+            "fill_categories": np.array([self.fill_categories.get(col, "") for col in categorical], dtype=str),
+        }
+        for i, col in enumerate(categorical):
+            arrays[f"vocabulary_{i}"] = np.array(self.vocabulary[col], dtype=str)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            categorical = arrays["categorical"].tolist()
+            return cls(
+                numeric=arrays["numeric"].tolist(),
+                fill=arrays["fill"],
+                center=arrays["center"],
+                scale=arrays["scale"],
+                vocabulary={col: arrays[f"vocabulary_{i}"].tolist() for i, col in enumerate(categorical)},
+                fill_categories={col: value for col, value in zip(categorical, arrays["fill_categories"].tolist())
+                                 if value},
+            )
+
+    # --- Applicazione ---
+
+    def _apply(self, X):
+        # Imputazione + standardizzazione in place su una matrice (righe, descrittori)
+        np.copyto(X, self.fill, where=np.isnan(X))
+        X -= self.center
+        X *= self.inv_scale
+
+    def _category_codes(self, series, col):
+        # Codici delle categorie (posizione nel vocabolario): i mancanti
+        # diventano la categoria di riempimento, le sconosciute -1
+        codes = pd.Categorical(series.dropna().astype(str), categories=self.vocabulary[col]).codes
+        out = np.full(len(series), self._codes[col].get(self.fill_categories.get(col), 0), dtype=np.int64)
+        out[series.notna().to_numpy()] = codes
+        return out
+
+    def _set_dummies(self, X, col, codes, base=0):
+        # drop_first: la prima categoria (codice 0) è la riga tutta a zero.
+        # `base`: colonna di X corrispondente alla prima dummy
+        rows = np.flatnonzero(codes > 0)
+        X[rows, self._offsets[col] - base + codes[rows] - 1] = 1.0
+
+    def transform_frame(self, df, target=None):
+        # DataFrame pulito -> DataFrame del training (descrittori trasformati,
+        # dummy booleane, target in fondo)
+        with telemetry.phase("impute_scale", rows=len(df)):
+            X = df[self.numeric].to_numpy(dtype=np.float64, copy=True)
+            self._apply(X)
+            out = pd.DataFrame(X, columns=self.numeric, index=df.index)
+        if self.vocabulary:
+            with telemetry.phase("get_dummies", rows=len(df), categorical_columns=len(self.vocabulary)):
+                D = np.zeros((len(df), self.n_features - self.n_numeric))
+                for col in self.vocabulary:
+                    self._set_dummies(D, col, self._category_codes(df[col], col), base=self.n_numeric)
+                out = pd.concat([out, pd.DataFrame(D.astype(bool), columns=self.features[self.n_numeric:],
+                                                   index=df.index)], axis=1)
+        if target is not None and target in df.columns:
+            out[target] = df[target].to_numpy()
+        return out
+
+    # --- Inferenza (stessa interfaccia di FeatureSchema) ---
+
+    def _fill_row(self, out, record):
+        # Scrive il record grezzo nella riga `out`: descrittori (None = da
+        # imputare) e dummy. Le colonne assenti dal record sono un errore.
+        if not isinstance(record, dict):
+            raise SchemaError("ogni record deve essere un oggetto JSON")
+        out[:self.n_numeric] = np.nan
+        out[self.n_numeric:] = 0.0
+
+        seen = 0
+        bad = []
+        for name, value in record.items():
+            pos = self.index.get(name)
+            if pos is None:
+                if name in self.vocabulary:
+                    seen += 1
+                    code = self._codes[name].get(str(value)) if value is not None \
+                        else self._codes[name].get(self.fill_categories.get(name))
+                    if code is None:
+                        bad.append(name)
+                    elif code > 0:
+                        out[self._offsets[name] + code - 1] = 1.0
+                # Colonne extra (Label, SMILES, descrittori non usati) ignorate
+                continue
+            seen += 1
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = float(value)
+            elif not isinstance(value, (int, float)):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    bad.append(name)
+                    continue
+            if math.isinf(value):
+                bad.append(name)
+                continue
+            out[pos] = value
+
+        if bad:
+            raise SchemaError(f"valori non numerici, non finiti o categorie sconosciute: {bad[:10]}")
+        if seen != self.n_numeric + len(self.vocabulary):
+            missing = [f for f in self.numeric + list(self.vocabulary) if f not in record]
+            raise SchemaError(f"feature mancanti ({len(missing)}): {missing[:10]}")
+
+    def vectorize(self, record):
+        X = np.empty((1, self.n_features), dtype=np.float64)
+        self._fill_row(X[0], record)
+        self._apply(X[:, :self.n_numeric])
+        return X
+
+    def vectorize_many(self, records):
+        X = np.empty((len(records), self.n_features), dtype=np.float64)
+        valid = []
+        errors = {}
+        for i, record in enumerate(records):
+            try:
+                self._fill_row(X[len(valid)], record)
+                valid.append(i)
+            except SchemaError as e:
+                errors[i] = str(e)
+        X = X[:len(valid)]
+        self._apply(X[:, :self.n_numeric])
+        return X, valid, errors
+
+    def vectorize_frame(self, df):
+        missing = [f for f in self.numeric + list(self.vocabulary) if f not in df.columns]
+        if missing:
+            raise SchemaError(f"feature mancanti ({len(missing)}): {missing[:10]}")
+        raw = df[self.numeric]
+        X = np.zeros((len(df), self.n_features), dtype=np.float64)
+        X[:, :self.n_numeric] = raw.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        # Errore solo per valori presenti ma non convertibili (o infiniti);
+        # le celle vuote vengono imputate
+        bad = (np.isnan(X[:, :self.n_numeric]) & raw.notna().to_numpy()) | np.isinf(X[:, :self.n_numeric])
+        bad_names = list(self.numeric)
+        for col in self.vocabulary:
+            codes = self._category_codes(df[col], col)
+            bad = np.column_stack([bad, codes < 0])
+            bad_names.append(col)
+            self._set_dummies(X, col, np.maximum(codes, 0))
+
+        row_ok = ~bad.any(axis=1)
+        errors = {}
+        for i in np.flatnonzero(~row_ok):
+            names = [bad_names[j] for j in np.flatnonzero(bad[i])]
+            errors[int(i)] = f"valori non numerici, non finiti o categorie sconosciute: {names[:10]}"
+        X = np.ascontiguousarray(X[row_ok])
+        self._apply(X[:, :self.n_numeric])
+        return X, np.flatnonzero(row_ok).tolist(), errors